@@ -0,0 +1,156 @@
+from server.extensions import services
+
+from collections import defaultdict
+from typing import Dict, List
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+
+# NOTE: Only for stress testing; runs searches against the configured
+# server while other threads remove and re-add equipments and swap the
+# ranker, and reports search throughput and latency per second so stalls
+# during writes and swaps show up
+
+
+class Recorder:
+
+    def __init__(self, start: float):
+        self.start = start
+        self._lock = threading.Lock()
+        self.latencies: Dict[int, List[float]] = defaultdict(list)
+        self.events: Dict[int, List[str]] = defaultdict(list)
+        self.errors: List[str] = []
+
+    def bucket(self, at: float) -> int:
+        return int(at - self.start)
+
+    def search(self, started: float, finished: float):
+        with self._lock:
+            self.latencies[self.bucket(finished)].append(finished - started)
+
+    def event(self, name: str):
+        with self._lock:
+            self.events[self.bucket(time.perf_counter())].append(name)
+
+    def error(self):
+        with self._lock:
+            self.errors.append(traceback.format_exc())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=60.)
+    parser.add_argument("--searchers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--write-batch", type=int, default=32)
+    parser.add_argument("--swap-every", type=float, default=10.,
+                        help="Seconds between ranker swaps; 0 disables them")
+    parser.add_argument("--queries", type=str, default=None,
+                        help="File with one query per line; feedback queries if missing")
+    args = parser.parse_args()
+
+    # NOTE: Builds and indexes everything, without the background workers
+    services.run_until(services.INDEX)
+    database_acessor = services.database_acessor
+    driver = services.driver
+
+    if args.queries is not None:
+        with open(args.queries, 'r') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sorted(set(database_acessor.get_feedback_columns().queries))
+
+    assert queries, "No queries to search with"
+
+    tags = driver.indexed_tags()
+    indexed_before = len(tags)
+
+    ranker_path = tempfile.mkdtemp(prefix="ranker-")
+    driver.ranking.save_ranker(ranker_path)
+
+    stop = threading.Event()
+    recorder = Recorder(time.perf_counter())
+
+    def searcher():
+        while not stop.is_set():
+            query = random.choice(queries)
+            started = time.perf_counter()
+
+            try:
+                driver.get_query_rankings(query, 20)
+            except Exception:
+                recorder.error()
+                continue
+
+            recorder.search(started, time.perf_counter())
+
+    def writer():
+        while not stop.is_set():
+            batch = random.sample(tags, min(args.write_batch, len(tags)))
+
+            try:
+                driver.apply_equipment_changes([], batch)
+                recorder.event("removed")
+                driver.apply_equipment_changes(batch, [])
+                recorder.event("re-added")
+            except Exception:
+                recorder.error()
+
+    def swapper():
+        while not stop.wait(args.swap_every):
+            try:
+                driver.ranking.load_ranker(ranker_path)
+                recorder.event("ranker swap")
+            except Exception:
+                recorder.error()
+
+    threads = [threading.Thread(target=searcher) for _ in range(args.searchers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    if args.swap_every > 0:
+        threads.append(threading.Thread(target=swapper))
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    print(f"{'second':>6} {'searches':>9} {'p50 ms':>9} {'p99 ms':>9}  events")
+
+    all_latencies = []
+    for second in range(int(args.duration) + 1):
+        latencies = np.array(recorder.latencies.get(second, [])) * 1000
+        all_latencies.extend(latencies)
+
+        events = recorder.events.get(second, [])
+        summary = ", ".join(f"{events.count(name)} {name}" for name in sorted(set(events)))
+
+        if len(latencies) == 0:
+            print(f"{second:>6} {0:>9} {'-':>9} {'-':>9}  {summary}")
+            continue
+
+        print(f"{second:>6} {len(latencies):>9} "
+              f"{np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}  {summary}")
+
+    all_latencies = np.array(all_latencies)
+    print(f"\n{len(all_latencies)} searches "
+          f"({len(all_latencies) / args.duration:.1f}/s), "
+          f"p50 {np.percentile(all_latencies, 50):.2f}ms, "
+          f"p99 {np.percentile(all_latencies, 99):.2f}ms")
+
+    # Every writer re-adds what it removed, so the index ends as it began
+    indexed_after = len(driver.indexed_tags())
+    print(f"Indexed equipments: {indexed_before} before, {indexed_after} after")
+    print(f"{len(recorder.errors)} errors")
+
+    for error in recorder.errors[:5]:
+        print(error)
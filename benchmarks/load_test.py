@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import argparse
+import http.client
+import random
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+# NOTE: Only for benchmarking; sends /search requests to running servers,
+# e.g. the Flask app (flask run / gunicorn server.app:app) and the ASGI
+# app (uvicorn server.asgi:app), one after the other with the same
+# queries and concurrency, and reports requests per second and latency
+# for each:
+#   python benchmarks/load_test.py --queries queries.txt \
+#       --target flask=http://localhost:5000 --target asgi=http://localhost:8000
+
+
+def run(base_url: str, queries: List[str], concurrency: int, duration: float, limit: int) -> Tuple[np.ndarray, int, float]:
+    url = urllib.parse.urlsplit(base_url)
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies: List[float] = []
+    errors = [0]
+
+    def client(seed: int):
+        # NOTE: One keep-alive connection per client, as a browser would
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+
+        while not stop.is_set():
+            query = urllib.parse.quote(rng.choice(queries), safe="")
+            started = time.perf_counter()
+
+            try:
+                connection.request(
+                    "GET", f"{url.path.rstrip('/')}/search/{query}?limit={limit}")
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port)
+                ok = False
+
+            finished = time.perf_counter()
+
+            with lock:
+                if ok:
+                    latencies.append(finished - started)
+                else:
+                    errors[0] += 1
+
+        connection.close()
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for seed in range(concurrency):
+            executor.submit(client, seed)
+
+        time.sleep(duration)
+        stop.set()
+
+    return np.array(latencies) * 1000, errors[0], time.perf_counter() - start
+
+
+def report(name: str, latencies: np.ndarray, errors: int, elapsed: float):
+    if len(latencies) == 0:
+        print(f"{name:<12} no successful requests, {errors} errors")
+        return
+
+    print(f"{name:<12} {len(latencies) / elapsed:9.1f} req/s  "
+          f"p50 {np.percentile(latencies, 50):8.2f}ms  "
+          f"p99 {np.percentile(latencies, 99):8.2f}ms  "
+          f"{errors} errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", required=True,
+                        help="name=base_url of a running server; repeat to compare")
+    parser.add_argument("--queries", type=str, required=True,
+                        help="File with one query per line")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.)
+    parser.add_argument("--warmup", type=float, default=5.)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.queries, 'r') as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    targets = [target.split("=", 1) for target in args.target]
+
+    for name, base_url in targets:
+        if args.warmup > 0:
+            run(base_url, queries, args.concurrency, args.warmup, args.limit)
+
+        report(name, *run(base_url, queries,
+               args.concurrency, args.duration, args.limit))
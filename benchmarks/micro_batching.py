@@ -0,0 +1,73 @@
+from server.extensions import services
+
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import time
+
+import numpy as np
+
+# NOTE: Only for benchmarking; runs concurrent searches for distinct
+# queries against the configured server and reports latency along with
+# the batch sizes and queueing delays of the query micro-batchers
+# (query_batch_max_size in the config); run with 1 to compare
+
+
+def report_batcher(name: str, batcher):
+    if batcher is None:
+        print(f"{name:<24} batching disabled")
+        return
+
+    stats = batcher.stats()
+    if stats["batches"] == 0:
+        print(f"{name:<24} no batches")
+        return
+
+    print(f"{name:<24} {stats['batches']:>6} batches  "
+          f"mean size {stats['batch_size_mean']:5.2f}  "
+          f"max size {stats['batch_size_max']:>3}  "
+          f"queue p50 {stats['queue_delay_ms_p50']:6.2f}ms  "
+          f"p99 {stats['queue_delay_ms_p99']:6.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=str, required=True,
+                        help="File with one query per line")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    # NOTE: Builds and indexes everything, without the background workers
+    services.run_until(services.INDEX)
+    driver = services.driver
+    query_cache = services.query_cache
+    query_transformer = services.query_transformer
+
+    with open(args.queries, 'r') as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    def search(index: int) -> float:
+        # NOTE: Suffixed so no two requests share a cached embedding
+        query = f"{queries[index % len(queries)]} {index}"
+        started = time.perf_counter()
+        driver.get_query_rankings(query, 20)
+
+        return time.perf_counter() - started
+
+    query_cache.clear()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        latencies = np.array(
+            list(executor.map(search, range(args.requests)))) * 1000
+
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.requests} searches at concurrency {args.concurrency}: "
+          f"{args.requests / elapsed:.1f}/s, "
+          f"p50 {np.percentile(latencies, 50):.2f}ms, "
+          f"p99 {np.percentile(latencies, 99):.2f}ms")
+
+    report_batcher("query encoder", query_transformer.batcher)
+    report_batcher("ranker query encoder", driver.ranking.batcher)
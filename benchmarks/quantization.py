@@ -0,0 +1,80 @@
+from ccdr.retrieval.vector_index import FLOAT16, FLOAT32, INT8, BruteForceIndex
+from ccdr.transformers.user_query_transformer import TypeTransformer
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# NOTE: Only for benchmarking; reports the memory, latency and recall@k of
+# the float16 and int8 index storages against float32 on held-out queries.
+# The equipment embeddings come from a snapshot (see server.snapshot)
+
+
+def report(name: str, nbytes: int, timings: np.ndarray, recalls: np.ndarray):
+    print(f"{name:<8} {nbytes / 2 ** 20:10.1f}MiB  "
+          f"mean {timings.mean():8.2f}ms  "
+          f"p99 {np.percentile(timings, 99):8.2f}ms  "
+          f"recall@k {recalls.mean():.4f} (min {recalls.min():.4f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("snapshot", type=str,
+                        help="Snapshot directory holding embeddings.npy and tags.json")
+    parser.add_argument("--queries", type=str, default=None,
+                        help="File with one query per line; held-out equipments if missing")
+    parser.add_argument("--held-out", type=int, default=500,
+                        help="Equipments left out of the index and used as queries")
+    parser.add_argument("--k", type=int, default=100)
+    args = parser.parse_args()
+
+    embeddings = np.load(os.path.join(args.snapshot, "embeddings.npy"))
+    with open(os.path.join(args.snapshot, "tags.json"), "r") as f:
+        tags = json.load(f)["tags"]
+
+    rng = np.random.default_rng(42)
+
+    if args.queries is not None:
+        query_transformer = TypeTransformer()
+
+        with open(args.queries, 'r') as f:
+            queries = np.stack([
+                query_transformer.calculate_embedding(line.strip())
+                for line in f if line.strip()
+            ])
+        indexed = np.arange(len(tags))
+    else:
+        order = rng.permutation(len(tags))
+        queries = embeddings[order[:args.held_out]]
+        indexed = np.sort(order[args.held_out:])
+
+    indexes = {}
+    for storage in (FLOAT32, FLOAT16, INT8):
+        index = BruteForceIndex(storage=storage)
+        index.add_many([tags[row] for row in indexed], embeddings[indexed])
+        indexes[storage] = index
+
+    truth = [
+        {tag for tag, _ in indexes[FLOAT32].search(query, args.k)}
+        for query in queries
+    ]
+
+    print(f"{len(indexed)} equipments, {len(queries)} queries, k={args.k}")
+
+    for storage, index in indexes.items():
+        timings = []
+        recalls = []
+
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = {tag for tag, _ in index.search(query, args.k)}
+            timings.append(time.perf_counter() - start)
+
+            recalls.append(len(found.intersection(expected)) /
+                           len(expected) if expected else 1.)
+
+        report(storage, index.nbytes, np.array(timings)
+               * 1000, np.array(recalls))
@@ -0,0 +1,69 @@
+from ccdr.ranking_model.ranking import EquipmentRankingModel, POOLER_OUTPUT_DIM
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# NOTE: Only for benchmarking; compares the eager ranker paths with the
+# compiled EquipmentRankingModel.infer graph on synthetic inputs
+
+
+def timed(func, repeat: int):
+    func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return np.array(timings) * 1000
+
+
+def report(name: str, timings: np.ndarray):
+    print(f"{name:<28} mean {timings.mean():8.2f}ms  "
+          f"p50 {np.percentile(timings, 50):8.2f}ms  "
+          f"p99 {np.percentile(timings, 99):8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--equipments", type=int, default=10_000)
+    parser.add_argument("--candidates", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--export", type=str, default=None,
+                        help="Also export the compiled graph as a SavedModel here")
+    args = parser.parse_args()
+
+    ids = [f"{i:024x}" for i in range(args.equipments)]
+    ranker = EquipmentRankingModel(ids, 1, 1e-3)
+
+    rng = np.random.default_rng(42)
+    query_output = tf.convert_to_tensor(
+        rng.normal(size=(1, POOLER_OUTPUT_DIM)).astype(np.float32))
+    candidates = list(rng.choice(ids, size=args.candidates, replace=False))
+
+    def eager_per_candidate():
+        for tag in candidates:
+            ranker.ranking_model(query_output, tf.convert_to_tensor(tag))
+
+    def eager_batched():
+        queries = tf.tile(tf.expand_dims(query_output, axis=0),
+                          [len(candidates), 1, 1])
+        ranker.ranking_model(queries, tf.convert_to_tensor(candidates))
+
+    def compiled():
+        ranker.score_batch(query_output, candidates)
+
+    ranker.warm_up()
+
+    print(f"{args.candidates} candidates out of {args.equipments} equipments")
+    report("eager, one per candidate", timed(eager_per_candidate, args.repeat))
+    report("eager, batched", timed(eager_batched, args.repeat))
+    report("compiled (infer)", timed(compiled, args.repeat))
+
+    if args.export is not None:
+        ranker.export_saved_model(args.export)
+        print("Exported SavedModel to", args.export)
@@ -0,0 +1,152 @@
+from server.database import MongoDatabaseAccessor
+from server.config import ServerConfig
+from ccdr.retrieval.candidates import CandidateGenerator, ECMCandidateGenerator, VectorIndexCandidateGenerator
+from ccdr.retrieval.vector_index import BruteForceIndex
+from ccdr.retrieval.ivf_index import IVFIndex
+from ccdr.transformers.user_query_transformer import TypeTransformer
+from ccdr.transformers.equipment_transformer import EquipmentTypeTransformer
+from ccdr.utils.embedding_store import EmbeddingStore
+from ccdr.utils.iterators import chunked
+from ccdr.utils.query_cache import QueryEmbeddingCache
+from interference.clusters.ecm import ECM
+
+from interference.interface import Interface
+from interference.scoring import ScoringCalculator
+
+from typing import Dict, List
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+# NOTE: Only for benchmarking; compares the latency and recall of the
+# candidate generators against the exact (brute force) top k on the
+# equipments in the configured database
+
+
+def report(name: str, timings: np.ndarray, recalls: np.ndarray):
+    print(f"{name:<16} mean {timings.mean():8.2f}ms  "
+          f"p50 {np.percentile(timings, 50):8.2f}ms  "
+          f"p99 {np.percentile(timings, 99):8.2f}ms  "
+          f"recall@k {recalls.mean():.3f}")
+
+
+def top_tags(candidates: Dict[str, float], k: int) -> List[str]:
+    return [tag for tag, _ in sorted(candidates.items(), key=lambda item: item[1], reverse=True)[:k]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.json")
+    parser.add_argument("--queries", type=str, default=None,
+                        help="File with one query per line; feedback queries if missing")
+    parser.add_argument("--max-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16, 32],
+                        help="n_probe values the ivf index is measured with")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config: ServerConfig = json.load(f)
+
+    modelname = 'neuralmind/bert-large-portuguese-cased'
+    embedding_store_path = config.get("embedding_store_path")
+
+    equipment_transformer = EquipmentTypeTransformer(
+        modelname=modelname,
+        encode_batch_size=config.get("encode_batch_size", 32),
+        embedding_store=None if embedding_store_path is None else EmbeddingStore(
+            embedding_store_path, modelname),
+    )
+    query_transformer = TypeTransformer(
+        modelname=modelname, query_cache=QueryEmbeddingCache())
+
+    interface = Interface(
+        processor=ECM(distance_threshold=5.),
+        transformers={
+            "query_type": query_transformer,
+            "equipment": equipment_transformer,
+        },
+        scoring_calculator=ScoringCalculator(),
+    )
+
+    exact = VectorIndexCandidateGenerator(
+        BruteForceIndex(), query_transformer, k=args.k)
+
+    # NOTE: min_train_size=0 so the ivf index is trained however small
+    # the database is
+    ivf = VectorIndexCandidateGenerator(
+        IVFIndex(n_lists=args.n_lists, min_train_size=0), query_transformer, k=args.k)
+
+    backends: Dict[str, CandidateGenerator] = {
+        "ecm": ECMCandidateGenerator(interface),
+        "brute_force": exact,
+        "ivf": ivf,
+    }
+
+    with MongoDatabaseAccessor(config) as database_accessor:
+        start = time.perf_counter()
+        indexed = 0
+
+        for chunk in chunked(database_accessor.get_all_equipments(args.batch_size), args.batch_size):
+            equipments = [equipment for _, equipment in chunk]
+            embeddings = equipment_transformer.calculate_embeddings(equipments)
+
+            for backend in backends.values():
+                with equipment_transformer.precomputed(equipments, embeddings):
+                    for (tag, equipment), embedding in zip(chunk, embeddings):
+                        backend.add(tag, equipment, embedding)
+
+            indexed += len(chunk)
+
+        print(f"Indexed {indexed} equipments in "
+              f"{time.perf_counter() - start:.1f}s")
+
+        # NOTE: Retrained once over everything, as the server would have
+        # after growing to this size
+        ivf.index.train()
+
+        if args.queries is not None:
+            with open(args.queries, 'r') as f:
+                queries = [line.strip() for line in f if line.strip()]
+        else:
+            queries = sorted(set(database_accessor.get_feedback_columns().queries))
+
+    queries = queries[:args.max_queries]
+
+    # NOTE: Query embeddings are computed (and cached) up front so only
+    # the candidate generation itself is timed
+    for query in queries:
+        query_transformer.calculate_embedding(query)
+
+    truth = {query: top_tags(exact.candidates(query), args.k)
+             for query in queries}
+
+    print(f"{len(queries)} queries, k={args.k}")
+
+    def measure(name: str, backend: CandidateGenerator):
+        timings = []
+        recalls = []
+
+        for query in queries:
+            start = time.perf_counter()
+            candidates = backend.candidates(query)
+            timings.append(time.perf_counter() - start)
+
+            expected = truth[query]
+            found = set(top_tags(candidates, args.k))
+            recalls.append(
+                len(found.intersection(expected)) / len(expected) if expected else 1.)
+
+        report(name, np.array(timings) * 1000, np.array(recalls))
+
+    measure("ecm", backends["ecm"])
+    measure("brute_force", backends["brute_force"])
+
+    for n_probe in args.n_probe:
+        ivf.index.n_probe = n_probe
+        measure(f"ivf n_probe={n_probe}", ivf)
@@ -1,21 +1,73 @@
 from collections import defaultdict
+from dataclasses import dataclass
 
 from tensorflow.python.ops import script_ops
 from tensorflow.python.platform.tf_logging import vlog
 from server.database import MongoDatabaseAccessor
-from typing import Any, Callable, Dict, List, Sequence, Tuple, Text
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, Text
+import json
+import logging
+import os
+import pickle
+import random
+import numpy as np
 import tensorflow as tf
 import tensorflow_recommenders as tfrs
-from transformers import AutoTokenizer, TFBertModel
 
+from ccdr.transformers.model_registry import ModelRegistry, default_registry
+from ccdr.utils.embedding_store import EmbeddingStore
+from ccdr.utils.iterators import chunked
+from ccdr.utils.micro_batcher import MicroBatcher
+from ccdr.utils.query_cache import QueryEmbeddingCache
+from ccdr.utils.top_k import top_k_indexes
 
-def argsort(seq: Sequence):
-    # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-    return sorted(range(len(seq)), key=seq.__getitem__)
+
+logger = logging.getLogger('ranking')
+logger.setLevel(logging.INFO)
 
 
 Feedback = Dict[str, List[Tuple[str, float]]]
 
+FeedbackRows = Dict[Tuple[str, str], float]
+
+# Maps queries to their (len(queries), 768) pooler outputs
+QueryEncoder = Callable[[Sequence[str]], np.ndarray]
+
+
+def feedback_to_rows(clicks: Feedback) -> FeedbackRows:
+    return {
+        (query, tag): score
+        for query, values in clicks.items()
+        for tag, score in values
+    }
+
+
+def rows_to_feedback(rows: FeedbackRows) -> Feedback:
+    clicks: Feedback = {}
+
+    for (query, tag), score in rows.items():
+        clicks.setdefault(query, []).append((tag, score))
+
+    return clicks
+
+# Size of the bert-base pooler output used to represent queries
+POOLER_OUTPUT_DIM = 768
+
+INFERENCE_SIGNATURE = [
+    tf.TensorSpec(shape=[None, POOLER_OUTPUT_DIM],
+                  dtype=tf.float32, name="queries"),
+    tf.TensorSpec(shape=[None], dtype=tf.string, name="equipment_ids"),
+]
+
+
+@dataclass(frozen=True)
+class RankerVersion:
+    # A ranker with the feedback it was trained on; published as a whole
+    # so readers never pair a ranker with another one's version or rows
+    ranker: "EquipmentRankingModel"
+    version: int
+    trained_rows: FeedbackRows
+
 
 class RankingExtension:
     def __init__(
@@ -26,60 +78,245 @@ class RankingExtension:
         ranker_factory: Callable[[List[str], int, float], "EquipmentRankingModel"],
         training_epochs: int = 150,
         learning_rate: float = 1e-3,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        registry: Optional[ModelRegistry] = None,
+        incremental_epochs: int = 20,
+        replay_size: int = 1024,
+        query_store: Optional[EmbeddingStore] = None,
+        encode_batch_size: int = 32,
+        max_batch: int = 1,
+        max_wait: float = 0.005,
     ):
         self.database_accessor = database_accessor
+        self.query_cache = query_cache
         self.training_epochs = training_epochs
         self.learning_rate = learning_rate
+        self.incremental_epochs = incremental_epochs
+        self.replay_size = replay_size
+        self.query_store = query_store
+        self.encode_batch_size = encode_batch_size
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            tokenizer_name)
+        # NOTE: Concurrent rank() calls encode their queries together when
+        # max_batch > 1
+        self.batcher = None if max_batch <= 1 else MicroBatcher(
+            self._compute_output_batch, max_batch, max_wait, name="ranker-query-encoder")
 
-        self.model = TFBertModel.from_pretrained(
-            model_name, from_pt=True)
+        self.tokenizer_name = tokenizer_name
+        self.model_name = model_name
+        self.registry = registry or default_registry
 
         initial_ids = database_accessor.get_unique_ids()
 
         self.ranker_factory = ranker_factory
-        self.ranker = ranker_factory(
-            initial_ids, training_epochs, learning_rate)
+
+        ranker = ranker_factory(initial_ids, training_epochs, learning_rate)
+        ranker.warm_up()
+
+        self.current = RankerVersion(ranker, 0, {})
+
+    @property
+    def ranker(self) -> "EquipmentRankingModel":
+        return self.current.ranker
+
+    @property
+    def ranker_version(self) -> int:
+        return self.current.version
+
+    def publish(self, ranker: "EquipmentRankingModel", trained_rows: FeedbackRows):
+        # NOTE: A single reference assignment, so readers see either the
+        # old or the new ranker as a whole
+        self.current = RankerVersion(
+            ranker, self.current.version + 1, trained_rows)
+
+    @property
+    def tokenizer(self):
+        return self.registry.tokenizer(self.tokenizer_name)
+
+    @property
+    def model(self):
+        return self.registry.tf_bert_model(self.model_name)
 
     def _get_output(self, value: str):
+        if self.query_cache is None:
+            return self._compute_output(value)
+
+        return self.query_cache.get_or_compute(
+            value, QueryEmbeddingCache.RANKER, self._compute_output)
+
+    def _compute_output(self, value: str):
+        if self.batcher is not None:
+            return self.batcher.submit(value)
+
         input_ = self.tokenizer.encode(value, return_tensors="tf")
         output_ = self.model(input_).pooler_output
 
         return output_
 
-    def rank(self, query: str, equipment_tags: Sequence[str]) -> Dict[str, float]:
-        scores: List[float] = []
-        query_output = self._get_output(query)
-        for tag in equipment_tags:
-            score = self.ranker(
-                query_output, tag
+    def _compute_output_batch(self, values: List[str]) -> List[np.ndarray]:
+        # One (1, 768) pooler output per value, like _compute_output
+        outputs = self._compute_outputs(values)
+
+        return [outputs[index:index + 1] for index in range(len(values))]
+
+    def _compute_outputs(self, values: Sequence[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            list(values), padding=True, return_tensors="tf")
+
+        return self.model(inputs).pooler_output.numpy()
+
+    def encode_queries(self, queries: Sequence[str]) -> np.ndarray:
+        # Batched, deduplicated pooler outputs of the feedback queries,
+        # read from the query store when available
+        unique = list(dict.fromkeys(queries))
+        by_query: Dict[str, np.ndarray] = {}
+
+        if self.query_store is not None:
+            stored = self.query_store.get_many(unique)
+            by_query.update(
+                (query, output)
+                for query, output in zip(unique, stored)
+                if output is not None
             )
-            scores.append(score)
 
-        indexes = argsort(scores)
+        missing = [query for query in unique if query not in by_query]
+
+        for chunk in chunked(missing, self.encode_batch_size):
+            outputs = self._compute_outputs(chunk)
+            by_query.update(zip(chunk, outputs))
+
+            if self.query_store is not None:
+                self.query_store.put_many(chunk, outputs)
+
+        if self.query_store is not None and missing:
+            self.query_store.flush()
+
+        if not queries:
+            return np.zeros((0, POOLER_OUTPUT_DIM), dtype=np.float32)
+
+        return np.stack([by_query[query] for query in queries]).astype(np.float32)
+
+    def rank(
+        self,
+        query: str,
+        equipment_tags: Sequence[str],
+        limit: Optional[int] = None,
+        ranker: Optional["EquipmentRankingModel"] = None,
+    ) -> Dict[str, float]:
+        # ranker, when given, is used instead of the current one so a
+        # caller can pin the ranker it read once
+        if len(equipment_tags) == 0:
+            return {}
+
+        ranker = ranker or self.ranker
+
+        query_output = self._get_output(query)
+        scores = ranker.score_batch(query_output, equipment_tags)
 
         return {
             equipment_tags[index]: scores[index]
-            for index in indexes[::-1]
+            for index in top_k_indexes(scores, limit)
         }
 
     def learn(self, clicks: Feedback):
         # NOTE: This method can run at the same time as a call to rank()
-        # Which means, we have to keep a self.ranker in "sync"
-        # The solution found was having a ranker factory and create one
-        # here; only when ready do we set it to self.ranker
+        # The new ranker is built from the factory on the side and only
+        # published once trained and warmed up; rank() keeps using the
+        # ranker it read until then
+        current = self.current
 
         ids = self.database_accessor.get_unique_ids()
 
+        rows = feedback_to_rows(clicks)
+
+        if self.query_store is not None:
+            self._compact_query_store({query for query, _ in rows})
+
+        delta = {
+            key: score
+            for key, score in rows.items()
+            if current.trained_rows.get(key) != score
+        }
+        ids_changed = set(ids) != set(current.ranker.unique_equipment_ids)
+
+        if not delta and not ids_changed:
+            logger.info("No new feedback nor equipments; skipping training")
+            return
+
         new_ranker = self.ranker_factory(
             ids, self.training_epochs, self.learning_rate)
-        # ...
 
-        new_ranker.train(clicks, self.tokenizer, self.model)
+        if not current.trained_rows:
+            if rows:
+                logger.info("Training ranker on %d feedback rows", len(rows))
+                new_ranker.train(clicks, self.encode_queries)
+        else:
+            new_ranker.warm_start_from(current.ranker)
 
-        self.ranker = new_ranker
+            if delta:
+                replay = self._replay_sample(rows, delta)
+                logger.info("Training ranker incrementally on %d new and %d replayed feedback rows",
+                            len(delta), len(replay))
+
+                new_ranker.train(
+                    rows_to_feedback({**replay, **delta}),
+                    self.encode_queries,
+                    epochs=self.incremental_epochs, holdout=0.,
+                )
+
+        new_ranker.warm_up()
+
+        self.publish(new_ranker, rows)
+
+    def save_ranker(self, path: str):
+        # Weights, vocabulary and trained feedback of the current ranker
+        current = self.current
+        ranker = current.ranker
+        os.makedirs(path, exist_ok=True)
+
+        ranker.save_weights(os.path.join(path, "weights"))
+
+        with open(os.path.join(path, "ranker.json"), "w") as f:
+            json.dump({"equipment_ids": ranker.unique_equipment_ids}, f)
+
+        with open(os.path.join(path, "trained_rows.pkl"), "wb") as f:
+            pickle.dump(current.trained_rows, f)
+
+    def read_ranker(self, path: str) -> Tuple["EquipmentRankingModel", FeedbackRows]:
+        # A saved ranker and its trained feedback, not yet published
+        with open(os.path.join(path, "ranker.json"), "r") as f:
+            ids = json.load(f)["equipment_ids"]
+
+        with open(os.path.join(path, "trained_rows.pkl"), "rb") as f:
+            trained_rows = pickle.load(f)
+
+        ranker = self.ranker_factory(
+            ids, self.training_epochs, self.learning_rate)
+        ranker.warm_up()
+        ranker.load_weights(os.path.join(path, "weights")).expect_partial()
+
+        return ranker, trained_rows
+
+    def load_ranker(self, path: str):
+        self.publish(*self.read_ranker(path))
+
+    def _compact_query_store(self, queries: Set[str]):
+        # NOTE: Only the feedback queries are kept. Compacting rewrites the
+        # store, so it only runs once the queries no longer in the
+        # feedback are as many as the ones still in it
+        assert self.query_store is not None
+        self.query_store.touch_many(list(queries))
+
+        if self.query_store.unused_count() > len(queries):
+            evicted = self.query_store.compact()
+            logger.info("Evicted %d stale queries from the store", evicted)
+
+    def _replay_sample(self, rows: FeedbackRows, delta: FeedbackRows) -> FeedbackRows:
+        # Already seen feedback, trained again alongside the new rows so
+        # the warm-started ranker does not drift towards them only
+        seen = [key for key in rows if key not in delta]
+        sample = random.sample(seen, min(self.replay_size, len(seen)))
+
+        return {key: rows[key] for key in sample}
 
 
 class EquipmentRankingModel(tfrs.models.Model):
@@ -89,8 +326,9 @@ class EquipmentRankingModel(tfrs.models.Model):
 
         self.training_epochs = training_epochs
         self.learning_rate = learning_rate
+        self.unique_equipment_ids = list(unique_equipment_ids)
 
-        self.ranking_model: tf.keras.Model = RankingModel(unique_equipment_ids)
+        self.ranking_model: RankingModel = RankingModel(unique_equipment_ids)
         self.tasks: tf.keras.layers.Layer = tfrs.tasks.Ranking(
             loss=tf.keras.losses.MeanSquaredError(),
             metrics=[tf.keras.metrics.RootMeanSquaredError()]
@@ -107,22 +345,70 @@ class EquipmentRankingModel(tfrs.models.Model):
 
     def __call__(self, query_output, equipment_id) -> float:
 
-        score = self.ranking_model(
-            query_output, tf.convert_to_tensor(equipment_id))
+        return float(self.score_batch(query_output, [equipment_id])[0])
 
-        if score is None:
-            return 0.
+    def score_batch(self, query_output, equipment_ids: Sequence[str]) -> np.ndarray:
+        # Scores every equipment against the same query in one forward pass;
+        # query_output is the (1, 768) pooler output of the query
 
-        return score.numpy()[0][0][0]
+        if len(equipment_ids) == 0:
+            return np.zeros((0,), dtype=np.float32)
 
-    def _convert_to_tensor(self, query, tokenizer, model):
+        queries = tf.tile(query_output, [len(equipment_ids), 1])
 
-        input_ = tokenizer.encode(query, return_tensors="tf")
-        output_ = model(input_).pooler_output
+        scores = self.infer(
+            queries, tf.convert_to_tensor(list(equipment_ids)))
 
-        return output_
+        return scores["scores"].numpy()
+
+    @tf.function(input_signature=INFERENCE_SIGNATURE)
+    def infer(self, queries, equipment_ids):
+        return {"scores": self.ranking_model.score(queries, equipment_ids)}
+
+    def warm_up(self):
+        # Traces infer ahead of the first request
+        self.infer.get_concrete_function()
+
+    def warm_start_from(self, other: "EquipmentRankingModel"):
+        # Copies the weights of other into this model; equipments unknown
+        # to other keep their freshly initialized embeddings
+        self.warm_up()
+        other.warm_up()
+
+        self.ranking_model.rankings.set_weights(
+            other.ranking_model.rankings.get_weights())
 
-    def _build_dataset(self, clicks: Feedback, tokenizer, model):
+        embeddings = self.ranking_model.equipment_embeddings
+        other_embeddings = other.ranking_model.equipment_embeddings
+
+        if embeddings is None or other_embeddings is None:
+            return
+
+        vocabulary = embeddings.layers[0].get_vocabulary()
+        other_index = {
+            token: index
+            for index, token in enumerate(other_embeddings.layers[0].get_vocabulary())
+        }
+
+        pairs = np.array([
+            (index, other_index[token])
+            for index, token in enumerate(vocabulary)
+            if token in other_index
+        ], dtype=np.int64).reshape(-1, 2)
+
+        table = embeddings.layers[1].get_weights()[0]
+        other_table = other_embeddings.layers[1].get_weights()[0]
+        table[pairs[:, 0]] = other_table[pairs[:, 1]]
+
+        embeddings.layers[1].set_weights([table])
+
+    def export_saved_model(self, path: str):
+        export = RankerExport(self.ranking_model)
+
+        tf.saved_model.save(
+            export, path, signatures={"serving_default": export.serve})
+
+    def _build_dataset(self, clicks: Feedback, query_encoder: QueryEncoder, holdout: float = 0.2):
 
         queries = []
         equipments_ids = []
@@ -136,27 +422,37 @@ class EquipmentRankingModel(tfrs.models.Model):
                 equipments_ids.append(value[0])
                 scores.append(value[1])
 
-        queries = [self._convert_to_tensor(
-            query, tokenizer, model) for query in queries]
+        unique_queries = list(dict.fromkeys(queries))
+        query_index = {query: index for index,
+                       query in enumerate(unique_queries)}
 
-        tf_dataset = tf.data.Dataset.from_tensor_slices(
-            {'queries': queries, 'equipments_ids': equipments_ids, 'scores': scores})
+        # Each distinct query is encoded once; rows then pick its
+        # (1, 768) output for every equipment clicked on that query
+        query_outputs = query_encoder(unique_queries)[:, np.newaxis, :]
+        rows = np.array([query_index[query] for query in queries],
+                        dtype=np.int64)
+
+        tf_dataset = tf.data.Dataset.from_tensor_slices({
+            'queries': query_outputs[rows],
+            'equipments_ids': equipments_ids,
+            'scores': np.array(scores, dtype=np.float32),
+        })
 
         shuffled = tf_dataset.shuffle(
             100_000, seed=42, reshuffle_each_iteration=False)
         dataset_size = len(shuffled)
 
-        train_size = int(0.8 * dataset_size)
-        test_size = int(0.2 * dataset_size)
+        train_size = dataset_size - int(holdout * dataset_size)
+        test_size = int(holdout * dataset_size)
 
         train = shuffled.take(train_size)
         test = shuffled.skip(train_size).take(test_size)
 
         return (train, test)
 
-    def train(self, clicks: Feedback, tokenizer, model):
+    def train(self, clicks: Feedback, query_encoder: QueryEncoder, epochs: Optional[int] = None, holdout: float = 0.2):
 
-        train, test = self._build_dataset(clicks, tokenizer, model)
+        train, test = self._build_dataset(clicks, query_encoder, holdout)
 
         cached_train = train.shuffle(100_000).batch(8192).cache()
         cached_test = test.batch(4096).cache()
@@ -164,9 +460,10 @@ class EquipmentRankingModel(tfrs.models.Model):
         self.compile(optimizer=tf.keras.optimizers.Adagrad(
             learning_rate=self.learning_rate))
 
-        self.fit(cached_train, epochs=self.training_epochs)
+        self.fit(cached_train, epochs=epochs or self.training_epochs)
 
-        self.evaluate(cached_test, return_dict=True)
+        if holdout > 0:
+            self.evaluate(cached_test, return_dict=True)
 
 
 class RankingModel(tf.keras.Model):
@@ -216,3 +513,29 @@ class RankingModel(tf.keras.Model):
         x = tf.concat([query_output, equipment_embedding], axis=-1)
 
         return self.rankings(x)
+
+    def score(self, queries, equipment_ids):
+        # Fixed-rank counterpart of call: (batch, 768) queries and (batch,)
+        # ids in, (batch,) scores out
+
+        if self.equipment_embeddings is None:
+            return tf.zeros(tf.shape(equipment_ids), dtype=tf.float32)
+
+        equipment_embeddings = self.equipment_embeddings(equipment_ids)
+
+        x = tf.concat([queries, equipment_embeddings], axis=-1)
+
+        return tf.squeeze(self.rankings(x), axis=-1)
+
+
+class RankerExport(tf.Module):
+    # Serving-only view of a RankingModel; keeps the Keras training
+    # machinery of EquipmentRankingModel out of the SavedModel
+
+    def __init__(self, ranking_model: RankingModel):
+        super().__init__()
+        self.ranking_model = ranking_model
+
+    @tf.function(input_signature=INFERENCE_SIGNATURE)
+    def serve(self, queries, equipment_ids):
+        return {"scores": self.ranking_model.score(queries, equipment_ids)}
@@ -0,0 +1,194 @@
+import os
+import pickle
+from typing import AbstractSet, Any, Dict, Optional, Sequence
+
+import numpy as np
+from typing_extensions import Protocol
+
+from interference.interface import Interface
+
+from ccdr.models.equipment import Equipment
+from ccdr.retrieval.vector_index import VectorIndex
+from ccdr.transformers.user_query_transformer import TypeTransformer
+
+
+class CandidateGenerator(Protocol):
+    # Whether it keeps the embeddings it is given; those that do are
+    # EmbeddingCandidateGenerators and give them back
+    stores_embeddings: bool
+
+    def add(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]) -> None:
+        ...
+
+    def update(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]) -> None:
+        ...
+
+    def remove(self, tag: str) -> None:
+        ...
+
+    def prepare(self, query: str) -> Any:
+        # The model work a query needs (its embedding), kept apart so it
+        # can run outside of the index locks
+        ...
+
+    def candidates_for(self, prepared: Any, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        # tags, when given, restricts the candidates to those equipments
+        ...
+
+    def candidates(self, query: str, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        ...
+
+    def state(self) -> Any:
+        # An in-memory copy of what save writes, taken under the index
+        # lock; None when there is nothing to save
+        ...
+
+    def save(self, state: Any, path: str) -> bool:
+        ...
+
+    def load(self, path: str) -> bool:
+        ...
+
+
+class EmbeddingCandidateGenerator(CandidateGenerator, Protocol):
+    # A candidate generator with stores_embeddings
+
+    def embeddings(self, tags: Sequence[str]) -> np.ndarray:
+        # The stored embeddings of the tags, row aligned
+        ...
+
+
+class ECMCandidateGenerator:
+    # Candidates are the scorings of the Interface's ECM processor
+
+    stores_embeddings = False
+
+    def __init__(self, interface: Interface):
+        self.interface = interface
+
+    def add(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]):
+        instance = self.interface.try_create_instance_from_value(
+            "equipment", equipment)
+
+        assert instance
+        self.interface.add(tag, instance)
+
+    def update(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]):
+        instance = self.interface.try_create_instance_from_value(
+            "equipment", equipment)
+
+        assert instance
+        self.interface.update(tag, instance)
+
+    def remove(self, tag: str):
+        self.interface.remove(tag)
+
+    def prepare(self, query: str):
+        instance = self.interface.try_create_instance_from_value(
+            "query_type", query)
+
+        assert instance
+        return instance
+
+    def candidates(self, query: str, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        return self.candidates_for(self.prepare(query), tags)
+
+    def candidates_for(self, prepared: Any, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        # NOTE: The processor cannot be restricted up front; the tags only
+        # filter its scorings
+        matches = self.interface.get_scorings_for(prepared)
+
+        return {
+            scoring.scored_tag: scoring.score
+            for scoring in matches
+            if scoring.scored_tag is not None and (tags is None or scoring.scored_tag in tags)
+        }
+
+    def state(self) -> Optional[bytes]:
+        processor = getattr(self.interface, "processor", None)
+
+        if processor is None:
+            return None
+
+        try:
+            return pickle.dumps(processor, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def save(self, state: Optional[bytes], path: str) -> bool:
+        if state is None:
+            return False
+
+        with open(os.path.join(path, "processor.pkl"), "wb") as f:
+            f.write(state)
+
+        return True
+
+    def load(self, path: str) -> bool:
+        processor_path = os.path.join(path, "processor.pkl")
+
+        if not hasattr(self.interface, "processor") or not os.path.exists(processor_path):
+            return False
+
+        with open(processor_path, "rb") as f:
+            self.interface.processor = pickle.load(f)
+
+        return True
+
+
+class VectorIndexCandidateGenerator:
+    # Candidates are the k equipments closest to the query embedding
+
+    stores_embeddings = True
+
+    def __init__(self, index: VectorIndex, query_transformer: TypeTransformer, k: int = 100):
+        self.index = index
+        self.query_transformer = query_transformer
+        self.k = k
+
+    def add(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]):
+        assert embedding is not None
+        self.index.add(tag, embedding)
+
+    def update(self, tag: str, equipment: Equipment, embedding: Optional[np.ndarray]):
+        self.add(tag, equipment, embedding)
+
+    def remove(self, tag: str):
+        self.index.remove(tag)
+
+    def prepare(self, query: str) -> np.ndarray:
+        return self.query_transformer.calculate_embedding(query)
+
+    def candidates(self, query: str, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        if tags is not None and not tags:
+            return {}
+
+        return self.candidates_for(self.prepare(query), tags)
+
+    def candidates_for(self, prepared: np.ndarray, tags: Optional[AbstractSet[str]] = None) -> Dict[str, float]:
+        rows = None if tags is None else self.index.rows_of(list(tags))
+
+        if rows is not None and len(rows) == 0:
+            return {}
+
+        return dict(self.index.search(prepared, self.k, rows))
+
+    def embeddings(self, tags: Sequence[str]) -> np.ndarray:
+        # NOTE: Normalized, and as lossy as the index storage
+        return self.index.vectors(self.index.rows_of(tags))
+
+    def state(self) -> VectorIndex:
+        return self.index.copy()
+
+    def save(self, state: VectorIndex, path: str) -> bool:
+        state.save(os.path.join(path, "vector_index"))
+        return True
+
+    def load(self, path: str) -> bool:
+        index_path = os.path.join(path, "vector_index")
+
+        if not os.path.isdir(index_path):
+            return False
+
+        self.index = type(self.index).load(index_path, **self.index.params())
+        return True
@@ -0,0 +1,223 @@
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from ccdr.models.equipment import Equipment
+
+EARTH_RADIUS_KM = 6371.0088
+
+# (min_lat, min_long, max_lat, max_long)
+BoundingBox = Tuple[float, float, float, float]
+# (lat, long, radius in km)
+Radius = Tuple[float, float, float]
+
+
+def haversine_km(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def radius_bounding_box(lat: float, long: float, radius_km: float) -> BoundingBox:
+    delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # NOTE: Clamped so the box stays finite close to the poles
+    delta_long = math.degrees(
+        radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+
+    return lat - delta_lat, long - delta_long, lat + delta_lat, long + delta_long
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    # Every given condition must hold; equipments without localizacao never
+    # match a bbox or radius
+    groups: Optional[Tuple[str, ...]] = None
+    areas: Optional[Tuple[str, ...]] = None
+    bbox: Optional[BoundingBox] = None
+    radius: Optional[Radius] = None
+
+    def is_empty(self):
+        return self.groups is None and self.areas is None and self.bbox is None and self.radius is None
+
+
+class SpatialGrid:
+    """Equipment locations bucketed in a grid of cell_degrees cells."""
+
+    def __init__(self, cell_degrees: float = 0.05):
+        self.cell_degrees = cell_degrees
+
+        self._cells: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+        self._locations: Dict[str, Tuple[float, float]] = {}
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _cell(self, lat: float, long: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(long / self.cell_degrees)
+
+    def add(self, tag: str, lat: float, long: float):
+        self.remove(tag)
+
+        self._locations[tag] = (lat, long)
+        self._cells[self._cell(lat, long)].add(tag)
+
+    def remove(self, tag: str):
+        location = self._locations.pop(tag, None)
+
+        if location is None:
+            return
+
+        cell = self._cell(*location)
+        self._cells[cell].discard(tag)
+
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def location(self, tag: str) -> Optional[Tuple[float, float]]:
+        return self._locations.get(tag)
+
+    def in_bounding_box(self, bbox: BoundingBox) -> Set[str]:
+        min_lat, min_long, max_lat, max_long = bbox
+
+        min_cell = self._cell(min_lat, min_long)
+        max_cell = self._cell(max_lat, max_long)
+        n_cells = (max_cell[0] - min_cell[0] + 1) * \
+            (max_cell[1] - min_cell[1] + 1)
+
+        # NOTE: Boxes spanning more cells than there are occupied ones are
+        # served by walking the occupied cells instead
+        if n_cells > len(self._cells):
+            cells: Iterable[Tuple[int, int]] = [
+                cell for cell in self._cells
+                if min_cell[0] <= cell[0] <= max_cell[0] and min_cell[1] <= cell[1] <= max_cell[1]
+            ]
+        else:
+            cells = [
+                (lat_cell, long_cell)
+                for lat_cell in range(min_cell[0], max_cell[0] + 1)
+                for long_cell in range(min_cell[1], max_cell[1] + 1)
+            ]
+
+        matches: Set[str] = set()
+
+        for cell in cells:
+            for tag in self._cells.get(cell, ()):
+                lat, long = self._locations[tag]
+
+                if min_lat <= lat <= max_lat and min_long <= long <= max_long:
+                    matches.add(tag)
+
+        return matches
+
+    def in_radius(self, lat: float, long: float, radius_km: float) -> Set[str]:
+        return {
+            tag for tag in self.in_bounding_box(radius_bounding_box(lat, long, radius_km))
+            if haversine_km(lat, long, *self._locations[tag]) <= radius_km
+        }
+
+
+class AttributeIndex:
+    """In-memory inverted indexes of the equipments' group and area, plus a
+    spatial grid of their localizacao, answering SearchFilters with the
+    set of matching tags."""
+
+    def __init__(self, cell_degrees: float = 0.05):
+        self.cell_degrees = cell_degrees
+        self.clear()
+
+    def clear(self):
+        self._groups: Dict[str, Set[str]] = defaultdict(set)
+        self._areas: Dict[str, Set[str]] = defaultdict(set)
+        self._attributes: Dict[str, Tuple[str, str]] = {}
+        self.grid = SpatialGrid(self.cell_degrees)
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def add(self, tag: str, equipment: Equipment):
+        localizacao = equipment.get("localizacao")
+
+        self.add_attributes(
+            tag,
+            equipment["group"],
+            equipment["area"],
+            None if localizacao is None else (
+                localizacao["lat"], localizacao["long"]),
+        )
+
+    def add_attributes(self, tag: str, group: str, area: str, location: Optional[Tuple[float, float]]):
+        self.remove(tag)
+
+        self._attributes[tag] = (group, area)
+        self._groups[group].add(tag)
+        self._areas[area].add(tag)
+
+        if location is not None:
+            self.grid.add(tag, *location)
+
+    def remove(self, tag: str):
+        attributes = self._attributes.pop(tag, None)
+
+        if attributes is None:
+            return
+
+        group, area = attributes
+        self._discard(self._groups, group, tag)
+        self._discard(self._areas, area, tag)
+        self.grid.remove(tag)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[str]], key: str, tag: str):
+        index[key].discard(tag)
+
+        if not index[key]:
+            del index[key]
+
+    def matching(self, search_filter: SearchFilter) -> Optional[Set[str]]:
+        # Tags matching every condition of the filter; None when the
+        # filter is empty (everything matches)
+        if search_filter.is_empty():
+            return None
+
+        # NOTE: The most selective sets go first so the intersections
+        # stay small
+        sets: List[Set[str]] = []
+
+        if search_filter.groups is not None:
+            sets.append(set().union(
+                *(self._groups.get(group, set()) for group in search_filter.groups)))
+
+        if search_filter.areas is not None:
+            sets.append(set().union(
+                *(self._areas.get(area, set()) for area in search_filter.areas)))
+
+        if search_filter.bbox is not None:
+            sets.append(self.grid.in_bounding_box(search_filter.bbox))
+
+        if search_filter.radius is not None:
+            sets.append(self.grid.in_radius(*search_filter.radius))
+
+        sets.sort(key=len)
+
+        matches = set(sets[0])
+        for other in sets[1:]:
+            matches.intersection_update(other)
+
+        return matches
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            tag: [group, area, self.grid.location(tag)]
+            for tag, (group, area) in self._attributes.items()
+        }
+
+    def restore_state(self, state: Dict[str, Any]):
+        self.clear()
+
+        for tag, (group, area, location) in state.items():
+            self.add_attributes(
+                tag, group, area, None if location is None else tuple(location))
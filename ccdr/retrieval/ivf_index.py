@@ -0,0 +1,267 @@
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ccdr.retrieval.vector_index import BruteForceIndex, normalize_rows
+
+logger = logging.getLogger('ivf_index')
+logger.setLevel(logging.INFO)
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    # Unit length centroids of normalized vectors, clustered by cosine
+    # similarity
+    rng = np.random.default_rng(seed)
+
+    centroids = vectors[rng.choice(
+        len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # NOTE: Empty clusters are reseeded from random vectors
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex(BruteForceIndex):
+    """Approximate cosine-similarity index with an inverted file.
+
+    The vectors live in the same matrix as BruteForceIndex; each row is
+    also assigned to its closest k-means centroid (its list) and a search
+    only scores the rows of the n_probe lists closest to the query, so
+    n_probe trades recall for latency. The rows are also kept grouped by
+    list, so a search gathers the rows of its lists without scanning the
+    list of every row; rows added since the grouping are scanned apart
+    and regrouped once they grow past regroup_ratio of it. Until there are min_train_size
+    vectors the index is not trained and searches are exact; it is
+    retrained whenever it grows retrain_growth times past the size it was
+    trained at.
+    """
+
+    ASSIGN_CHUNK_SIZE = 65536
+    REGROUP_RATIO = 0.1
+
+    def __init__(
+        self,
+        dim: Optional[int] = None,
+        n_lists: Optional[int] = None,
+        n_probe: int = 8,
+        min_train_size: int = 4096,
+        train_sample_per_list: int = 64,
+        kmeans_iterations: int = 10,
+        retrain_growth: float = 4.,
+        seed: int = 0,
+        **kwargs,
+    ):
+        super().__init__(dim=dim, **kwargs)
+
+        # Number of lists; sqrt of the size at training time if None
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.train_sample_per_list = train_sample_per_list
+        self.kmeans_iterations = kmeans_iterations
+        self.retrain_growth = retrain_growth
+        self.seed = seed
+
+        self._centroids: Optional[np.ndarray] = None
+        self._lists = np.zeros((0,), dtype=np.int32)
+        self._trained_size = 0
+
+        # The first _grouped_size rows sorted by list: the rows of list i
+        # are _list_rows[_list_offsets[i]:_list_offsets[i + 1]]
+        self._list_rows = np.zeros((0,), dtype=np.int64)
+        self._list_offsets = np.zeros((1,), dtype=np.int64)
+        self._grouped_size = 0
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            **super().params(),
+            "n_lists": self.n_lists,
+            "n_probe": self.n_probe,
+            "min_train_size": self.min_train_size,
+            "train_sample_per_list": self.train_sample_per_list,
+            "kmeans_iterations": self.kmeans_iterations,
+            "retrain_growth": self.retrain_growth,
+            "seed": self.seed,
+        }
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    def _reserve(self, rows: int):
+        super()._reserve(rows)
+
+        capacity = self._vectors.shape[0]
+        if self._lists.shape[0] < capacity:
+            lists = np.full((capacity,), -1, dtype=np.int32)
+            lists[:self._size] = self._lists[:self._size]
+            self._lists = lists
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        # Closest centroid of each row, dequantized a chunk at a time
+        assert self._centroids is not None
+
+        return np.concatenate([
+            np.argmax(self.vectors(rows[start:start + self.ASSIGN_CHUNK_SIZE]) @ self._centroids.T, axis=1)
+            for start in range(0, len(rows), self.ASSIGN_CHUNK_SIZE)
+        ] or [np.empty((0,), dtype=np.int64)]).astype(np.int32)
+
+    def add_many(self, tags: Sequence[str], vectors: np.ndarray):
+        super().add_many(tags, vectors)
+
+        if len(tags) == 0:
+            return
+
+        rows = self.rows_of(tags)
+        self._lists[rows] = self._assign(rows) if self.is_trained else -1
+
+        if len(self) >= max(self.min_train_size, self._trained_size * self.retrain_growth):
+            self.train()
+        elif self.is_trained and (
+            # NOTE: Grouped before their lists were assigned, when adding
+            # them compacted the index
+            rows.min() < self._grouped_size
+            or self._size - self._grouped_size > self._grouped_size * self.REGROUP_RATIO
+        ):
+            self._group_rows()
+
+    def _group_rows(self):
+        # NOTE: Only from writers; searches read the grouping unlocked
+        assert self._centroids is not None
+
+        lists = self._lists[:self._size]
+        counts = np.bincount(lists[lists >= 0], minlength=len(self._centroids))
+        # Rows without a list sort first and belong to none
+        unassigned = len(lists) - counts.sum()
+
+        self._list_rows = np.argsort(lists, kind="stable")
+        self._list_offsets = unassigned + \
+            np.concatenate([[0], np.cumsum(counts)])
+        self._grouped_size = self._size
+
+    def _probed_rows(self, probed: np.ndarray) -> np.ndarray:
+        grouped = [
+            self._list_rows[self._list_offsets[probe]:self._list_offsets[probe + 1]]
+            for probe in probed
+        ]
+
+        added = np.arange(self._grouped_size, self._size)
+        added = added[np.isin(self._lists[added], probed)]
+
+        return np.sort(np.concatenate(grouped + [added]))
+
+    def compact(self):
+        alive = np.flatnonzero(~self._deleted[:self._size])
+        lists = self._lists[alive]
+
+        super().compact()
+
+        self._lists = lists
+
+        # NOTE: The rows were renumbered
+        self._grouped_size = 0
+        if self.is_trained:
+            self._group_rows()
+
+    def train(self):
+        # Runs k-means over a sample of the vectors and reassigns every
+        # row to its closest centroid
+        start = time.perf_counter()
+
+        alive = np.flatnonzero(~self._deleted[:self._size])
+        n_lists = self.n_lists or max(1, int(math.sqrt(len(alive))))
+        n_lists = min(n_lists, len(alive))
+
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(alive), n_lists * self.train_sample_per_list)
+        sample = self.vectors(np.sort(
+            rng.choice(alive, sample_size, replace=False)))
+
+        self._centroids = spherical_kmeans(
+            sample, n_lists, self.kmeans_iterations, self.seed)
+        self._lists[:self._size] = self._assign(np.arange(self._size))
+        self._trained_size = len(alive)
+        self._group_rows()
+
+        logger.info("Trained %d lists over %d vectors in %.1fs",
+                    n_lists, len(alive), time.perf_counter() - start)
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        # NOTE: Restricted searches over few rows (a filtered query) are
+        # exact; probing could only lose their results
+        if not self.is_trained or len(self) == 0 or (rows is not None and len(rows) <= self.min_train_size):
+            return super().search(query, k, rows)
+
+        assert self._centroids is not None
+
+        query = normalize_rows(np.asarray(query).reshape(-1))
+
+        n_probe = max(1, min(self.n_probe, len(self._centroids)))
+        probed = np.argpartition(-(self._centroids @ query),
+                                 n_probe - 1)[:n_probe]
+
+        if rows is None:
+            rows = self._probed_rows(probed)
+        else:
+            rows = rows[np.isin(self._lists[rows], probed)]
+
+        return super().search(query, k, rows)
+
+    def copy(self) -> "IVFIndex":
+        alive = np.flatnonzero(~self._deleted[:self._size])
+
+        index = super().copy()
+        index._lists = self._lists[alive]
+        index._centroids = None if self._centroids is None else self._centroids.copy()
+        index._trained_size = self._trained_size
+
+        if index.is_trained:
+            index._group_rows()
+
+        return index
+
+    def save(self, path: str):
+        super().save(path)
+
+        alive = np.flatnonzero(~self._deleted[:self._size])
+
+        np.save(os.path.join(path, "lists.npy"), self._lists[alive])
+        if self._centroids is not None:
+            np.save(os.path.join(path, "centroids.npy"), self._centroids)
+
+        with open(os.path.join(path, "ivf.json"), "w") as f:
+            json.dump({"trained_size": self._trained_size}, f)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "IVFIndex":
+        index = super().load(path, **kwargs)
+
+        index._lists = np.load(os.path.join(path, "lists.npy"))
+
+        centroids_path = os.path.join(path, "centroids.npy")
+        if os.path.exists(centroids_path):
+            index._centroids = np.load(centroids_path)
+
+        with open(os.path.join(path, "ivf.json"), "r") as f:
+            index._trained_size = json.load(f)["trained_size"]
+
+        if index.is_trained:
+            index._group_rows()
+
+        return index
@@ -0,0 +1,53 @@
+import threading
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from ccdr.utils.top_k import top_k_indexes
+
+
+class RankedResults:
+    """The scored tags of one query, sorted lazily.
+
+    Only the prefix that was asked for is ever sorted: the first page costs
+    a partial selection over the scores and each later page extends the
+    sorted prefix with the next best of what is left.
+    """
+
+    def __init__(self, tags: Sequence[str], scores: Sequence[float]):
+        self._tags = list(tags)
+        self._scores = np.asarray(scores, dtype=np.float64)
+
+        self._order = np.empty((0,), dtype=np.int64)
+        self._rest = np.arange(len(self._tags))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _sort_until(self, end: int):
+        if end <= len(self._order) or len(self._rest) == 0:
+            return
+
+        best = top_k_indexes(self._scores[self._rest], end - len(self._order))
+
+        self._order = np.concatenate([self._order, self._rest[best]])
+        self._rest = np.delete(self._rest, best)
+
+    def page(self, offset: int, count: int) -> List[Tuple[str, float]]:
+        # count <= 0 means everything past offset
+        end = len(self) if count <= 0 else min(offset + count, len(self))
+
+        with self._lock:
+            self._sort_until(end)
+            rows = self._order[offset:end]
+
+        return [(self._tags[row], float(self._scores[row])) for row in rows]
+
+    def iter_pages(self, offset: int, page_size: int, end: int) -> Iterator[List[Tuple[str, float]]]:
+        # Pages of page_size results from offset up to end, each sorted
+        # only when it is reached
+        end = min(end, len(self))
+
+        for start in range(offset, end, page_size):
+            yield self.page(start, min(page_size, end - start))
@@ -0,0 +1,323 @@
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from typing_extensions import Protocol
+
+from ccdr.utils.top_k import top_k_indexes
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+
+STORAGE_DTYPES = {
+    FLOAT32: np.dtype(np.float32),
+    FLOAT16: np.dtype(np.float16),
+    INT8: np.dtype(np.int8),
+}
+
+
+def quantize(vectors: np.ndarray, storage: str) -> Tuple[np.ndarray, np.ndarray]:
+    # Rows in the storage dtype and the per row scale they are multiplied
+    # by when dequantized; int8 rows are scaled so their largest component
+    # maps to 127
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    if storage != INT8:
+        return vectors.astype(STORAGE_DTYPES[storage]), np.ones((len(vectors),), dtype=np.float32)
+
+    scales = np.abs(vectors).max(axis=1) / 127.
+    scales[scales == 0] = 1.
+
+    codes = np.rint(vectors / scales[:, np.newaxis]).clip(-127, 127)
+
+    return codes.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, np.newaxis]
+
+
+class VectorIndex(Protocol):
+
+    def __len__(self) -> int:
+        ...
+
+    def add(self, tag: str, vector: np.ndarray) -> None:
+        ...
+
+    def remove(self, tag: str) -> None:
+        ...
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        ...
+
+    def rows_of(self, tags: Sequence[str]) -> np.ndarray:
+        ...
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        ...
+
+    def copy(self) -> "VectorIndex":
+        ...
+
+    def save(self, path: str) -> None:
+        ...
+
+    def params(self) -> Dict[str, Any]:
+        ...
+
+
+class BruteForceIndex:
+    """Exact cosine-similarity index over a contiguous matrix.
+
+    Rows are appended in place (the matrix grows by doubling); removed rows
+    are only marked in a tombstone bitmap until enough of them pile up and
+    the matrix is compacted.
+
+    The matrix is float32 by default; with float16 or int8 storage (int8
+    rows carry their own scale) it takes a half or a quarter of the
+    memory, and queries are scored block by block, converting one block
+    of rows to float32 at a time.
+    """
+
+    SCORE_BLOCK_ROWS = 16384
+
+    def __init__(
+        self,
+        dim: Optional[int] = None,
+        initial_capacity: int = 1024,
+        compact_ratio: float = 0.25,
+        storage: str = FLOAT32,
+    ):
+        assert storage in STORAGE_DTYPES
+
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self.compact_ratio = compact_ratio
+        self.storage = storage
+
+        self._vectors = np.zeros(
+            (0, dim or 0), dtype=STORAGE_DTYPES[storage])
+        self._scales = np.zeros((0,), dtype=np.float32)
+        self._deleted = np.zeros((0,), dtype=bool)
+        self._tags: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._size = 0
+        self._tombstones = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def params(self) -> Dict[str, Any]:
+        # Constructor arguments, other than dim, to load a saved index with
+        return {
+            "initial_capacity": self.initial_capacity,
+            "compact_ratio": self.compact_ratio,
+            "storage": self.storage,
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes + self._scales.nbytes
+
+    def __contains__(self, tag: str):
+        return tag in self._rows
+
+    def _reserve(self, rows: int):
+        needed = self._size + rows
+        capacity = self._vectors.shape[0]
+
+        if needed <= capacity:
+            return
+
+        new_capacity = max(needed, capacity * 2, self.initial_capacity)
+
+        vectors = np.zeros((new_capacity, self.dim),
+                           dtype=STORAGE_DTYPES[self.storage])
+        vectors[:self._size] = self._vectors[:self._size]
+
+        scales = np.zeros((new_capacity,), dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+
+        deleted = np.zeros((new_capacity,), dtype=bool)
+        deleted[:self._size] = self._deleted[:self._size]
+
+        self._vectors = vectors
+        self._scales = scales
+        self._deleted = deleted
+
+    def add(self, tag: str, vector: np.ndarray):
+        self.add_many([tag], np.asarray(vector)[np.newaxis])
+
+    def add_many(self, tags: Sequence[str], vectors: np.ndarray):
+        if len(tags) == 0:
+            return
+
+        vectors = normalize_rows(np.asarray(vectors).reshape(len(tags), -1))
+
+        # NOTE: A tag given more than once keeps its last vector only
+        last = {tag: position for position, tag in enumerate(tags)}
+        if len(last) < len(tags):
+            positions = sorted(last.values())
+            tags = [tags[position] for position in positions]
+            vectors = vectors[positions]
+
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._vectors = self._vectors.reshape(0, self.dim)
+
+        assert vectors.shape[1] == self.dim
+
+        for tag in tags:
+            if tag in self._rows:
+                self._delete_row(self._rows.pop(tag))
+
+        self._reserve(len(tags))
+
+        codes, scales = quantize(vectors, self.storage)
+
+        start = self._size
+        self._vectors[start:start + len(tags)] = codes
+        self._scales[start:start + len(tags)] = scales
+        self._deleted[start:start + len(tags)] = False
+
+        for offset, tag in enumerate(tags):
+            self._tags.append(tag)
+            self._rows[tag] = start + offset
+
+        self._size += len(tags)
+        self._maybe_compact()
+
+    def remove(self, tag: str):
+        row = self._rows.pop(tag, None)
+
+        if row is None:
+            return
+
+        self._delete_row(row)
+        self._maybe_compact()
+
+    def _delete_row(self, row: int):
+        self._deleted[row] = True
+        self._tags[row] = None
+        self._tombstones += 1
+
+    def _maybe_compact(self):
+        if self._size > 0 and self._tombstones / self._size > self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        alive = np.flatnonzero(~self._deleted[:self._size])
+
+        self._vectors = np.ascontiguousarray(self._vectors[alive])
+        self._scales = self._scales[alive]
+        self._deleted = np.zeros((len(alive),), dtype=bool)
+        self._tags = [self._tags[row] for row in alive]
+        self._rows = {tag: row for row, tag in enumerate(self._tags)}
+        self._size = len(alive)
+        self._tombstones = 0
+
+    def rows_of(self, tags: Sequence[str]) -> np.ndarray:
+        return np.array([self._rows[tag] for tag in tags if tag in self._rows], dtype=np.int64)
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        # The given rows as float32
+        return dequantize(self._vectors[rows], self._scales[rows])
+
+    def _score(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        codes = self._vectors[:self._size] if rows is None else self._vectors[rows]
+        scales = self._scales[:self._size] if rows is None else self._scales[rows]
+
+        if self.storage == FLOAT32:
+            return (codes @ query) * scales
+
+        # NOTE: The per row scale factors out of the dot product, so int8
+        # blocks are only cast, never multiplied by their scales
+        scores = np.empty((len(codes),), dtype=np.float32)
+        for start in range(0, len(codes), self.SCORE_BLOCK_ROWS):
+            block = codes[start:start + self.SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+
+        return scores * scales
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        # Top k tags by cosine similarity; rows restricts the search to
+        # those rows of the matrix
+        if len(self._rows) == 0:
+            return []
+
+        query = normalize_rows(np.asarray(query).reshape(-1))
+
+        scores = self._score(query, rows)
+
+        if rows is None:
+            rows = np.arange(self._size)
+
+        scores[self._deleted[rows]] = -np.inf
+
+        return [
+            (self._tags[rows[position]], float(scores[position]))
+            for position in top_k_indexes(scores, k)
+            if not self._deleted[rows[position]]
+        ]
+
+    def copy(self) -> "BruteForceIndex":
+        # A compacted copy of the live rows, sharing no array with this
+        # index, so it can be saved while this one keeps changing
+        alive = np.flatnonzero(~self._deleted[:self._size])
+
+        index = type(self)(dim=self.dim, **self.params())
+        index._vectors = self._vectors[alive]
+        index._scales = self._scales[alive]
+        index._deleted = np.zeros((len(alive),), dtype=bool)
+        index._tags = [self._tags[row] for row in alive]
+        index._rows = {tag: row for row, tag in enumerate(index._tags)}
+        index._size = len(alive)
+
+        return index
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        alive = np.flatnonzero(~self._deleted[:self._size])
+
+        np.save(os.path.join(path, "vectors.npy"), self._vectors[alive])
+        np.save(os.path.join(path, "scales.npy"), self._scales[alive])
+        np.save(os.path.join(path, "tags.npy"),
+                np.array([self._tags[row] for row in alive], dtype=str))
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "BruteForceIndex":
+        # NOTE: Copy-on-write memory map; pages are only copied once this
+        # process appends to or compacts the index
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="c")
+        tags = [str(tag) for tag in np.load(os.path.join(path, "tags.npy"))]
+
+        scales_path = os.path.join(path, "scales.npy")
+        scales = np.load(scales_path) if os.path.exists(
+            scales_path) else np.ones((len(tags),), dtype=np.float32)
+
+        # NOTE: An index saved before its first vector has no dim yet
+        index = cls(dim=vectors.shape[1] or None, **kwargs)
+
+        if vectors.dtype != STORAGE_DTYPES[index.storage]:
+            # Saved with another storage
+            vectors, scales = quantize(
+                dequantize(vectors, scales), index.storage)
+
+        index._vectors = vectors
+        index._scales = scales
+        index._deleted = np.zeros((len(tags),), dtype=bool)
+        index._tags = list(tags)
+        index._rows = {tag: row for row, tag in enumerate(tags)}
+        index._size = len(tags)
+
+        return index
@@ -1,13 +1,20 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from ccdr.models.infrastructure import CommunicationDetails, EnergyDetails, GasDetails, InternetDetails, LightDetails, MailDetails, TVDetails, TelephoneDetails
-from typing import Any, Callable, Optional, TypeVar, Dict, List, cast
+from typing import Any, Callable, Optional, Sequence, TypeVar, Dict, List, cast
 from interference.transformers.transformer_pipeline import TransformerPipeline, Instance
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
 from ccdr.models.equipment import CulturalDetails, Equipment, InstalacaoApoio, Localizacao, Organizacao, SportDetails, SocialDetails, EducationDetails, GeneralHealthDetails, HospitalHealthDetails, Unidade, HealthDetails
 
 from ccdr.utils.string import stringuify_value_func_guard_none, tuple_dict_list_to_string
+from ccdr.utils.embedding_store import EmbeddingStore
+from ccdr.transformers.model_registry import ModelRegistry, default_registry
+
+import logging
+
+logger = logging.getLogger('equipment_transformer')
 
 
 def stringuify(equipment: Equipment):
@@ -386,9 +393,90 @@ def stringuify_tv(details: TVDetails):
 
 class EquipmentTypeTransformer(TransformerPipeline[Equipment]):
 
-    def __init__(self, modelname: str = 'neuralmind/bert-large-portuguese-cased'):
-        self.model = SentenceTransformer(modelname)
+    def __init__(
+        self,
+        modelname: str = 'neuralmind/bert-large-portuguese-cased',
+        encode_batch_size: int = 32,
+        embedding_store: Optional[EmbeddingStore] = None,
+        registry: Optional[ModelRegistry] = None,
+    ):
+        self.modelname = modelname
+        self.registry = registry or default_registry
+        self.encode_batch_size = encode_batch_size
+        self.embedding_store = embedding_store
+
+        self._precomputed: Dict[str, np.ndarray] = {}
+
+    @property
+    def model(self):
+        return self.registry.sentence_transformer(self.modelname)
+
+    def _encode_texts(self, texts: Sequence[str]) -> List[np.ndarray]:
+        unique = list(dict.fromkeys(texts))
+        by_text: Dict[str, np.ndarray] = {}
+
+        if self.embedding_store is not None:
+            stored = self.embedding_store.get_many(unique)
+            by_text.update(
+                (text, embedding)
+                for text, embedding in zip(unique, stored)
+                if embedding is not None
+            )
+
+        missing = [text for text in unique if text not in by_text]
+
+        if missing:
+            encoded = self.model.encode(
+                missing, batch_size=self.encode_batch_size)
+            by_text.update(zip(missing, encoded))
+
+            if self.embedding_store is not None:
+                self.embedding_store.put_many(missing, encoded)
+
+        return [by_text[text] for text in texts]
+
+    def calculate_embeddings(self, equipments: Sequence[Equipment]) -> List[np.ndarray]:
+        return self._encode_texts([stringuify(equipment) for equipment in equipments])
+
+    @contextmanager
+    def precomputed(self, equipments: Sequence[Equipment], embeddings: Optional[Sequence[np.ndarray]] = None):
+        # NOTE: The Interface only knows how to create instances one value
+        # at a time, through calculate_embedding; we encode the whole batch
+        # up front (unless given) and serve it from here while the
+        # instances are created
+        if embeddings is None:
+            embeddings = self.calculate_embeddings(equipments)
+
+        for equipment, embedding in zip(equipments, embeddings):
+            self._precomputed[stringuify(equipment)] = embedding
+
+        try:
+            yield embeddings
+        finally:
+            self._precomputed.clear()
 
     def calculate_embedding(self, equipment: Equipment):
         stringuified = stringuify(equipment)
-        return self.model.encode(stringuified)
+
+        precomputed = self._precomputed.get(stringuified)
+        if precomputed is not None:
+            return precomputed
+
+        return self._encode_texts([stringuified])[0]
+
+    def keep_embeddings(self, equipments: Sequence[Equipment]):
+        # The stored embeddings of these equipments survive compaction
+        # even though they were not encoded again
+        if self.embedding_store is not None:
+            self.embedding_store.touch_many(
+                [stringuify(equipment) for equipment in equipments])
+
+    def persist_embeddings(self, compact: bool = False):
+        if self.embedding_store is None:
+            return
+
+        if compact:
+            evicted = self.embedding_store.compact()
+            logger.info("Evicted %d stale embeddings from the store", evicted)
+        else:
+            self.embedding_store.flush()
@@ -0,0 +1,115 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+import logging
+
+logger = logging.getLogger('model_registry')
+logger.setLevel(logging.INFO)
+
+
+# NOTE: The heavy libraries are imported by the loaders themselves so that
+# importing this module (and everything holding a registry) stays cheap
+
+def _load_sentence_transformer(name: str):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+def _load_tokenizer(name: str):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name)
+
+
+def _load_tf_bert_model(name: str):
+    from transformers import TFBertModel
+    return TFBertModel.from_pretrained(name, from_pt=True)
+
+
+def _model_nbytes(model: Any) -> int:
+    # torch modules (SentenceTransformer)
+    if hasattr(model, "parameters") and callable(model.parameters):
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+
+    # keras models (TFBertModel)
+    if hasattr(model, "weights"):
+        return sum(int(w.shape.num_elements()) * w.dtype.size for w in model.weights)
+
+    return 0
+
+
+@dataclass
+class LoadedModel:
+    kind: str
+    name: str
+    model: Any
+    load_seconds: float
+    nbytes: int
+
+
+class ModelRegistry:
+
+    SENTENCE_TRANSFORMER = "sentence_transformer"
+    TOKENIZER = "tokenizer"
+    TF_BERT_MODEL = "tf_bert_model"
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[str], Any]] = {
+            self.SENTENCE_TRANSFORMER: _load_sentence_transformer,
+            self.TOKENIZER: _load_tokenizer,
+            self.TF_BERT_MODEL: _load_tf_bert_model,
+        }
+        self._models: Dict[Tuple[str, str], LoadedModel] = {}
+        self._lock = threading.Lock()
+
+    def register_loader(self, kind: str, loader: Callable[[str], Any]):
+        self._loaders[kind] = loader
+
+    def get(self, kind: str, name: str) -> Any:
+        loaded = self._models.get((kind, name))
+        if loaded is not None:
+            return loaded.model
+
+        with self._lock:
+            loaded = self._models.get((kind, name))
+            if loaded is not None:
+                return loaded.model
+
+            start = time.perf_counter()
+            model = self._loaders[kind](name)
+            elapsed = time.perf_counter() - start
+
+            loaded = LoadedModel(kind, name, model, elapsed, _model_nbytes(model))
+            self._models[(kind, name)] = loaded
+
+            logger.info("Loaded %s %s in %.1fs (%.1f MB)",
+                        kind, name, elapsed, loaded.nbytes / 2**20)
+
+            return model
+
+    def is_loaded(self, kind: str, name: str) -> bool:
+        return (kind, name) in self._models
+
+    def sentence_transformer(self, name: str):
+        return self.get(self.SENTENCE_TRANSFORMER, name)
+
+    def tokenizer(self, name: str):
+        return self.get(self.TOKENIZER, name)
+
+    def tf_bert_model(self, name: str):
+        return self.get(self.TF_BERT_MODEL, name)
+
+    def report(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "kind": loaded.kind,
+                "name": loaded.name,
+                "load_seconds": loaded.load_seconds,
+                "nbytes": loaded.nbytes,
+            }
+            for loaded in list(self._models.values())
+        ]
+
+
+default_registry = ModelRegistry()
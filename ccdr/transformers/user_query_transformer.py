@@ -1,15 +1,46 @@
+from typing import List, Optional
+
 from interference.transformers.transformer_pipeline import TransformerPipeline, Instance
 
-from sentence_transformers import SentenceTransformer
+from ccdr.transformers.model_registry import ModelRegistry, default_registry
+from ccdr.utils.micro_batcher import MicroBatcher
+from ccdr.utils.query_cache import QueryEmbeddingCache
 
 
 class TypeTransformer(TransformerPipeline[str]):
 
     def __init__(
         self,
-        modelname: str = 'neuralmind/bert-large-portuguese-cased'
+        modelname: str = 'neuralmind/bert-large-portuguese-cased',
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        registry: Optional[ModelRegistry] = None,
+        max_batch: int = 1,
+        max_wait: float = 0.005,
     ):
-        self.model = SentenceTransformer(modelname)
+        self.modelname = modelname
+        self.registry = registry or default_registry
+        self.query_cache = query_cache
+
+        # NOTE: Concurrent queries are encoded together when max_batch > 1
+        self.batcher = None if max_batch <= 1 else MicroBatcher(
+            self._encode_batch, max_batch, max_wait, name="query-encoder")
+
+    @property
+    def model(self):
+        return self.registry.sentence_transformer(self.modelname)
+
+    def _encode(self, query: str):
+        if self.batcher is None:
+            return self.model.encode(query)
+
+        return self.batcher.submit(query)
+
+    def _encode_batch(self, queries: List[str]):
+        return list(self.model.encode(queries, batch_size=len(queries)))
 
     def calculate_embedding(self, query: str):
-        return self.model.encode(query)
+        if self.query_cache is None:
+            return self._encode(query)
+
+        return self.query_cache.get_or_compute(
+            query, QueryEmbeddingCache.ECM, self._encode)
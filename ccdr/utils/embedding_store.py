@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+
+logger = logging.getLogger('embedding_store')
+logger.setLevel(logging.INFO)
+
+
+class EmbeddingStore:
+    """On-disk embedding cache.
+
+    Embeddings live in a memory-mapped float32 matrix, one row per entry;
+    a small json index maps the hash of (model name, text) to its row.
+    A store written for another model is emptied when opened. Entries not
+    read, written or touched since the store was opened can be dropped
+    with compact().
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, path: str, model_name: str, flush_every: int = 256):
+        self.path = path
+        self.model_name = model_name
+        self.flush_every = flush_every
+
+        self._lock = threading.RLock()
+
+        self._rows: Dict[str, int] = {}
+        self._used: Set[str] = set()
+        self._count = 0
+        self._dim: Optional[int] = None
+        self._generation = 0
+        self._matrix: Optional[np.memmap] = None
+        self._dirty = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, text: str):
+        return self.key(text) in self._rows
+
+    def unused_count(self) -> int:
+        # Entries compact() would drop now
+        with self._lock:
+            return sum(1 for key in self._rows if key not in self._used)
+
+    def _data_file(self, generation: int):
+        return os.path.join(self.path, f"embeddings-{generation}.f32")
+
+    def _load(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+
+        if not os.path.exists(index_path):
+            return
+
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        if index.get("model_name") != self.model_name:
+            # NOTE: Nothing in it can be served and its rows may not even
+            # have this model's dim; the next generation starts empty
+            logger.info("Emptying %s: written for %s, not %s",
+                        self.path, index.get("model_name"), self.model_name)
+
+            data_file = self._data_file(index["generation"])
+            if os.path.exists(data_file):
+                os.remove(data_file)
+
+            os.remove(index_path)
+
+            self._generation = index["generation"] + 1
+            return
+
+        self._dim = index["dim"]
+        self._count = index["count"]
+        self._generation = index["generation"]
+        self._rows = index["rows"]
+
+        if self._dim is not None and self._count > 0:
+            self._matrix = self._open_matrix(self._generation, self._count)
+
+    def _open_matrix(self, generation: int, capacity: int) -> np.memmap:
+        assert self._dim is not None
+
+        data_file = self._data_file(generation)
+        size = capacity * self._dim * np.dtype(np.float32).itemsize
+
+        if not os.path.exists(data_file) or os.path.getsize(data_file) < size:
+            with open(data_file, "ab") as f:
+                f.truncate(size)
+
+        return np.memmap(data_file, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+
+    def _reserve(self, rows: int):
+        needed = self._count + rows
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+
+        if needed <= capacity:
+            return
+
+        new_capacity = max(needed, capacity * 2, 1024)
+
+        if self._matrix is not None:
+            self._matrix.flush()
+            del self._matrix
+
+        self._matrix = self._open_matrix(self._generation, new_capacity)
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            found: List[Optional[np.ndarray]] = []
+
+            for text in texts:
+                key = self.key(text)
+                row = self._rows.get(key)
+
+                if row is None or self._matrix is None:
+                    found.append(None)
+                    continue
+
+                self._used.add(key)
+                found.append(np.array(self._matrix[row]))
+
+            return found
+
+    def touch_many(self, texts: Sequence[str]):
+        # Marks the stored texts as still in use, so compact() keeps them
+        with self._lock:
+            for text in texts:
+                key = self.key(text)
+
+                if key in self._rows:
+                    self._used.add(key)
+
+    def put(self, text: str, embedding: np.ndarray):
+        self.put_many([text], [embedding])
+
+    def put_many(self, texts: Sequence[str], embeddings: Iterable[np.ndarray]):
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+                if self._dim is None:
+                    self._dim = embedding.shape[0]
+
+                assert embedding.shape[0] == self._dim
+
+                key = self.key(text)
+                row = self._rows.get(key)
+
+                if row is None:
+                    self._reserve(1)
+                    row = self._count
+                    self._count += 1
+                    self._rows[key] = row
+
+                assert self._matrix is not None
+                self._matrix[row] = embedding
+                self._used.add(key)
+                self._dirty += 1
+
+            if self._dirty >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+
+            self._write_index()
+            self._dirty = 0
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "model_name": self.model_name,
+                "dim": self._dim,
+                "count": self._count,
+                "generation": self._generation,
+                "rows": self._rows,
+            }, f)
+
+        os.replace(tmp_path, index_path)
+
+    def compact(self) -> int:
+        """Drops every entry that was not used since the store was opened."""
+
+        with self._lock:
+            stale = [key for key in self._rows if key not in self._used]
+
+            if not stale or self._matrix is None:
+                self.flush()
+                return 0
+
+            kept = [(key, row) for key, row in self._rows.items()
+                    if key in self._used]
+
+            old_generation = self._generation
+            old_matrix = self._matrix
+
+            self._generation += 1
+            matrix = self._open_matrix(self._generation, max(len(kept), 1))
+
+            rows: Dict[str, int] = {}
+            for new_row, (key, old_row) in enumerate(kept):
+                matrix[new_row] = old_matrix[old_row]
+                rows[key] = new_row
+
+            matrix.flush()
+            del old_matrix
+
+            self._matrix = matrix
+            self._rows = rows
+            self._count = len(kept)
+
+            # NOTE: The index points at the new data file only once it is
+            # replaced, so a crash here leaves the old generation readable
+            self._write_index()
+            self._dirty = 0
+
+            os.remove(self._data_file(old_generation))
+
+            return len(stale)
@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+logger = logging.getLogger('micro_batcher')
+logger.setLevel(logging.INFO)
+
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class MicroBatcher(Generic[K, V]):
+    """Coalesces concurrent single-item calls into batched ones.
+
+    submit() blocks its caller until a worker thread has run the item
+    through compute_batch. The worker takes the first waiting item, then
+    whatever else arrives within max_wait seconds of it (or until
+    max_batch items), so concurrent requests share one model pass instead
+    of each running a batch of one. Equal items in a batch are computed
+    once.
+
+    Recent batch sizes and queueing delays (submit to batch start) are
+    kept for stats().
+    """
+
+    def __init__(
+        self,
+        compute_batch: Callable[[List[K]], Sequence[V]],
+        max_batch: int = 16,
+        max_wait: float = 0.005,
+        name: str = "micro-batcher",
+        window: int = 1024,
+    ):
+        self.compute_batch = compute_batch
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self.name = name
+
+        self._queue: "queue.Queue[Tuple[K, Future, float]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self._batch_sizes: Deque[int] = deque(maxlen=window)
+        self._delays: Deque[float] = deque(maxlen=window)
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                thread.start()
+                self._thread = thread
+
+    def submit(self, item: K) -> V:
+        self._ensure_started()
+
+        future: Future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+
+        return future.result()
+
+    def _collect(self) -> List[Tuple[K, Future, float]]:
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        # NOTE: Nothing a batch raises may end this thread, or every later
+        # submit() would wait forever
+        while True:
+            batch = self._collect()
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.exception("Batch of %d failed", len(batch))
+
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, batch: List[Tuple[K, Future, float]]):
+        started = time.perf_counter()
+
+        unique = list(dict.fromkeys(item for item, _, _ in batch))
+
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+            self._batch_sizes.append(len(unique))
+            self._delays.extend(started - submitted for _, _, submitted in batch)
+
+        results = list(self.compute_batch(unique))
+
+        if len(results) != len(unique):
+            raise ValueError(
+                f"{self.name}: {len(results)} results for a batch of {len(unique)}")
+
+        values = dict(zip(unique, results))
+
+        for item, future, _ in batch:
+            future.set_result(values[item])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sizes = np.array(self._batch_sizes, dtype=np.float64)
+            delays = np.array(self._delays, dtype=np.float64) * 1000
+
+        if len(sizes) == 0:
+            return {"batches": 0, "items": 0}
+
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "batch_size_mean": float(sizes.mean()),
+            "batch_size_max": int(sizes.max()),
+            "queue_delay_ms_p50": float(np.percentile(delays, 50)),
+            "queue_delay_ms_p99": float(np.percentile(delays, 99)),
+        }
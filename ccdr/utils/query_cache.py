@@ -0,0 +1,109 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, TypeVar
+
+
+T = TypeVar('T')
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+@dataclass
+class _Entry:
+    created_at: float
+    vectors: Dict[str, Any] = field(default_factory=dict)
+
+
+class QueryEmbeddingCache:
+    """Bounded, thread-safe LRU of query embeddings.
+
+    Each normalized query keeps one vector per slot, so the ECM lookup and
+    the ranker share an entry (and its TTL) for the same query text.
+    """
+
+    ECM = "ecm"
+    RANKER = "ranker"
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 3600.,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _lookup(self, key: str, slot: str):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        if self.clock() - entry.created_at > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return entry.vectors.get(slot)
+
+    def get_or_compute(self, query: str, slot: str, compute: Callable[[str], T]) -> T:
+        key = normalize_query(query)
+
+        with self._lock:
+            found = self._lookup(key, slot)
+
+            if found is not None:
+                self.hits += 1
+                return found
+
+            self.misses += 1
+
+        # NOTE: The model runs outside of the lock; two threads missing the
+        # same query at once both compute it and the last one wins
+        value = compute(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                entry = _Entry(created_at=self.clock())
+                self._entries[key] = entry
+
+            entry.vectors[slot] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,60 @@
+import logging
+import os
+from typing import Optional, Sequence
+
+logger = logging.getLogger('threads')
+logger.setLevel(logging.INFO)
+
+
+def limit_threads(
+    intra_op: Optional[int] = None,
+    inter_op: Optional[int] = None,
+    cpus: Optional[Sequence[int]] = None,
+):
+    """Caps the CPU this process uses for model work.
+
+    intra_op and inter_op bound TensorFlow's (and torch's intra-op) thread
+    pools, intra_op also the BLAS and OpenMP pools numpy and torch use,
+    and cpus pins the process to those cores (Linux only). Must run before
+    any model runs: TensorFlow's thread pools cannot be resized afterwards.
+    """
+    if cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, set(cpus))
+        else:
+            logger.info("Cannot pin to cpus %s on this platform", cpus)
+
+    if intra_op is not None:
+        # NOTE: Only read by the OpenMP runtimes loaded from now on; numpy
+        # already loaded its BLAS, whose pools threadpoolctl resizes
+        os.environ.setdefault("OMP_NUM_THREADS", str(intra_op))
+
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            logger.info(
+                "threadpoolctl is not installed; BLAS thread pools keep their size")
+        else:
+            threadpool_limits(limits=intra_op)
+
+    if intra_op is None and inter_op is None:
+        return
+
+    import tensorflow as tf
+
+    if intra_op is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+
+    if inter_op is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+    try:
+        import torch
+    except ImportError:
+        pass
+    else:
+        if intra_op is not None:
+            torch.set_num_threads(intra_op)
+
+    logger.info("Limited to %s intra-op and %s inter-op threads on cpus %s",
+                intra_op, inter_op, cpus or "all")
@@ -0,0 +1,15 @@
+from typing import Optional
+
+import numpy as np
+
+
+def top_k_indexes(scores: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    # Indexes of the k highest scores, highest first
+    if k is None or k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+
+    if k <= 0:
+        return np.empty((0,), dtype=np.int64)
+
+    partition = np.argpartition(-scores, k - 1)[:k]
+    return partition[np.argsort(-scores[partition], kind="stable")]
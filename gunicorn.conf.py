@@ -0,0 +1,32 @@
+# NOTE: Read by gunicorn from the working directory:
+#   gunicorn server.app:app
+# The master loads the app and the fork-safe models once (see
+# ServerServices); every worker then builds the rest of the stages, so the
+# model weights are shared copy-on-write between them
+import os
+
+from server.extensions import services
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+# NOTE: Each worker keeps its own index; more than one needs a config that
+# only reads (see ServerServices.check_workers), checked right here. The
+# ASGI app runs the same check in its lifespan, from WEB_CONCURRENCY, and
+# a uvicorn worker started with --workers N fails to claim_writes instead
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 120
+
+preload_app = True
+
+# Nothing but the models may start in the master
+services.autostart = False
+services.check_workers(workers)
+
+
+def on_starting(server):
+    services.preload()
+
+
+def post_fork(server, worker):
+    services.start()
@@ -25,10 +25,8 @@ def query(driver: CCDRDriver, v: str):
 
     results = driver.get_query_rankings_with_score(v)
 
-    eqs = {
-        tag: db.get_equipment_by_id(tag)
-        for tag in results[0].keys()
-    }
+    found, _ = db.get_equipments_by_ids(list(results[0].keys()))
+    eqs = dict(found)
 
     pretty_results = {
         tag: {
@@ -44,11 +42,14 @@ def query(driver: CCDRDriver, v: str):
 
 
 if __name__ == "__main__":
+    equipment_transformer = EquipmentTypeTransformer(
+        modelname='neuralmind/bert-large-portuguese-cased')
+
     t = Interface(
         processor=ECM(8.),
         transformers={
             "query_type": TypeTransformer(modelname='neuralmind/bert-large-portuguese-cased'),
-            "equipment": EquipmentTypeTransformer(modelname='neuralmind/bert-large-portuguese-cased'),
+            "equipment": equipment_transformer,
         },
         scoring_calculator=ScoringCalculator(),
     )
@@ -71,6 +72,7 @@ if __name__ == "__main__":
         ),
         ranking_stringify_equipment_func=stringuify,
         database_accessor=database_accessor,
+        equipment_transformer=equipment_transformer,
     )
 
     driver.init_processor()
@@ -2,22 +2,56 @@
 from ccdr.models.equipment import Equipment
 import re
 from server.database import DatabaseAccessor
-from ccdr.ranking_model.ranking import RankingExtension, RankingModel
+from ccdr.ranking_model.ranking import FeedbackRows, RankerVersion, RankingExtension, RankingModel, rows_to_feedback
 from ccdr.models.user_query import UserQuery
+from ccdr.transformers.equipment_transformer import EquipmentTypeTransformer
+from ccdr.utils.iterators import chunked
+from ccdr.utils.rwlock import ReadWriteLock
+from ccdr.retrieval.candidates import CandidateGenerator, ECMCandidateGenerator, EmbeddingCandidateGenerator
+from ccdr.retrieval.filters import AttributeIndex, SearchFilter
+from ccdr.retrieval.results import RankedResults
 
 from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, cast
 
 from interference.interface import Interface
 
 from itertools import chain
+from dataclasses import dataclass
+from datetime import datetime
 
+import numpy as np
+
+import hashlib
 import logging
+import threading
+import time
 
 logger = logging.getLogger('ccdr_driver')
 logger.setLevel(logging.INFO)
 
 
+@dataclass(frozen=True)
+class ServingSnapshot:
+    # What a search read: the index version its candidates came from and
+    # the ranker it scored them with
+    index_version: int
+    ranker: RankerVersion
+
+
 class CCDRDriver:
+    """Serves searches over the indexed equipments and keeps them in sync.
+
+    Searches and index writers share a read/write lock: searches hold it
+    only while reading candidates from the index, writers only while
+    applying already encoded equipments to it, so model work never runs
+    under the lock. The ranker is never locked; searches pin the
+    RankerVersion they read and training publishes a new one atomically.
+
+    Writers (the write queue, the index synchronizer, startup) are also
+    serialized among themselves by writer_lock, held from deciding what a
+    change adds, updates or removes until it is applied, so two of them
+    never both add the same tag.
+    """
 
     def __init__(
         self,
@@ -25,74 +59,387 @@ class CCDRDriver:
         ranking_stringify_equipment_func: Callable[[Equipment], str],
         ranking: RankingExtension,
         database_accessor: DatabaseAccessor,
+        equipment_transformer: Optional[EquipmentTypeTransformer] = None,
+        init_batch_size: int = 64,
+        candidate_generator: Optional[CandidateGenerator] = None,
     ):
         self.interface = interface
+        self.candidate_generator: CandidateGenerator = candidate_generator or ECMCandidateGenerator(
+            interface)
         self.ranking = ranking
         self.ranking_stringify_equipment_func = ranking_stringify_equipment_func
         self.database_accessor = database_accessor
+        self.equipment_transformer = equipment_transformer
+        self.init_batch_size = init_batch_size
+
+        # Digest of the text each indexed equipment was embedded from
+        self._equipment_digests: Dict[str, str] = {}
+        # Embedding of each indexed equipment, for snapshots; only kept
+        # when the candidate generator does not store them (the vector
+        # index does). Shares the arrays handed to the interface, so it
+        # costs no extra copies
+        self._equipment_embeddings: Dict[str, np.ndarray] = {}
+
+        # Group, area and location of each indexed equipment, for filters
+        self.attribute_index = AttributeIndex()
+        # Bumped on every change to the indexed equipments
+        self.index_version = 0
+
+        self.index_lock = ReadWriteLock()
+        # NOTE: Reentrant; the public writers call each other
+        self.writer_lock = threading.RLock()
+
+        self._feedback_rows: FeedbackRows = {}
+        self._feedback_watermark: Optional[datetime] = None
+
+    def init_processor(self, batch_size: Optional[int] = None):
+        with self.writer_lock:
+            logger.info("Initializing processor")
+
+            if batch_size is None:
+                batch_size = self.init_batch_size
+
+            if self.equipment_transformer is None:
+                for tag, equipment in self.database_accessor.get_all_equipments():
+                    with self.index_lock.write():
+                        self._add_equipment_with_tag(equipment, tag)
+            else:
+                self._bulk_init_processor(max(batch_size, 1))
+
+            if self.equipment_transformer is not None:
+                # NOTE: Every current equipment went through the embedding store
+                # by now, so whatever was not used belongs to stale text
+                self.equipment_transformer.persist_embeddings(compact=True)
+
+            return self
+
+    def _bulk_init_processor(self, batch_size: int, known_embeddings: Optional[Dict[str, Tuple[str, np.ndarray]]] = None):
+        start = time.perf_counter()
+        indexed = 0
+
+        equipments = self.database_accessor.get_all_equipments(batch_size)
+
+        for chunk in chunked(equipments, batch_size):
+            self._index_equipments(chunk, [], known_embeddings)
+            indexed += len(chunk)
+
+            elapsed = time.perf_counter() - start
+            logger.info("Indexed %d equipments (%.1f docs/sec)",
+                        indexed, indexed / elapsed)
+
+        elapsed = time.perf_counter() - start
+        logger.info("Processor initialized with %d equipments in %.1fs (%.1f docs/sec)",
+                    indexed, elapsed, indexed / elapsed if elapsed > 0 else 0.)
 
-    def init_processor(self):
-        logger.info("Initializing processor")
+    def _index_equipments(
+        self,
+        added: Sequence[Tuple[str, Equipment]],
+        updated: Sequence[Tuple[str, Equipment]],
+        known_embeddings: Optional[Dict[str, Tuple[str, np.ndarray]]] = None,
+    ):
+        # Encodes every added and updated equipment in one batch and then
+        # applies them to the interface; known_embeddings maps tags to the
+        # (digest, embedding) they had before, reused when the text is
+        # still the same
+        items = list(added) + list(updated)
+
+        if self.equipment_transformer is None:
+            with self.index_lock.write():
+                self._apply_upserts(added, updated)
+            return
+
+        if not items:
+            return
+
+        known_embeddings = known_embeddings or {}
+        digests = [self._equipment_digest(equipment) for _, equipment in items]
 
-        for tag, equipment in self.database_accessor.get_all_equipments():
-            self._add_equipment_with_tag(equipment, tag)
+        embeddings: List[Optional[np.ndarray]] = [
+            known_embeddings[tag][1]
+            if tag in known_embeddings and known_embeddings[tag][0] == digest else None
+            for (tag, _), digest in zip(items, digests)
+        ]
+
+        to_encode = [index for index, embedding in enumerate(embeddings)
+                     if embedding is None]
+
+        if len(to_encode) < len(items):
+            self.equipment_transformer.keep_embeddings(
+                [equipment for (_, equipment), embedding in zip(items, embeddings) if embedding is not None])
+        encoded = self.equipment_transformer.calculate_embeddings(
+            [items[index][1] for index in to_encode])
+
+        for index, embedding in zip(to_encode, encoded):
+            embeddings[index] = embedding
+
+        embeddings_by_tag = {
+            tag: embedding for (tag, _), embedding in zip(items, embeddings)
+        }
 
-        return self
+        with self.index_lock.write(), self.equipment_transformer.precomputed([equipment for _, equipment in items], embeddings):
+            self._apply_upserts(added, updated, embeddings_by_tag)
 
-    def _add_equipment_with_tag(self, equipment: Equipment, tag: str):
-        instance = self.interface.try_create_instance_from_value(
-            "equipment", equipment)
+            if not self.candidate_generator.stores_embeddings:
+                for (tag, _), embedding in zip(items, embeddings):
+                    self._equipment_embeddings[tag] = embedding
 
-        assert instance
-        self.interface.add(tag, instance)
+    def _equipment_digest(self, equipment: Equipment):
+        text = self.ranking_stringify_equipment_func(equipment)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _add_equipment_with_tag(self, equipment: Equipment, tag: str, embedding: Optional[np.ndarray] = None):
+        self.candidate_generator.add(tag, equipment, embedding)
+        self.attribute_index.add(tag, equipment)
+        self.index_version += 1
+        self._equipment_digests[tag] = self._equipment_digest(equipment)
 
     def add_equipment_by_tag(self, tag: str):
-        equipment = self.database_accessor.get_equipment_by_id(tag)
+        with self.writer_lock:
+            equipment = self.database_accessor.get_equipment_by_id(tag)
+
+            self._index_equipments([(tag, equipment)], [])
+
+    def _update_equipment_with_tag(self, equipment: Equipment, tag: str, embedding: Optional[np.ndarray] = None):
+        self.candidate_generator.update(tag, equipment, embedding)
+        self.attribute_index.add(tag, equipment)
+        self.index_version += 1
+        self._equipment_digests[tag] = self._equipment_digest(equipment)
 
-        self._add_equipment_with_tag(equipment, tag)
+    def _equipment_changed(self, equipment: Equipment, tag: str):
+        return self._equipment_digests.get(tag) != self._equipment_digest(equipment)
 
     def update_equipment_by_tag(self, tag: str):
-        equipment = self.database_accessor.get_equipment_by_id(tag)
+        with self.writer_lock:
+            equipment = self.database_accessor.get_equipment_by_id(tag)
+
+            if not self._equipment_changed(equipment, tag):
+                logger.info("Equipment %s text did not change; skipping", tag)
+                return
+
+            self._index_equipments([], [(tag, equipment)])
+
+            if self.equipment_transformer is not None:
+                self.equipment_transformer.persist_embeddings()
+
+    def upsert_equipments_by_tags(self, tags: Sequence[str]) -> Dict[str, List[str]]:
+        # Adds the tags not indexed yet and re-indexes the ones whose text
+        # changed, fetching and encoding all of them in one go
+        with self.writer_lock:
+            equipments, missing = self.database_accessor.get_equipments_by_ids(
+                tags)
+
+            added = [(tag, equipment) for tag, equipment in equipments
+                     if tag not in self._equipment_digests]
+            updated = [(tag, equipment) for tag, equipment in equipments
+                       if tag in self._equipment_digests and self._equipment_changed(equipment, tag)]
+            unchanged = [tag for tag, equipment in equipments
+                         if tag in self._equipment_digests and not self._equipment_changed(equipment, tag)]
+
+            self._index_equipments(added, updated)
 
-        instance = self.interface.try_create_instance_from_value(
-            "equipment", equipment)
+            if self.equipment_transformer is not None and (added or updated):
+                self.equipment_transformer.persist_embeddings()
 
-        assert instance
-        self.interface.update(tag, instance)
+            return {
+                "added": [tag for tag, _ in added],
+                "updated": [tag for tag, _ in updated],
+                "unchanged": unchanged,
+                "missing": missing,
+            }
+
+    def _apply_upserts(
+        self,
+        added: Sequence[Tuple[str, Equipment]],
+        updated: Sequence[Tuple[str, Equipment]],
+        embeddings: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        embeddings = embeddings or {}
+
+        for tag, equipment in added:
+            self._add_equipment_with_tag(equipment, tag, embeddings.get(tag))
+
+        for tag, equipment in updated:
+            self._update_equipment_with_tag(
+                equipment, tag, embeddings.get(tag))
 
     def remove_equipment_by_tag(self, tag: str):
-        self.interface.remove(tag)
+        with self.writer_lock, self.index_lock.write():
+            self.candidate_generator.remove(tag)
+            self.attribute_index.remove(tag)
+            self.index_version += 1
+            self._equipment_digests.pop(tag, None)
+            self._equipment_embeddings.pop(tag, None)
 
-    def get_query_rankings(self, query: str, limit: int):
-        rankings, matches_score = self.get_query_rankings_with_score(query)
-        sorted_rankings = list(sorted([(tag, matches_score[tag])
-                                       for tag in rankings], key=lambda k: k[1], reverse=True))
+    def indexed_tags(self) -> List[str]:
+        with self.index_lock.read():
+            return list(self._equipment_digests)
 
-        if limit == 0:
-            return sorted_rankings
+    def apply_equipment_changes(self, upserts: Sequence[str], removals: Sequence[str]):
+        with self.writer_lock:
+            result = self.upsert_equipments_by_tags(upserts) if upserts else {}
 
-        return sorted_rankings[:limit]
+            removed = [tag for tag in removals if tag in self._equipment_digests]
+            for tag in removed:
+                self.remove_equipment_by_tag(tag)
 
-    def get_query_rankings_with_score(self, query: str):
-        instance = self.interface.try_create_instance_from_value(
-            "query_type", query)
+            return {**result, "removed": removed}
 
-        assert instance
+    def export_index(self) -> Tuple[List[str], List[str], np.ndarray]:
+        # Indexed tags, their text digests and their embeddings, row
+        # aligned; the caller holds index_lock for reading
+        stores_embeddings = self.candidate_generator.stores_embeddings
 
-        matches = self.interface.get_scorings_for(instance)
+        tags = list(
+            self._equipment_digests if stores_embeddings else self._equipment_embeddings)
+        digests = [self._equipment_digests[tag] for tag in tags]
 
-        relevant_equipments_and_scores: Dict[str, float] = {
-            scoring.scored_tag: scoring.score
-            for scoring in matches
-            if scoring.scored_tag is not None
-        }
+        if not tags:
+            return tags, digests, np.zeros((0, 0), dtype=np.float32)
+
+        if stores_embeddings:
+            return tags, digests, cast(EmbeddingCandidateGenerator, self.candidate_generator).embeddings(tags)
+
+        embeddings = np.stack(
+            [self._equipment_embeddings[tag] for tag in tags]).astype(np.float32)
+
+        return tags, digests, embeddings
+
+    def restore_index(
+        self,
+        tags: Sequence[str],
+        digests: Sequence[str],
+        embeddings: np.ndarray,
+        candidates_restored: bool = False,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        # When the candidate generator restored its own state (the ECM
+        # clusters or the vector index) only the equipments that differ
+        # from the database (added, removed or with another text digest)
+        # are reconciled; otherwise the index is rebuilt from the database
+        # reusing the given embeddings
+        with self.writer_lock:
+            if candidates_restored and attributes is not None:
+                with self.index_lock.write():
+                    self.attribute_index.restore_state(attributes)
+                    self.index_version += 1
+                    self._equipment_digests = dict(zip(tags, digests))
+                    self._equipment_embeddings = {} if self.candidate_generator.stores_embeddings else {
+                        tag: embeddings[index] for index, tag in enumerate(tags)
+                    }
+
+                # NOTE: Reads every equipment, but only encodes the
+                # changed ones
+                in_database = set()
+                changed = []
+                unchanged: List[Equipment] = []
+
+                for tag, equipment in self.database_accessor.get_all_equipments(self.init_batch_size):
+                    in_database.add(tag)
+
+                    if self._equipment_changed(equipment, tag):
+                        changed.append(tag)
+                    elif self.equipment_transformer is not None:
+                        unchanged.append(equipment)
+
+                        if len(unchanged) >= self.init_batch_size:
+                            self.equipment_transformer.keep_embeddings(
+                                unchanged)
+                            unchanged = []
+
+                if self.equipment_transformer is not None:
+                    self.equipment_transformer.keep_embeddings(unchanged)
+
+                result = self.apply_equipment_changes(
+                    changed,
+                    [tag for tag in self._equipment_digests if tag not in in_database],
+                )
+                logger.info("Reconciled snapshot with the database: %d added, %d updated, %d removed",
+                            len(result.get("added", [])), len(result.get("updated", [])), len(result["removed"]))
+
+                if self.equipment_transformer is not None:
+                    # NOTE: Every current equipment was kept or encoded
+                    self.equipment_transformer.persist_embeddings(
+                        compact=True)
+
+                return self
+
+            known_embeddings = {
+                tag: (digest, embeddings[index])
+                for index, (tag, digest) in enumerate(zip(tags, digests))
+            }
+
+            self._bulk_init_processor(self.init_batch_size, known_embeddings)
+
+            if self.equipment_transformer is not None:
+                self.equipment_transformer.persist_embeddings(compact=True)
+
+            return self
+
+    def feedback_state(self) -> Tuple[FeedbackRows, Optional[datetime]]:
+        return self._feedback_rows, self._feedback_watermark
+
+    def restore_feedback_state(self, rows: FeedbackRows, watermark: Optional[datetime]):
+        self._feedback_rows = rows
+        # NOTE: Older snapshots saved an _id; all feedback is read again
+        self._feedback_watermark = watermark if isinstance(
+            watermark, datetime) else None
+
+    def serving_snapshot(self) -> ServingSnapshot:
+        with self.index_lock.read():
+            return ServingSnapshot(self.index_version, self.ranking.current)
+
+    def results_version(self) -> Tuple[int, int]:
+        # Ranked results computed under another version are stale
+        # NOTE: Two attribute reads without the lock, so callers on an
+        # event loop never wait on a writer; a version read while a write
+        # lands only keys results nobody asks for once it has landed
+        return self.index_version, self.ranking.current.version
+
+    def get_query_rankings(self, query: str, limit: int, search_filter: Optional[SearchFilter] = None):
+        return self.rank_query(query, search_filter).page(0, limit)
+
+    def rank_query(self, query: str, search_filter: Optional[SearchFilter] = None) -> RankedResults:
+        # The ranked tags with their match scores, sorted by score only as
+        # far as they are read
+        rankings, matches_score = self.get_query_rankings_with_score(
+            query, search_filter)
+
+        tags = list(rankings)
+        return RankedResults(tags, [matches_score[tag] for tag in tags])
+
+    def get_query_rankings_with_score(self, query: str, search_filter: Optional[SearchFilter] = None):
+        # The filter is resolved from the attribute index first, so only
+        # the equipments matching it are scored
+        if search_filter is None:
+            tags = None
+        else:
+            with self.index_lock.read():
+                tags = self.attribute_index.matching(search_filter)
+
+        if tags is not None and not tags:
+            return {}, {}
+
+        prepared = self.candidate_generator.prepare(query)
+
+        with self.index_lock.read():
+            snapshot = ServingSnapshot(
+                self.index_version, self.ranking.current)
+            relevant_equipments_and_scores = self.candidate_generator.candidates_for(
+                prepared, tags)
 
         rankings = self.ranking.rank(
-            query, list(relevant_equipments_and_scores.keys()))
+            query, list(relevant_equipments_and_scores.keys()), ranker=snapshot.ranker.ranker)
 
         return rankings, relevant_equipments_and_scores
 
     def learn_with_feedback(self):
-        all_feedback = self.database_accessor.get_feedback()
-        self.ranking.learn(all_feedback)
+        # Only feedback newer than the watermark is read; it is merged
+        # into what was read before keeping the max score
+        columns = self.database_accessor.get_feedback_columns(
+            self._feedback_watermark)
+
+        columns.merge_into(self._feedback_rows)
+        self._feedback_watermark = columns.watermark
+
+        self.ranking.learn(rows_to_feedback(self._feedback_rows))
         # TODO: maybe delete feedbacks here
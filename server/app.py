@@ -2,7 +2,7 @@ from flask import Flask, request, jsonify
 
 import logging
 
-from .extensions import scheduler
+from .extensions import scheduler, services
 
 import os
 
@@ -34,16 +34,26 @@ def create_app():
 
         # pylint: disable=W0611
         if is_debug_mode() and not is_werkzeug_reloader_process():
+            # NOTE: Either the reloader's watcher, which never serves, or a
+            # debug server run without the reloader
             pass
         else:
-            from . import ranking  # noqa: F401
             scheduler.api_enabled = True
-            scheduler.start()
 
-        from . import search, equipment  # noqa: F401
+        # NOTE: Nothing starts on import, so a preloading master stays free
+        # of models and connections; the process that serves starts the
+        # services (in the background) on its first request, readiness
+        # probes included, and answers 503 until the index is loaded
+        @app.before_request
+        def start_services():
+            if services.autostart:
+                services.start()
+
+        from . import search, equipment, health  # noqa: F401
 
         app.register_blueprint(search.s_bp)
         app.register_blueprint(equipment.eq_bp)
+        app.register_blueprint(health.h_bp)
 
         return app
 
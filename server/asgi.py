@@ -0,0 +1,349 @@
+"""Async entry point serving the same /search and /equipment routes.
+
+    uvicorn server.asgi:app
+
+Several workers are started with WEB_CONCURRENCY=N, which uvicorn reads
+as its --workers default, rather than --workers N: it is the only worker
+count a worker can see (see lifespan).
+
+Handlers never run models on the event loop: searches are handed to a
+bounded thread pool, identical searches in flight share one computation
+(and, below that, the query micro-batchers share model passes), and a
+search whose client disconnects stops waiting and gives up its slot.
+"""
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from flask import Flask
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable
+
+import asyncio
+import json
+import os
+
+from ccdr.retrieval.results import RankedResults
+
+from .extensions import scheduler, services
+from .result_cache import InvalidCursorError, SearchResultCache
+from .search import ndjson_lines, page_bounds, parse_search_filter
+from .write_queue import EquipmentWriteQueue, QueueFullError
+
+class OverloadedError(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+@dataclass
+class _Inflight:
+    job: "Future[Any]"
+    task: "asyncio.Future[Any]"
+    waiters: int = 0
+
+
+class InflightSearches:
+    """Runs blocking searches on a bounded executor, one per key.
+
+    Requests for a key already in flight wait on the same computation
+    instead of queueing another one. At most max_pending computations are
+    queued or running; past that new keys are refused. When every request
+    waiting on a computation has gone, it is cancelled if the executor had
+    not started it yet; a running one cannot be stopped, so it keeps its
+    key (later requests still share it) and its pending slot until it
+    finishes.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64):
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="search")
+        self.max_pending = max_pending
+        self._inflight: Dict[Hashable, _Inflight] = {}
+
+        self.coalesced = 0
+        self.cancelled = 0
+        self.refused = 0
+
+    def _forget(self, key: Hashable, entry: _Inflight):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    async def run(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        # NOTE: Only touched from the event loop, so no lock is needed
+        entry = self._inflight.get(key)
+
+        if entry is None:
+            if len(self._inflight) >= self.max_pending:
+                self.refused += 1
+                raise OverloadedError(
+                    f"{len(self._inflight)} searches pending; try again later")
+
+            job = self.executor.submit(func)
+            entry = _Inflight(job, asyncio.wrap_future(job))
+            self._inflight[key] = entry
+            entry.task.add_done_callback(
+                lambda _, key=key, entry=entry: self._forget(key, entry))
+        else:
+            self.coalesced += 1
+
+        entry.waiters += 1
+        try:
+            return await asyncio.shield(entry.task)
+        finally:
+            entry.waiters -= 1
+
+            # NOTE: Fails once the job runs; its entry is then only
+            # forgotten when it is done
+            if entry.waiters == 0 and entry.job.cancel():
+                self.cancelled += 1
+                self._forget(key, entry)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._inflight),
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "refused": self.refused,
+        }
+
+
+def not_ready():
+    return JSONResponse({"error": "Starting up; try again later"}, 503, {"Retry-After": "5"})
+
+
+def read_only():
+    return JSONResponse({"error": "Served by several workers; equipment changes are read from the database"}, 409)
+
+
+async def _until_disconnected(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(request.app.state.disconnect_poll)
+
+
+async def run_search(request: Request, key: Hashable, func: Callable[[], Any]) -> Any:
+    # The result of func, unless the client disconnects first
+    work = asyncio.ensure_future(request.app.state.inflight.run(key, func))
+    watch = asyncio.ensure_future(_until_disconnected(request))
+
+    try:
+        await asyncio.wait({work, watch}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watch.cancel()
+
+    if not work.done():
+        work.cancel()
+        raise ClientDisconnected()
+
+    return work.result()
+
+
+async def _page(request: Request, results: RankedResults, offset: int, count: int):
+    # NOTE: The first page of a result set sorts it; kept off the loop
+    return await asyncio.get_running_loop().run_in_executor(
+        request.app.state.inflight.executor, results.page, offset, count)
+
+
+def _int_param(request: Request, name: str, default: int = 0) -> int:
+    # Like Flask's args.get(type=int): the default when missing or invalid
+    try:
+        return int(request.query_params.get(name, default))
+    except ValueError:
+        return default
+
+
+async def search(request: Request):
+    query = request.path_params["query"]
+    offset = _int_param(request, 'offset')
+    limit = _int_param(request, 'limit')
+    page_size = _int_param(request, 'page_size')
+    cursor = request.query_params.get('cursor')
+    stream = _int_param(request, 'stream') != 0
+
+    if not services.is_ready():
+        return not_ready()
+
+    driver = services.driver
+    result_cache = services.result_cache
+
+    if cursor is not None:
+        try:
+            entry_id, offset = SearchResultCache.decode_cursor(cursor)
+        except InvalidCursorError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        results = result_cache.get(
+            entry_id, query, driver.results_version())
+
+        if results is None:
+            return JSONResponse({"error": "Cursor expired; run the query again"}, 410)
+
+    else:
+        try:
+            search_filter = parse_search_filter(request.query_params)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        key = SearchResultCache.key(query, search_filter)
+        version = driver.results_version()
+
+        try:
+            entry_id, results = await run_search(
+                request,
+                (key, version),
+                lambda: result_cache.get_or_compute(
+                    key, version, lambda: driver.rank_query(query, search_filter)),
+            )
+        except OverloadedError as e:
+            return JSONResponse({"error": str(e)}, 503, {"Retry-After": "1"})
+        except ClientDisconnected:
+            # NOTE: Nobody reads it; 499 as nginx logs it
+            return Response(status_code=499)
+
+        if page_size <= 0 and not stream:
+            page = await _page(request, results, max(offset, 0), limit)
+            return Response(json.dumps(page), media_type="application/json")
+
+    offset, page_end, next_cursor = page_bounds(
+        results, offset, limit, page_size, entry_id)
+
+    if stream:
+        # NOTE: Starlette iterates sync generators on its thread pool, so
+        # later blocks are sorted off the event loop
+        return StreamingResponse(
+            ndjson_lines(results, offset, page_end, next_cursor),
+            media_type="application/x-ndjson",
+        )
+
+    return JSONResponse({
+        "results": await _page(request, results, offset, page_end - offset) if page_end > offset else [],
+        "next_cursor": next_cursor,
+    })
+
+
+def enqueue(request: Request, operation: str, tags):
+    if not services.accepts_writes():
+        return read_only()
+
+    if not services.is_ready():
+        return not_ready()
+
+    try:
+        job = services.write_queue.submit(operation, tags)
+    except QueueFullError as e:
+        return JSONResponse({"error": str(e)}, 503, {"Retry-After": "1"})
+
+    return JSONResponse({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": request.app.url_path_for("job_status", job_id=job.id),
+    }, 202)
+
+
+async def job_status(request: Request):
+    if not services.accepts_writes():
+        return read_only()
+
+    if not services.is_ready():
+        return not_ready()
+
+    job = services.write_queue.get(request.path_params["job_id"])
+
+    if job is None:
+        return JSONResponse({"error": "Unknown job"}, 404)
+
+    return JSONResponse(job.to_dict())
+
+
+async def sync_metrics(request: Request):
+    if not services.is_ready():
+        return not_ready()
+
+    index_synchronizer = services.index_synchronizer
+
+    if index_synchronizer is None:
+        return JSONResponse({"enabled": False})
+
+    return JSONResponse({"enabled": True, **index_synchronizer.metrics()})
+
+
+async def upsert_equipments(request: Request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+
+    tags = body.get("tags") if isinstance(body, dict) else None
+
+    if not isinstance(tags, list):
+        return JSONResponse({"error": "Expected a json body with a list of tags"}, 400)
+
+    return enqueue(request, EquipmentWriteQueue.UPSERT, [str(tag) for tag in tags])
+
+
+async def upsert_equipment(request: Request):
+    return enqueue(request, EquipmentWriteQueue.UPSERT, [request.path_params["tag"]])
+
+
+async def remove_equipment(request: Request):
+    return enqueue(request, EquipmentWriteQueue.DELETE, [request.path_params["tag"]])
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    # NOTE: A worker started with --workers N rather than WEB_CONCURRENCY
+    # counts itself alone; claim_writes then stops every one but the
+    # first, instead of letting each keep its own diverging index
+    services.check_workers(int(os.environ.get("WEB_CONCURRENCY", 1)))
+    services.claim_writes()
+
+    # NOTE: Built here rather than on import, which reads nothing
+    config = services.config
+    app.state.inflight = InflightSearches(
+        max_workers=config.get("asgi_inference_workers", 4),
+        max_pending=config.get("asgi_max_pending", 64),
+    )
+    app.state.disconnect_poll = config.get("asgi_disconnect_poll_ms", 50.) / 1000
+
+    # NOTE: Flask-APScheduler reads its settings from a Flask app; this
+    # one only hosts the scheduler
+    scheduler.init_app(Flask(__name__))
+    services.start()
+
+    yield
+
+    app.state.inflight.executor.shutdown(wait=False)
+
+
+async def health(request: Request):
+    status = services.status()
+
+    return JSONResponse(status, 200 if status["healthy"] else 500)
+
+
+async def ready(request: Request):
+    status = services.status()
+
+    return JSONResponse(status, 200 if status["ready"] else 503)
+
+
+routes = [
+    Route("/health", health, methods=["GET"]),
+    Route("/ready", ready, methods=["GET"]),
+    Route("/search/{query}", search, methods=["GET"]),
+    Route("/equipment/jobs/{job_id}", job_status,
+          methods=["GET"], name="job_status"),
+    Route("/equipment/sync", sync_metrics, methods=["GET"]),
+    Route("/equipment/bulk", upsert_equipments, methods=["POST"]),
+    Route("/equipment/{tag}", upsert_equipment, methods=["POST", "PUT"]),
+    Route("/equipment/{tag}", remove_equipment, methods=["DELETE"]),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,91 @@
+from typing import List
+from typing_extensions import TypedDict
+
+from server.database import MongoDatabaseConfig
+
+
+class OptionalServerConfigFields(TypedDict, total=False):
+    # Number of equipments encoded per SentenceTransformer.encode call
+    encode_batch_size: int
+    # Number of equipments read from the database per bulk indexing chunk
+    init_batch_size: int
+    # Directory of the on-disk equipment embedding cache; disabled if missing
+    embedding_store_path: str
+    # Number of queries whose embeddings are kept in memory
+    query_cache_size: int
+    # Seconds a cached query embedding stays valid
+    query_cache_ttl: float
+    # Epochs used when the ranker is trained on new feedback only
+    ranker_incremental_epochs: int
+    # Already seen feedback rows trained again alongside new ones
+    ranker_replay_size: int
+    # Directory of the on-disk feedback query pooler output cache
+    query_store_path: str
+    # Keep the index in sync with the equipment collection in background
+    index_sync_enabled: bool
+    # Seconds changes to the same tag are gathered before being applied
+    index_sync_coalesce_seconds: float
+    # Seconds between polls when change streams are not available
+    index_sync_poll_interval: float
+    # Equipment jobs waiting before the endpoints answer 503
+    write_queue_max_depth: int
+    # Equipment jobs applied together by the write queue worker
+    write_queue_max_batch: int
+    # Directory of the serving index snapshots; disabled if missing
+    snapshot_path: str
+    # Seconds between snapshots
+    snapshot_interval: int
+    # Candidate generator: "ecm" (default), "brute_force" or "ivf"
+    retrieval_backend: str
+    # Candidates taken from a vector index per query
+    retrieval_k: int
+    # Lists of the ivf index; sqrt of the equipment count if missing
+    retrieval_n_lists: int
+    # Lists the ivf index scores per query; higher is slower and more exact
+    retrieval_n_probe: int
+    # Vector index storage: "float32" (default), "float16" or "int8"
+    retrieval_storage: str
+    # Results per NDJSON chunk of a streamed search
+    search_stream_block: int
+    # Ranked result sets kept in memory for repeated queries and pages
+    search_cache_max_entries: int
+    # Seconds a ranked result set (and its cursors) stays valid
+    search_cache_ttl: float
+    # Former names of search_cache_max_entries and search_cache_ttl
+    search_cursor_max_entries: int
+    search_cursor_ttl: float
+    # Concurrent search queries encoded in one model pass; 1 disables it
+    query_batch_max_size: int
+    # Milliseconds a query waits for others to share its model pass
+    query_batch_max_wait_ms: float
+    # Threads running searches in the ASGI server
+    asgi_inference_workers: int
+    # Distinct searches queued or running in the ASGI server before 503s
+    asgi_max_pending: int
+    # Milliseconds between checks for clients that went away mid-search
+    asgi_disconnect_poll_ms: float
+    # Lock file held by the one ASGI process taking equipment changes;
+    # distinct per deployment sharing a host
+    writer_lock_path: str
+    # Where the ranker is trained: "in_process" (default) or "worker"
+    ranker_training: str
+    # Directory the worker publishes versioned rankers to; needed by "worker"
+    ranker_store_path: str
+    # Spawn the worker from the server; False if it is run on its own
+    ranker_worker_spawn: bool
+    # Seconds between the worker's training rounds
+    ranker_worker_interval: int
+    # Seconds between the server's checks for a newer ranker
+    ranker_poll_interval: int
+    # TensorFlow intra/inter-op threads and cpus of the training worker
+    trainer_intra_op_threads: int
+    trainer_inter_op_threads: int
+    trainer_cpus: List[int]
+    # TensorFlow intra/inter-op threads and cpus of the serving process
+    serving_intra_op_threads: int
+    serving_inter_op_threads: int
+    serving_cpus: List[int]
+
+
+class ServerConfig(MongoDatabaseConfig, OptionalServerConfigFields):
+    pass
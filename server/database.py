@@ -1,9 +1,14 @@
-from typing import Any, DefaultDict, Iterator, List, Tuple, Dict, TypeVar, Optional, Generic, cast
+from typing import Any, DefaultDict, Iterator, List, Sequence, Tuple, Dict, TypeVar, Optional, Generic, cast
 from typing_extensions import Protocol, Type, TypedDict
 from ccdr.models.equipment import Equipment
-from pymongo import MongoClient, collection
+from ccdr.utils.iterators import chunked
+from pymongo import MongoClient, collection, monitoring
 from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
 import abc
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 
 
 class DatabaseAccessor(Protocol):
@@ -11,12 +16,18 @@ class DatabaseAccessor(Protocol):
     def get_equipment_by_id(self, _id: str) -> Equipment:
         ...
 
-    def get_all_equipments(self) -> Iterator[Tuple[str, Equipment]]:
+    def get_equipments_by_ids(self, _ids: Sequence[str], projection: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[str, Equipment]], List[str]]:
+        ...
+
+    def get_all_equipments(self, batch_size: Optional[int] = None) -> Iterator[Tuple[str, Equipment]]:
         ...
 
     def get_feedback(self) -> Dict[str, List[Tuple[str, float]]]:
         ...
 
+    def get_feedback_columns(self, since: Optional[datetime] = None) -> "FeedbackColumns":
+        ...
+
     def get_unique_ids(self) -> List[str]:
         ...
 
@@ -31,11 +42,123 @@ class QueryFeedbackDataFromDB(TypedDict):
     feedbacks: List[FeedbackDataFromDB]
 
 
-class MongoDatabaseConfig(TypedDict):
+class RequiredMongoDatabaseConfig(TypedDict):
     database_host: str
     database: str
 
 
+class OptionalMongoDatabaseConfig(TypedDict, total=False):
+    max_pool_size: int
+    min_pool_size: int
+    max_idle_time_ms: int
+    connect_timeout_ms: int
+    socket_timeout_ms: int
+    server_selection_timeout_ms: int
+    wait_queue_timeout_ms: int
+
+
+@dataclass
+class FeedbackColumns:
+    # Max score per (query, equipment), as parallel arrays
+    queries: List[str]
+    equipment_ids: List[str]
+    scores: List[float]
+    # Newest updatedAt aggregated; pass as since to get only what was
+    # added afterwards
+    watermark: Optional[datetime]
+
+    def __len__(self):
+        return len(self.queries)
+
+    def to_feedback(self) -> Dict[str, List[Tuple[str, float]]]:
+        feedback: Dict[str, List[Tuple[str, float]]] = {}
+
+        for query, equipment_id, score in zip(self.queries, self.equipment_ids, self.scores):
+            feedback.setdefault(query, []).append((equipment_id, score))
+
+        return feedback
+
+    def merge_into(self, rows: Dict[Tuple[str, str], float]):
+        # Adds these scores to rows read before, keeping the max score
+        for query, equipment_id, score in zip(self.queries, self.equipment_ids, self.scores):
+            key = (query, equipment_id)
+            rows[key] = max(score, rows.get(key, score))
+
+
+class MongoDatabaseConfig(RequiredMongoDatabaseConfig, OptionalMongoDatabaseConfig):
+    pass
+
+
+# MongoClient keyword argument for each optional pool setting
+MONGO_CLIENT_OPTIONS = {
+    "max_pool_size": "maxPoolSize",
+    "min_pool_size": "minPoolSize",
+    "max_idle_time_ms": "maxIdleTimeMS",
+    "connect_timeout_ms": "connectTimeoutMS",
+    "socket_timeout_ms": "socketTimeoutMS",
+    "server_selection_timeout_ms": "serverSelectionTimeoutMS",
+    "wait_queue_timeout_ms": "waitQueueTimeoutMS",
+}
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.check_out_failures = 0
+        self.pool_clears = 0
+
+    def _increment(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._increment("pool_clears")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._increment("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._increment("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._increment("check_out_failures")
+
+    def connection_checked_out(self, event):
+        self._increment("checked_out")
+
+    def connection_checked_in(self, event):
+        self._increment("checked_in")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "open": self.created - self.closed,
+                "in_use": self.checked_out - self.checked_in,
+                "created": self.created,
+                "closed": self.closed,
+                "checked_out": self.checked_out,
+                "check_out_failures": self.check_out_failures,
+                "pool_clears": self.pool_clears,
+            }
+
+
 class MongoAcessor(abc.ABC):
     def __init__(self, collection: collection.Collection):
         self.collection = collection
@@ -51,13 +174,12 @@ T = TypeVar('T', bound=MongoAcessor)
 
 class MongoCollectionAccessorWrapper(Generic[T]):
 
-    def __init__(self, database_host: str, database: str, type_: Type[T]) -> None:
-        self.database_host = database_host
+    def __init__(self, client: MongoClient, database: str, type_: Type[T]) -> None:
+        self.client = client
         self.database = database
         self.type_ = type_
 
     def __enter__(self) -> T:
-        self.client = MongoClient(self.database_host)
         db = self.client[self.database]
         name = self.type_.name()
         return self.type_(collection=db[name])
@@ -66,6 +188,10 @@ class MongoCollectionAccessorWrapper(Generic[T]):
         pass
 
 
+# How far before the watermark equipment updates are read again
+EQUIPMENT_WATERMARK_OVERLAP = timedelta(seconds=30)
+
+
 class EquipmentMongoCollectionAccessor(MongoAcessor):
     def get_equipment_ids(self) -> List[str]:
         return self.collection.distinct('_id')
@@ -79,17 +205,67 @@ class EquipmentMongoCollectionAccessor(MongoAcessor):
 
         return equipment_from_db
 
-    def get_all_equipment_data(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    def get_equipment_data_by_ids(self, _ids: Sequence[str], projection: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+        equipments_from_db = self.collection.find(
+            {"_id": {"$in": [ObjectId(_id) for _id in _ids]}}, projection)
+
+        return {
+            str(equipment["_id"]): equipment
+            for equipment in equipments_from_db
+        }
+
+    def get_all_equipment_data(self, batch_size: Optional[int] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
         equipments_from_db = self.collection.find({})
 
+        if batch_size is not None:
+            equipments_from_db = equipments_from_db.batch_size(batch_size)
+
         for equipment in equipments_from_db:
             yield str(equipment["_id"]), equipment
 
+    def watch(self, resume_after: Optional[Dict[str, Any]] = None, start_at_operation_time: Optional[Timestamp] = None, max_await_time_ms: int = 500):
+        # NOTE: The server takes one of the two; the resume token is later
+        return self.collection.watch(
+            full_document="updateLookup",
+            resume_after=resume_after,
+            start_at_operation_time=None if resume_after is not None else start_at_operation_time,
+            max_await_time_ms=max_await_time_ms,
+        )
+
+    def get_equipment_ids_updated_since(self, since: Optional[datetime]) -> List[Tuple[str, datetime]]:
+        # NOTE: From EQUIPMENT_WATERMARK_OVERLAP before since, so updates
+        # sharing its updatedAt or committed out of updatedAt order are
+        # not missed; the caller skips the ones it already read
+        query = {"updatedAt": {"$exists": True}} if since is None \
+            else {"updatedAt": {"$gte": since - EQUIPMENT_WATERMARK_OVERLAP}}
+
+        from_db = self.collection.find(
+            query, {"_id": 1, "updatedAt": 1}).sort("updatedAt", 1)
+
+        return [
+            (str(equipment["_id"]), equipment["updatedAt"])
+            for equipment in from_db
+            if "updatedAt" in equipment
+        ]
+
+    def get_last_equipment_update(self) -> Optional[datetime]:
+        from_db = self.collection.find(
+            {"updatedAt": {"$exists": True}}, {"_id": 0, "updatedAt": 1}).sort("updatedAt", -1).limit(1)
+
+        for equipment in from_db:
+            return equipment["updatedAt"]
+
+        return None
+
     @staticmethod
     def name():
         return "equipment"
 
 
+# How far before the watermark feedback is read again
+FEEDBACK_WATERMARK_OVERLAP = timedelta(seconds=30)
+
+
 class FeedbackMongoCollectionAccessor(MongoAcessor):
 
     def get_query_feedback_data_by_id(self, _id: str) -> QueryFeedbackDataFromDB:
@@ -106,6 +282,33 @@ class FeedbackMongoCollectionAccessor(MongoAcessor):
         for item in from_db:
             yield str(item["_id"]), item
 
+    def aggregate_query_feedback(self, since: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+        # NOTE: Feedback is also $push'ed into existing documents, so the
+        # watermark is the updatedAt their writers set with $currentDate
+        # on every write (as for equipments), not the _id. Documents are
+        # read again from FEEDBACK_WATERMARK_OVERLAP before it, so writes
+        # committed out of updatedAt order are not missed; reading a score
+        # twice is harmless, as only the max is kept
+        pipeline: List[Dict[str, Any]] = []
+
+        if since is not None:
+            pipeline.append(
+                {"$match": {"updatedAt": {"$gte": since - FEEDBACK_WATERMARK_OVERLAP}}})
+
+        pipeline.extend([
+            {"$unwind": "$feedbacks"},
+            {"$group": {
+                "_id": {
+                    "query": "$query",
+                    "equipment_id": "$feedbacks.equipment_id",
+                },
+                "score": {"$max": "$feedbacks.score"},
+                "last_updated_at": {"$max": "$updatedAt"},
+            }},
+        ])
+
+        return self.collection.aggregate(pipeline, allowDiskUse=True)
+
     @staticmethod
     def name():
         return "queryfeedbacks"
@@ -124,45 +327,118 @@ def parse_query_feedback(data: QueryFeedbackDataFromDB) -> Tuple[str, List[Tuple
 
 class MongoDatabaseAccessor:
 
-    def __init__(self, config: MongoDatabaseConfig) -> None:
+    def __init__(self, config: MongoDatabaseConfig, client: Optional[MongoClient] = None) -> None:
         self.config = config
+        self.pool_metrics = PoolMetricsListener()
+
+        # NOTE: One pooled client for the whole lifetime of the accessor;
+        # MongoClient is thread-safe and hands sockets out from its pool
+        if client is None:
+            options = {
+                option: config[key]  # type: ignore
+                for key, option in MONGO_CLIENT_OPTIONS.items()
+                if key in config
+            }
+
+            client = MongoClient(
+                config["database_host"],
+                event_listeners=[self.pool_metrics],
+                **options,
+            )
+
+        self.client = client
+
+    def _access(self, type_: Type[T]) -> MongoCollectionAccessorWrapper[T]:
+        return MongoCollectionAccessorWrapper(self.client, self.config["database"], type_)
+
+    def close(self):
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self.pool_metrics.stats()
 
     def get_equipment_by_id(self, _id: str):
-        with MongoCollectionAccessorWrapper(self.config["database_host"], self.config["database"], EquipmentMongoCollectionAccessor) as access:
+        with self._access(EquipmentMongoCollectionAccessor) as access:
             equipment_from_db = access.get_equipment_data_by_id(_id)
 
         return cast(Equipment, equipment_from_db)
 
-    def get_all_equipments(self):
-        with MongoCollectionAccessorWrapper(self.config["database_host"], self.config["database"], EquipmentMongoCollectionAccessor) as access:
-            equipments_from_db = access.get_all_equipment_data()
+    def get_equipments_by_ids(self, _ids: Sequence[str], projection: Optional[Dict[str, Any]] = None, chunk_size: int = 1000):
+        # Returns the found equipments in the order of _ids, and the ids
+        # that are not in the database, each id once; ids that are not
+        # valid ObjectIds cannot be in it and are missing too
+        unique_ids = list(dict.fromkeys(_ids))
+        valid_ids = [_id for _id in unique_ids if ObjectId.is_valid(_id)]
+
+        found: Dict[str, Dict[str, Any]] = {}
+
+        with self._access(EquipmentMongoCollectionAccessor) as access:
+            for chunk in chunked(valid_ids, chunk_size):
+                found.update(
+                    access.get_equipment_data_by_ids(chunk, projection))
+
+        equipments = [
+            (_id, cast(Equipment, found[_id]))
+            for _id in unique_ids
+            if _id in found
+        ]
+        missing = [_id for _id in unique_ids if _id not in found]
+
+        return equipments, missing
+
+    def get_all_equipments(self, batch_size: Optional[int] = None):
+        with self._access(EquipmentMongoCollectionAccessor) as access:
+            equipments_from_db = access.get_all_equipment_data(batch_size)
 
         for _id, data in equipments_from_db:
             yield _id, cast(Equipment, data)
 
+    def watch_equipment_changes(self, resume_after: Optional[Dict[str, Any]] = None, start_at_operation_time: Optional[Timestamp] = None):
+        # Change stream over the equipment collection; needs a replica set
+        with self._access(EquipmentMongoCollectionAccessor) as access:
+            return access.watch(resume_after, start_at_operation_time)
+
+    def operation_time(self) -> Optional[Timestamp]:
+        # The cluster time now, to start a change stream from; None on a
+        # standalone server, which has no change streams
+        reply = self.client[self.config["database"]].command("ping")
+        return reply.get("operationTime")
+
+    def get_equipment_ids_updated_since(self, since: Optional[datetime]):
+        with self._access(EquipmentMongoCollectionAccessor) as access:
+            return access.get_equipment_ids_updated_since(since)
+
+    def get_last_equipment_update(self) -> Optional[datetime]:
+        with self._access(EquipmentMongoCollectionAccessor) as access:
+            return access.get_last_equipment_update()
+
     def get_unique_ids(self):
-        with MongoCollectionAccessorWrapper(self.config["database_host"], self.config["database"], EquipmentMongoCollectionAccessor) as access:
+        with self._access(EquipmentMongoCollectionAccessor) as access:
             from_db = access.get_equipment_ids()
 
             return [str(id_obj) for id_obj in from_db]
 
-    def get_feedback(self):
-        with MongoCollectionAccessorWrapper(self.config["database_host"], self.config["database"], FeedbackMongoCollectionAccessor) as access:
-            from_db = access.get_all_query_feedback_data()
+    def get_feedback_columns(self, since: Optional[datetime] = None) -> FeedbackColumns:
+        columns = FeedbackColumns([], [], [], since)
 
-        all_feedback: Dict[str, Dict[str, float]] = {}
+        with self._access(FeedbackMongoCollectionAccessor) as access:
+            for group in access.aggregate_query_feedback(since):
+                columns.queries.append(group["_id"]["query"])
+                columns.equipment_ids.append(
+                    str(group["_id"]["equipment_id"]))
+                columns.scores.append(float(group["score"]))
 
-        for _, data in from_db:
-            query, feedback = parse_query_feedback(data)
-            all_feedback.setdefault(query, {})
-            for tag, score in feedback:
-                if tag in all_feedback[query]:
-                    all_feedback[query][tag] = max(
-                        all_feedback[query][tag], score)
-                else:
-                    all_feedback[query][tag] = score
+                last_updated_at = group.get("last_updated_at")
+                if last_updated_at is not None and (columns.watermark is None or last_updated_at > columns.watermark):
+                    columns.watermark = last_updated_at
 
-        return {
-            query: list(scores.items())
-            for query, scores in all_feedback.items()
-        }
+        return columns
+
+    def get_feedback(self):
+        return self.get_feedback_columns().to_feedback()
@@ -1,25 +1,90 @@
 from flask import (
-    Blueprint
+    Blueprint, jsonify, request, url_for
 )
 
-from .extensions import driver
+from .extensions import services
+from .write_queue import EquipmentWriteQueue, QueueFullError
 
 eq_bp = Blueprint('equipment', __name__, url_prefix='/equipment')
 
 
+def not_ready():
+    return jsonify({"error": "Starting up; try again later"}), 503, {"Retry-After": "5"}
+
+
+def read_only():
+    return jsonify({"error": "Served by several workers; equipment changes are read from the database"}), 409
+
+
+def enqueue(operation: str, tags):
+    if not services.accepts_writes():
+        return read_only()
+
+    if not services.is_ready():
+        return not_ready()
+
+    try:
+        job = services.write_queue.submit(operation, tags)
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": url_for("equipment.job_status", job_id=job.id),
+    }), 202
+
+
+@eq_bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id: str):
+    if not services.accepts_writes():
+        return read_only()
+
+    if not services.is_ready():
+        return not_ready()
+
+    job = services.write_queue.get(job_id)
+
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    return jsonify(job.to_dict())
+
+
+@eq_bp.route('/sync', methods=['GET'])
+def sync_metrics():
+    if not services.is_ready():
+        return not_ready()
+
+    index_synchronizer = services.index_synchronizer
+
+    if index_synchronizer is None:
+        return jsonify({"enabled": False})
+
+    return jsonify({"enabled": True, **index_synchronizer.metrics()})
+
+
+@eq_bp.route('/bulk', methods=['POST'])
+def upsert_equipments():
+    body = request.get_json(force=True, silent=True) or {}
+    tags = body.get("tags")
+
+    if not isinstance(tags, list):
+        return jsonify({"error": "Expected a json body with a list of tags"}), 400
+
+    return enqueue(EquipmentWriteQueue.UPSERT, [str(tag) for tag in tags])
+
+
 @eq_bp.route('/<tag>', methods=['POST'])
 def add_equipment(tag: str):
-    driver.add_equipment_by_tag(tag)
-    return "Ok"
+    return enqueue(EquipmentWriteQueue.UPSERT, [tag])
 
 
 @eq_bp.route('/<tag>', methods=['DELETE'])
 def remove_equipment(tag: str):
-    driver.remove_equipment_by_tag(tag)
-    return "Ok"
+    return enqueue(EquipmentWriteQueue.DELETE, [tag])
 
 
 @eq_bp.route('/<tag>', methods=['PUT'])
 def update_equipment(tag: str):
-    driver.update_equipment_by_tag(tag)
-    return "Ok"
+    return enqueue(EquipmentWriteQueue.UPSERT, [tag])
@@ -1,54 +1,493 @@
-"""Initialize any app extensions."""
+"""Initialize any app extensions.
 
-from typing import List
+Nothing heavy happens on import: the serving objects are built by
+ServerServices in stages, either in the background after start() or on
+first access. The heavy modules are imported by the stages themselves.
+"""
+
+from typing import Any, Dict, List, Optional
 from flask_apscheduler import APScheduler
 
-from server.database import MongoDatabaseAccessor, MongoDatabaseConfig
-from ccdr.ranking_model.ranking import EquipmentRankingModel, RankingExtension
-from server.CCDRDriver import CCDRDriver
-from interference.clusters.ecm import ECM
+from server.config import ServerConfig
 
-from interference.interface import Interface
-from interference.scoring import ScoringCalculator
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import traceback
 
-from ccdr.transformers.user_query_transformer import TypeTransformer
-from ccdr.transformers.equipment_transformer import EquipmentTypeTransformer, stringuify
+logger = logging.getLogger('extensions')
+logger.setLevel(logging.INFO)
 
-import json
 
-scheduler = APScheduler()
+def ranker_factory(unique_equipment_ids: List[str], training_epochs, learning_rate):
+    from ccdr.ranking_model.ranking import EquipmentRankingModel
 
-interface = Interface(
-    processor=ECM(distance_threshold=5.),
-    transformers={
-        "query_type": TypeTransformer(modelname='neuralmind/bert-large-portuguese-cased'),
-        "equipment": EquipmentTypeTransformer(modelname='neuralmind/bert-large-portuguese-cased'),
-    },
-    scoring_calculator=ScoringCalculator(),
-)
+    return EquipmentRankingModel(unique_equipment_ids, training_epochs, learning_rate)
 
-with open('config.json', 'r') as f:
-    config: MongoDatabaseConfig = json.load(f)
 
+class ServerServices:
+    """Staged startup of everything the endpoints serve from.
 
-def ranker_factory(unique_equipment_ids: List[str], training_epochs, learning_rate):
+    config     reads config.json
+    models     applies the serving thread budget and loads the
+               SentenceTransformer and the tokenizer
+    services   connects to Mongo and builds the driver, the ranker (and
+               its TensorFlow BERT) and the queues around them
+    index      restores the index from a snapshot or builds it
+    workers    starts the scheduler and the background workers
 
-    return EquipmentRankingModel(unique_equipment_ids, training_epochs, learning_rate)
+    The stages up to models are safe to run before forking, so a
+    preloading server (see gunicorn.conf.py) loads the models once and
+    its workers share their pages copy-on-write; the rest holds sockets,
+    threads and TensorFlow state and must run in each worker.
+
+    Accessing an object runs the stages it needs; start() runs all of
+    them in a background thread so the process answers health probes
+    meanwhile. Searches are served once the index stage is done.
+
+    Each serving process keeps its own index, write queue and scheduler,
+    so several of them (check_workers) only serve reads: equipment
+    changes reach them through index sync, the ranker from the training
+    worker, and none of them writes snapshots.
+    """
+
+    CONFIG = "config"
+    MODELS = "models"
+    SERVICES = "services"
+    INDEX = "index"
+    WORKERS = "workers"
+
+    STAGES = (CONFIG, MODELS, SERVICES, INDEX, WORKERS)
+
+    EQUIPMENT_MODEL = 'neuralmind/bert-large-portuguese-cased'
+    RANKER_MODEL = 'neuralmind/bert-base-portuguese-cased'
+
+    def __init__(self, config_path: str = 'config.json'):
+        self.config_path = config_path
+        # Whether the Flask app starts the stages on its first request;
+        # preloading servers start them after forking instead
+        self.autostart = True
+        # Serving processes sharing the config; see check_workers
+        self.workers = 1
+        # Held while this process accepts equipment changes; see
+        # claim_writes
+        self._writes_lock_file = None
+
+        self.scheduler = APScheduler()
+
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._seconds: Dict[str, float] = {}
+        self._error: Optional[str] = None
+        self._started_at = time.time()
+
+        self._objects: Dict[str, Any] = {}
+
+    def run_until(self, stage: str):
+        if stage in self._seconds:
+            return
+
+        with self._lock:
+            for name in self.STAGES[:self.STAGES.index(stage) + 1]:
+                if name in self._seconds:
+                    continue
+
+                start = time.perf_counter()
+                getattr(self, f"_stage_{name}")()
+                self._seconds[name] = time.perf_counter() - start
+
+                logger.info("Stage %s done in %.1fs",
+                            name, self._seconds[name])
+
+    def _get(self, stage: str, name: str) -> Any:
+        self.run_until(stage)
+        return self._objects[name]
+
+    def preload(self):
+        # Everything that can be shared with forked workers
+        self.run_until(self.MODELS)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def run():
+            try:
+                self.run_until(self.WORKERS)
+            except Exception:
+                self._error = traceback.format_exc()
+                logger.exception("Startup failed")
+
+        self._thread = threading.Thread(
+            target=run, name="startup", daemon=True)
+        self._thread.start()
+
+    def check_workers(self, workers: int):
+        # Fails fast when the config is unsafe for workers processes
+        self.workers = workers
+
+        if workers <= 1:
+            return
+
+        config = self.config
+        problems = []
+
+        if not config.get("index_sync_enabled", False):
+            problems.append(
+                "index_sync_enabled must be true so every worker follows the database")
+
+        if config.get("ranker_training", "in_process") != "worker" or config.get("ranker_worker_spawn", True):
+            problems.append(
+                "ranker_training must be 'worker' with ranker_worker_spawn false, "
+                "and server.ranker_trainer run once on its own")
+
+        if problems:
+            raise ValueError(
+                f"Config is unsafe for {workers} workers: " + "; ".join(problems))
+
+    def accepts_writes(self) -> bool:
+        # Equipment changes are only taken by a single serving process
+        return self.workers <= 1
+
+    def claim_writes(self):
+        # Fails when another process on this host already accepts
+        # equipment changes, e.g. a sibling of a server that started
+        # several workers without telling them (see check_workers)
+        if not self.accepts_writes() or self._writes_lock_file is not None:
+            return
+
+        try:
+            import fcntl
+        except ImportError:
+            logger.info(
+                "fcntl is not available; a second writing process is not detected")
+            return
+
+        path = self.config.get("writer_lock_path", os.path.join(
+            tempfile.gettempdir(), "ccdr-writer.lock"))
+
+        lock_file = open(path, "a")
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                f"Another process already accepts equipment changes ({path}); "
+                "declare every worker with WEB_CONCURRENCY so they only serve reads") from None
+
+        # NOTE: Released by the operating system when the process exits
+        self._writes_lock_file = lock_file
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self._seconds
+
+    def is_ready(self) -> bool:
+        return self.is_done(self.INDEX)
+
+    def is_healthy(self) -> bool:
+        return self._error is None
+
+    def status(self) -> Dict[str, Any]:
+        seconds = dict(self._seconds)
+
+        return {
+            "ready": self.is_ready(),
+            "healthy": self.is_healthy(),
+            "uptime": time.time() - self._started_at,
+            "stages": [
+                {"name": name, "done": name in seconds,
+                    "seconds": seconds.get(name)}
+                for name in self.STAGES
+            ],
+            "error": self._error,
+        }
+
+    def _stage_config(self):
+        with open(self.config_path, 'r') as f:
+            self._objects["config"] = json.load(f)
+
+    def _stage_models(self):
+        from ccdr.transformers.model_registry import default_registry
+        from ccdr.utils.threads import limit_threads
+
+        config = self.config
+
+        # NOTE: Before any model is loaded; TensorFlow fixes its pools on
+        # first use
+        limit_threads(
+            intra_op=config.get("serving_intra_op_threads"),
+            inter_op=config.get("serving_inter_op_threads"),
+            cpus=config.get("serving_cpus"),
+        )
+
+        # NOTE: Only loaded, never run, so no thread pools exist before a
+        # fork; the TensorFlow BERT is left to the services stage as its
+        # runtime does not survive one
+        default_registry.sentence_transformer(self.EQUIPMENT_MODEL)
+        default_registry.tokenizer(self.RANKER_MODEL)
+
+    def _stage_services(self):
+        from server.database import MongoDatabaseAccessor
+        from ccdr.ranking_model.ranking import RankingExtension
+        from server.CCDRDriver import CCDRDriver
+        from server.index_sync import EquipmentIndexSynchronizer
+        from server.write_queue import EquipmentWriteQueue
+        from server.snapshot import SnapshotStore
+        from server.result_cache import SearchResultCache
+        from server.ranker_store import RankerStore
+        from server.ranker_trainer import RankerTrainerProcess
+        from interference.clusters.ecm import ECM
+
+        from interference.interface import Interface
+        from interference.scoring import ScoringCalculator
+
+        from ccdr.transformers.model_registry import default_registry
+        from ccdr.transformers.user_query_transformer import TypeTransformer
+        from ccdr.transformers.equipment_transformer import EquipmentTypeTransformer, stringuify
+        from ccdr.utils.embedding_store import EmbeddingStore
+        from ccdr.utils.query_cache import QueryEmbeddingCache
+        from ccdr.retrieval.candidates import ECMCandidateGenerator, VectorIndexCandidateGenerator
+        from ccdr.retrieval.vector_index import BruteForceIndex
+        from ccdr.retrieval.ivf_index import IVFIndex
+
+        config = self.config
+
+        default_registry.tf_bert_model(self.RANKER_MODEL)
+
+        embedding_store_path = config.get("embedding_store_path")
+
+        equipment_transformer = EquipmentTypeTransformer(
+            modelname=self.EQUIPMENT_MODEL,
+            encode_batch_size=config.get("encode_batch_size", 32),
+            embedding_store=None if embedding_store_path is None else EmbeddingStore(
+                embedding_store_path, self.EQUIPMENT_MODEL),
+        )
+
+        query_cache = QueryEmbeddingCache(
+            max_size=config.get("query_cache_size", 1024),
+            ttl=config.get("query_cache_ttl", 3600.),
+        )
+
+        query_batch_max_size = config.get("query_batch_max_size", 1)
+        query_batch_max_wait = config.get("query_batch_max_wait_ms", 5.) / 1000
+
+        query_transformer = TypeTransformer(
+            modelname=self.EQUIPMENT_MODEL,
+            query_cache=query_cache,
+            max_batch=query_batch_max_size,
+            max_wait=query_batch_max_wait,
+        )
+
+        interface = Interface(
+            processor=ECM(distance_threshold=5.),
+            transformers={
+                "query_type": query_transformer,
+                "equipment": equipment_transformer,
+            },
+            scoring_calculator=ScoringCalculator(),
+        )
+
+        retrieval_backend = config.get("retrieval_backend", "ecm")
+
+        if retrieval_backend == "ecm":
+            candidate_generator = ECMCandidateGenerator(interface)
+        elif retrieval_backend == "brute_force":
+            candidate_generator = VectorIndexCandidateGenerator(
+                BruteForceIndex(storage=config.get(
+                    "retrieval_storage", "float32")),
+                query_transformer,
+                k=config.get("retrieval_k", 100),
+            )
+        elif retrieval_backend == "ivf":
+            candidate_generator = VectorIndexCandidateGenerator(
+                IVFIndex(
+                    n_lists=config.get("retrieval_n_lists"),
+                    n_probe=config.get("retrieval_n_probe", 8),
+                    storage=config.get("retrieval_storage", "float32"),
+                ),
+                query_transformer,
+                k=config.get("retrieval_k", 100),
+            )
+        else:
+            raise ValueError(
+                f"Unknown retrieval_backend {retrieval_backend!r}")
+
+        database_acessor = MongoDatabaseAccessor(config)
+        atexit.register(database_acessor.close)
+
+        query_store_path = config.get("query_store_path")
+
+        driver = CCDRDriver(
+            interface,
+            ranking=RankingExtension(
+                database_accessor=database_acessor,
+                tokenizer_name=self.RANKER_MODEL,
+                model_name=self.RANKER_MODEL,
+                ranker_factory=ranker_factory,
+                query_cache=query_cache,
+                incremental_epochs=config.get("ranker_incremental_epochs", 20),
+                replay_size=config.get("ranker_replay_size", 1024),
+                query_store=None if query_store_path is None else EmbeddingStore(
+                    query_store_path, self.RANKER_MODEL),
+                encode_batch_size=config.get("encode_batch_size", 32),
+                max_batch=query_batch_max_size,
+                max_wait=query_batch_max_wait,
+            ),
+            ranking_stringify_equipment_func=stringuify,
+            database_accessor=database_acessor,
+            equipment_transformer=equipment_transformer,
+            init_batch_size=config.get("init_batch_size", 64),
+            candidate_generator=candidate_generator,
+        )
+
+        snapshot_path = config.get("snapshot_path")
+
+        ranker_training = config.get("ranker_training", "in_process")
+
+        if ranker_training not in ("in_process", "worker"):
+            raise ValueError(f"Unknown ranker_training {ranker_training!r}")
+
+        ranker_store = None
+        ranker_trainer = None
+
+        if ranker_training == "worker":
+            ranker_store_path = config.get("ranker_store_path")
+
+            if ranker_store_path is None:
+                raise ValueError(
+                    "ranker_training 'worker' needs ranker_store_path")
+
+            ranker_store = RankerStore(ranker_store_path)
+
+            if config.get("ranker_worker_spawn", True):
+                ranker_trainer = RankerTrainerProcess(self.config_path)
+
+        self._objects.update(
+            equipment_transformer=equipment_transformer,
+            query_cache=query_cache,
+            query_transformer=query_transformer,
+            interface=interface,
+            database_acessor=database_acessor,
+            driver=driver,
+            snapshot_store=None if snapshot_path is None else SnapshotStore(
+                snapshot_path),
+            ranker_store=ranker_store,
+            ranker_trainer=ranker_trainer,
+            # NOTE: Also holds the cursors; the search_cursor_* keys
+            # configured the cursor store it replaced
+            result_cache=SearchResultCache(
+                max_entries=config.get("search_cache_max_entries", config.get(
+                    "search_cursor_max_entries", 256)),
+                ttl=config.get("search_cache_ttl", config.get(
+                    "search_cursor_ttl", 60.)),
+            ),
+            write_queue=EquipmentWriteQueue(
+                driver,
+                max_depth=config.get("write_queue_max_depth", 1000),
+                max_batch=config.get("write_queue_max_batch", 64),
+            ),
+            index_synchronizer=None if not config.get("index_sync_enabled", False) else EquipmentIndexSynchronizer(
+                driver,
+                database_acessor,
+                coalesce_seconds=config.get("index_sync_coalesce_seconds", 1.),
+                poll_interval=config.get("index_sync_poll_interval", 5.),
+            ),
+        )
+
+    def _stage_index(self):
+        driver = self.driver
+        snapshot_store = self.snapshot_store
+
+        # NOTE: Before the index is built, so the changes made meanwhile
+        # are synced once the workers start
+        if self.index_synchronizer is not None:
+            self.index_synchronizer.mark_start()
+
+        if snapshot_store is None or not snapshot_store.restore(driver):
+            driver.init_processor()
+
+            if snapshot_store is not None and self.accepts_writes():
+                snapshot_store.save(driver)
+
+        # NOTE: After the snapshot, whose ranker may be older
+        if self.ranker_store is not None:
+            self.ranker_store.load_latest(driver.ranking)
+
+    def _stage_workers(self):
+        # pylint: disable=C0415, W0611
+        from . import ranking  # noqa: F401
+
+        self.scheduler.start()
+
+        self.write_queue.start()
+
+        if self.index_synchronizer is not None:
+            self.index_synchronizer.start()
+
+        if self.ranker_trainer is not None:
+            self.ranker_trainer.start()
+
+    @property
+    def config(self) -> ServerConfig:
+        return self._get(self.CONFIG, "config")
+
+    @property
+    def equipment_transformer(self):
+        return self._get(self.SERVICES, "equipment_transformer")
+
+    @property
+    def query_cache(self):
+        return self._get(self.SERVICES, "query_cache")
+
+    @property
+    def query_transformer(self):
+        return self._get(self.SERVICES, "query_transformer")
+
+    @property
+    def interface(self):
+        return self._get(self.SERVICES, "interface")
+
+    @property
+    def database_acessor(self):
+        return self._get(self.SERVICES, "database_acessor")
+
+    @property
+    def driver(self):
+        # NOTE: Built, not necessarily indexed; use is_ready for that
+        return self._get(self.SERVICES, "driver")
+
+    @property
+    def snapshot_store(self):
+        return self._get(self.SERVICES, "snapshot_store")
+
+    @property
+    def ranker_store(self):
+        return self._get(self.SERVICES, "ranker_store")
+
+    @property
+    def ranker_trainer(self):
+        return self._get(self.SERVICES, "ranker_trainer")
+
+    @property
+    def result_cache(self):
+        return self._get(self.SERVICES, "result_cache")
+
+    @property
+    def write_queue(self):
+        return self._get(self.SERVICES, "write_queue")
+
+    @property
+    def index_synchronizer(self):
+        return self._get(self.SERVICES, "index_synchronizer")
+
+
+services = ServerServices()
 
-database_acessor = MongoDatabaseAccessor(config)
-
-driver = CCDRDriver(
-    interface,
-    ranking=RankingExtension(
-        database_accessor=database_acessor,
-        tokenizer_name="neuralmind/bert-base-portuguese-cased",
-        model_name="neuralmind/bert-base-portuguese-cased",
-        ranker_factory=ranker_factory
-    ),
-    ranking_stringify_equipment_func=stringuify,
-    database_accessor=database_acessor,
-)
-
-driver.init_processor()
+scheduler = services.scheduler
 
 # ... any other stuff.. db, caching, sessions, etc.
@@ -0,0 +1,22 @@
+from flask import Blueprint, jsonify
+
+from .extensions import services
+
+h_bp = Blueprint('health', __name__)
+
+
+@h_bp.route('/health', methods=['GET'])
+def health():
+    # Liveness: answers while the stages still run; fails only when
+    # startup failed, so the process gets restarted
+    status = services.status()
+
+    return jsonify(status), 200 if status["healthy"] else 500
+
+
+@h_bp.route('/ready', methods=['GET'])
+def ready():
+    # Readiness: searches are served once the index is loaded
+    status = services.status()
+
+    return jsonify(status), 200 if status["ready"] else 503
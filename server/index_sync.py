@@ -0,0 +1,314 @@
+from server.CCDRDriver import CCDRDriver
+from server.database import EQUIPMENT_WATERMARK_OVERLAP, MongoDatabaseAccessor
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure, PyMongoError
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('index_sync')
+logger.setLevel(logging.INFO)
+
+# Server error codes of a change stream that cannot resume from where it
+# was asked to
+CHANGE_STREAM_FATAL = 280
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+@dataclass
+class PendingChange:
+    operation: str
+    # When the change happened in the database (epoch seconds)
+    happened_at: float
+    # When we first saw a change to this tag since the last flush
+    first_seen_at: float
+
+
+class EquipmentIndexSynchronizer:
+    """Keeps the driver's index in sync with the equipment collection.
+
+    Tails a change stream when the server supports it and otherwise polls
+    for documents whose updatedAt is past a watermark. Either starts from
+    where mark_start was called, before the index was built. Changes to
+    the same tag are coalesced and applied together in embedding batches;
+    a batch that fails to apply is kept and retried.
+    """
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+    def __init__(
+        self,
+        driver: CCDRDriver,
+        database_accessor: MongoDatabaseAccessor,
+        coalesce_seconds: float = 1.,
+        max_batch: int = 256,
+        poll_interval: float = 5.,
+        reconcile_every: int = 12,
+    ):
+        self.driver = driver
+        self.database_accessor = database_accessor
+        self.coalesce_seconds = coalesce_seconds
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        # Polling cannot see deletions; every reconcile_every polls the
+        # indexed tags are diffed against the collection instead
+        self.reconcile_every = reconcile_every
+
+        self.mode: Optional[str] = None
+
+        self._pending: Dict[str, PendingChange] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._resume_token: Optional[Dict[str, Any]] = None
+        self._start_at: Optional[Timestamp] = None
+        self._watermark: Optional[datetime] = None
+        # updatedAt of the tags polled within the overlap before the
+        # watermark, which every poll reads again
+        self._polled: Dict[str, datetime] = {}
+        self._marked = False
+        self._retry_at = 0.
+
+        self._metrics_lock = threading.Lock()
+        self.applied = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_lag = 0.
+        self.max_lag = 0.
+        self.last_applied_at: Optional[float] = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+
+        self._thread = threading.Thread(
+            target=self._run, name="equipment-index-sync", daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def mark_start(self):
+        # Where syncing starts from, for both the change stream and
+        # polling; everything older is expected in the index
+        self._start_at = self.database_accessor.operation_time()
+
+        self._watermark = self.database_accessor.get_last_equipment_update()
+        self._marked = True
+
+    def _run(self):
+        if not self._marked:
+            self.mark_start()
+
+        try:
+            self._watch()
+        except OperationFailure as e:
+            logger.info(
+                "Change streams unavailable (%s); falling back to polling", e)
+            self._poll()
+
+    def _watch(self):
+        self.mode = "change_stream"
+        opened = False
+        resync = False
+
+        while not self._stop.is_set():
+            try:
+                if resync:
+                    self._resync()
+                    resync = False
+
+                with self.database_accessor.watch_equipment_changes(self._resume_token, self._start_at) as stream:
+                    opened = True
+
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+
+                        if change is not None:
+                            self._record_change(change)
+
+                        self._resume_token = stream.resume_token
+                        self._maybe_flush()
+
+            except OperationFailure as e:
+                # NOTE: Unless the stream lost its place (its history
+                # rolled off the oplog), a failure before any stream
+                # opened means the server has no change streams
+                if not opened and e.code not in (CHANGE_STREAM_FATAL, CHANGE_STREAM_HISTORY_LOST):
+                    raise
+
+                logger.exception("Change stream cannot resume; resyncing")
+                resync = True
+
+            except PyMongoError:
+                logger.exception("Change stream failed; resuming")
+                time.sleep(self.poll_interval)
+
+        self._flush()
+
+    def _record_change(self, change: Dict[str, Any]):
+        operation = change["operationType"]
+
+        if operation in ("insert", "update", "replace"):
+            pending_operation = self.UPSERT
+        elif operation == "delete":
+            pending_operation = self.DELETE
+        else:
+            return
+
+        cluster_time = change.get("clusterTime")
+        happened_at = cluster_time.time if cluster_time is not None else time.time()
+
+        self._record(str(change["documentKey"]["_id"]),
+                     pending_operation, happened_at)
+
+    def _record(self, tag: str, operation: str, happened_at: float):
+        previous = self._pending.get(tag)
+
+        self._pending[tag] = PendingChange(
+            operation=operation,
+            happened_at=happened_at if previous is None else min(
+                previous.happened_at, happened_at),
+            first_seen_at=time.time() if previous is None else previous.first_seen_at,
+        )
+
+    def _poll(self):
+        self.mode = "polling"
+        polls = 0
+
+        while not self._stop.is_set():
+            try:
+                for tag, updated_at in self.database_accessor.get_equipment_ids_updated_since(self._watermark):
+                    if self._polled.get(tag) == updated_at:
+                        continue
+
+                    self._polled[tag] = updated_at
+                    self._record(tag, self.UPSERT, updated_at.timestamp())
+
+                    if self._watermark is None or updated_at > self._watermark:
+                        self._watermark = updated_at
+
+                if self._watermark is not None:
+                    horizon = self._watermark - EQUIPMENT_WATERMARK_OVERLAP
+                    self._polled = {
+                        tag: updated_at for tag, updated_at in self._polled.items()
+                        if updated_at >= horizon
+                    }
+
+                polls += 1
+                if polls % self.reconcile_every == 0:
+                    self._reconcile_deletions()
+
+                self._flush()
+
+            except PyMongoError:
+                logger.exception("Polling for equipment changes failed")
+
+            self._stop.wait(self.poll_interval)
+
+    def _resync(self):
+        # The changes a stream lost are unknown: every tag in the
+        # collection is upserted (the driver skips the unchanged ones) and
+        # the indexed ones gone from it removed, then a new stream starts
+        # from before the resync
+        self._resume_token = None
+        self._start_at = self.database_accessor.operation_time()
+
+        in_database = set(self.database_accessor.get_unique_ids())
+        now = time.time()
+
+        for tag in in_database:
+            self._record(tag, self.UPSERT, now)
+
+        self._reconcile_deletions(in_database)
+
+    def _reconcile_deletions(self, in_database: Optional[Set[str]] = None):
+        if in_database is None:
+            in_database = set(self.database_accessor.get_unique_ids())
+
+        for tag in self.driver.indexed_tags():
+            if tag not in in_database:
+                self._record(tag, self.DELETE, time.time())
+
+    def _maybe_flush(self):
+        if not self._pending or time.time() < self._retry_at:
+            return
+
+        oldest = min(change.first_seen_at for change in self._pending.values())
+
+        if len(self._pending) >= self.max_batch or time.time() - oldest >= self.coalesce_seconds:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+
+        upserts = [tag for tag, change in pending.items()
+                   if change.operation == self.UPSERT]
+        removals = [tag for tag, change in pending.items()
+                    if change.operation == self.DELETE]
+
+        try:
+            self.driver.apply_equipment_changes(upserts, removals)
+        except Exception:
+            logger.exception("Applying %d equipment changes failed; retrying in %.0fs",
+                             len(pending), self.poll_interval)
+            self._restore_pending(pending)
+
+            with self._metrics_lock:
+                self.failed_batches += 1
+
+            return
+
+        now = time.time()
+        lags = [now - change.happened_at for change in pending.values()]
+
+        with self._metrics_lock:
+            self.applied += len(pending)
+            self.batches += 1
+            self.last_lag = max(lags)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.last_applied_at = now
+
+        logger.info("Applied %d upserts and %d removals (lag %.2fs)",
+                    len(upserts), len(removals), self.last_lag)
+
+    def _restore_pending(self, pending: Dict[str, PendingChange]):
+        # NOTE: Changes recorded since are newer; their operation wins
+        for tag, change in pending.items():
+            newer = self._pending.get(tag)
+
+            self._pending[tag] = change if newer is None else PendingChange(
+                operation=newer.operation,
+                happened_at=change.happened_at,
+                first_seen_at=change.first_seen_at,
+            )
+
+        self._retry_at = time.time() + self.poll_interval
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._metrics_lock:
+            return {
+                "mode": self.mode,
+                "pending": len(self._pending),
+                "applied": self.applied,
+                "batches": self.batches,
+                "failed_batches": self.failed_batches,
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+                "last_applied_at": self.last_applied_at,
+            }
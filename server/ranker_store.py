@@ -0,0 +1,99 @@
+from ccdr.ranking_model.ranking import RankingExtension
+from server.versioned_dirs import claim_version, point_current, read_current, version_dirs
+
+from typing import List, Optional, Tuple
+
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger('ranker_store')
+logger.setLevel(logging.INFO)
+
+
+class RankerStore:
+    """Versioned ranker weights handed from the training worker to the
+    servers.
+
+    The worker publishes each trained ranker (RankingExtension.save_ranker)
+    into a ranker-NNNNNN directory it claims and then atomically replaces
+    the CURRENT file to point at it; servers poll CURRENT and load
+    versions newer than the one they have. As with snapshots, readers only
+    ever see complete versions.
+    """
+
+    CURRENT_FILE = "CURRENT"
+
+    def __init__(self, root: str, keep: int = 3):
+        self.root = root
+        self.keep = keep
+        # Version this process last published or loaded
+        self.loaded_version = 0
+
+        os.makedirs(root, exist_ok=True)
+
+    def _version_dirs(self) -> List[str]:
+        return version_dirs(self.root, "ranker")
+
+    def current(self) -> Optional[Tuple[int, str]]:
+        name = read_current(self.root, self.CURRENT_FILE)
+
+        if name is None:
+            return None
+
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(path):
+            return None
+
+        return int(name.split("-")[1]), path
+
+    def publish(self, ranking: RankingExtension) -> str:
+        # NOTE: The version is claimed by creating its directory, so
+        # concurrent publishers never write into the same one
+        version, name = claim_version(self.root, "ranker")
+        path = os.path.join(self.root, name)
+
+        try:
+            ranking.save_ranker(path)
+
+            with open(os.path.join(path, "manifest.json"), "w") as f:
+                json.dump({"version": version, "created_at": time.time()}, f)
+
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        point_current(self.root, name, self.CURRENT_FILE)
+
+        # NOTE: Servers may still be loading an older version; keep a few,
+        # and never the ones newer than CURRENT, still being written
+        current = read_current(self.root, self.CURRENT_FILE)
+        for old in self._version_dirs()[:-self.keep]:
+            if current is not None and old < current:
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+
+        self.loaded_version = version
+        logger.info("Published %s", name)
+
+        return path
+
+    def load_latest(self, ranking: RankingExtension) -> bool:
+        # Loads the current version into ranking if it is newer than the
+        # one loaded before; True when it did
+        current = self.current()
+
+        if current is None or current[0] <= self.loaded_version:
+            return False
+
+        version, path = current
+        start = time.perf_counter()
+
+        ranking.load_ranker(path)
+        self.loaded_version = version
+
+        logger.info("Loaded ranker version %d in %.1fs",
+                    version, time.perf_counter() - start)
+
+        return True
@@ -0,0 +1,138 @@
+"""Ranker training worker.
+
+Trains the ranker on feedback outside of the serving processes, so
+training never competes with searches for the GIL or their threads, and
+publishes each trained ranker to a RankerStore the servers hot-load from:
+
+    python -m server.ranker_trainer --config config.json
+"""
+
+from server.config import ServerConfig
+from server.database import FeedbackColumns, MongoDatabaseAccessor
+from server.ranker_store import RankerStore
+from ccdr.ranking_model.ranking import EquipmentRankingModel, FeedbackRows, RankingExtension, rows_to_feedback
+from ccdr.utils.embedding_store import EmbeddingStore
+from ccdr.utils.threads import limit_threads
+
+from typing import List, Optional
+
+import argparse
+import atexit
+import json
+import logging
+import signal
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger('ranker_trainer')
+logger.setLevel(logging.INFO)
+
+
+class RankerTrainerProcess:
+    """Runs the training worker as a child of the serving process."""
+
+    def __init__(self, config_path: str = "config.json"):
+        self.config_path = config_path
+        self._process: Optional[subprocess.Popen] = None
+
+    def start(self):
+        if self._process is not None:
+            return
+
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "server.ranker_trainer",
+             "--config", self.config_path],
+        )
+        atexit.register(self.stop)
+
+        logger.info("Started ranker trainer (pid %d)", self._process.pid)
+
+    def stop(self, timeout: float = 10.):
+        if self._process is None:
+            return
+
+        self._process.terminate()
+
+        try:
+            self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+        self._process = None
+
+
+def run(config: ServerConfig, stop: threading.Event):
+    limit_threads(
+        intra_op=config.get("trainer_intra_op_threads"),
+        inter_op=config.get("trainer_inter_op_threads"),
+        cpus=config.get("trainer_cpus"),
+    )
+
+    database_acessor = MongoDatabaseAccessor(config)
+    atexit.register(database_acessor.close)
+
+    query_store_path = config.get("query_store_path")
+
+    ranking = RankingExtension(
+        database_accessor=database_acessor,
+        tokenizer_name="neuralmind/bert-base-portuguese-cased",
+        model_name="neuralmind/bert-base-portuguese-cased",
+        ranker_factory=EquipmentRankingModel,
+        incremental_epochs=config.get("ranker_incremental_epochs", 20),
+        replay_size=config.get("ranker_replay_size", 1024),
+        query_store=None if query_store_path is None else EmbeddingStore(
+            query_store_path, 'neuralmind/bert-base-portuguese-cased'),
+        encode_batch_size=config.get("encode_batch_size", 32),
+    )
+
+    store = RankerStore(config["ranker_store_path"])  # type: ignore
+
+    # NOTE: Resumes from the last published ranker; learn() then only
+    # trains on feedback it was not trained on
+    store.load_latest(ranking)
+
+    rows: FeedbackRows = {}
+    watermark = None
+
+    while not stop.is_set():
+        try:
+            columns: FeedbackColumns = database_acessor.get_feedback_columns(
+                watermark)
+            columns.merge_into(rows)
+            watermark = columns.watermark
+
+            trained_version = ranking.ranker_version
+            ranking.learn(rows_to_feedback(rows))
+
+            if ranking.ranker_version != trained_version:
+                store.publish(ranking)
+
+        except Exception:
+            logger.exception("Training on feedback failed")
+
+        stop.wait(config.get("ranker_worker_interval", 60))
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.json")
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as f:
+        config: ServerConfig = json.load(f)
+
+    if config.get("ranker_store_path") is None:
+        parser.error("ranker_store_path is not set in the config")
+
+    stop = threading.Event()
+
+    # NOTE: SIGTERM, as sent by RankerTrainerProcess.stop, ends the loop
+    # between training rounds
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    run(config, stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,39 @@
-from .extensions import driver, scheduler
-
-#TODO: Put correct time
-@scheduler.task(
-    trigger="interval",
-    id="feedback",
-    seconds=60,
-    max_instances=1,
-)
-def learn_with_feedback():
-    driver.learn_with_feedback()
\ No newline at end of file
+from .extensions import scheduler, services
+
+# NOTE: Imported by the workers stage, once everything below is built
+config = services.config
+driver = services.driver
+ranker_store = services.ranker_store
+snapshot_store = services.snapshot_store
+
+if ranker_store is None:
+    #TODO: Put correct time
+    @scheduler.task(
+        trigger="interval",
+        id="feedback",
+        seconds=60,
+        max_instances=1,
+    )
+    def learn_with_feedback():
+        driver.learn_with_feedback()
+else:
+    # NOTE: The worker trains; this process only swaps in what it publishes
+    @scheduler.task(
+        trigger="interval",
+        id="ranker_reload",
+        seconds=config.get("ranker_poll_interval", 10),
+        max_instances=1,
+    )
+    def reload_ranker():
+        ranker_store.load_latest(driver.ranking)
+
+
+if snapshot_store is not None and services.accepts_writes():
+    @scheduler.task(
+        trigger="interval",
+        id="snapshot",
+        seconds=config.get("snapshot_interval", 600),
+        max_instances=1,
+    )
+    def save_snapshot():
+        snapshot_store.save(driver)
@@ -0,0 +1,171 @@
+from ccdr.retrieval.filters import SearchFilter
+from ccdr.retrieval.results import RankedResults
+from ccdr.utils.query_cache import normalize_query
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import base64
+import json
+import threading
+import time
+import uuid
+
+Version = Tuple[int, ...]
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+@dataclass
+class _Entry:
+    key: Hashable
+    results: RankedResults
+    created_at: float
+
+
+class SearchResultCache:
+    """Short-lived cache of ranked result sets.
+
+    Result sets are keyed by the normalized query, the filter and the
+    driver's results version (index and ranker versions), so repeated
+    queries and later pages are served from memory. Once the version
+    changes, because equipments changed or the ranker was swapped, every
+    entry is dropped and the cursors naming them stop resolving.
+
+    Dropping every entry is deliberate: an added or re-encoded equipment
+    can enter any result set and a new ranker reorders all of them, so no
+    entry is known to be unaffected without ranking it again. Under a
+    steady stream of equipment writes the hit rate falls accordingly.
+
+    This is also the only store of cursors: a cursor is an opaque token
+    naming a result set and the offset of the next page. At most
+    max_entries result sets are kept (least recently used go first) and
+    each lives for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 60.,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._ids: Dict[Hashable, str] = {}
+        self._version: Optional[Version] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(query: str, search_filter: Optional[SearchFilter]) -> Hashable:
+        return normalize_query(query), search_filter
+
+    def _is_current(self, version: Version) -> bool:
+        # Moves the cache to a newer version, dropping every entry; False
+        # for versions older than the cache's
+        if self._version is not None and version < self._version:
+            return False
+
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+
+            self._entries.clear()
+            self._ids.clear()
+            self._version = version
+
+        return True
+
+    def _forget(self, entry_id: str, entry: _Entry):
+        if self._ids.get(entry.key) == entry_id:
+            del self._ids[entry.key]
+
+    def _lookup(self, entry_id: str) -> Optional[_Entry]:
+        entry = self._entries.get(entry_id)
+
+        if entry is None:
+            return None
+
+        if self.clock() - entry.created_at > self.ttl:
+            del self._entries[entry_id]
+            self._forget(entry_id, entry)
+            return None
+
+        self._entries.move_to_end(entry_id)
+        return entry
+
+    def get_or_compute(self, key: Hashable, version: Version, compute: Callable[[], RankedResults]) -> Tuple[Optional[str], RankedResults]:
+        # The id and results stored for key, computing them on a miss; the
+        # id is None when the results were computed for an outdated
+        # version and could not be stored
+        with self._lock:
+            entry_id = self._ids.get(key) if self._is_current(
+                version) else None
+            entry = None if entry_id is None else self._lookup(entry_id)
+
+            if entry_id is not None and entry is not None:
+                self.hits += 1
+                return entry_id, entry.results
+
+            self.misses += 1
+
+        # NOTE: Ranked outside of the lock; concurrent misses on the same
+        # key both rank it and the last one wins
+        results = compute()
+
+        with self._lock:
+            if not self._is_current(version):
+                return None, results
+
+            entry_id = uuid.uuid4().hex
+            self._entries[entry_id] = _Entry(key, results, self.clock())
+            self._ids[key] = entry_id
+
+            while len(self._entries) > self.max_entries:
+                self._forget(*self._entries.popitem(last=False))
+
+        return entry_id, results
+
+    def get(self, entry_id: str, query: str, version: Version) -> Optional[RankedResults]:
+        # The results a cursor names, if they are still current and were
+        # ranked for this query
+        with self._lock:
+            entry = self._lookup(entry_id) if self._is_current(
+                version) else None
+
+            if entry is None or entry.key[0] != normalize_query(query):  # type: ignore
+                return None
+
+            return entry.results
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    @staticmethod
+    def encode_cursor(entry_id: str, offset: int) -> str:
+        payload = json.dumps({"id": entry_id, "offset": offset})
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, int]:
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(
+                cursor.encode("ascii")).decode("utf-8"))
+            return str(payload["id"]), int(payload["offset"])
+        except (ValueError, KeyError, TypeError) as e:
+            raise InvalidCursorError("Malformed cursor") from e
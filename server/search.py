@@ -1,16 +1,155 @@
 from flask import (
-    Blueprint, request
+    Blueprint, Response, jsonify, request, stream_with_context
 )
 
+from typing import Optional, Tuple
+
 import json
+import math
+
+from ccdr.retrieval.filters import SearchFilter
+from ccdr.retrieval.results import RankedResults
 
-from .extensions import driver
+from .extensions import services
+from .result_cache import InvalidCursorError, SearchResultCache
 
 s_bp = Blueprint('search', __name__, url_prefix='/search')
 
+def _values(args, name: str) -> Optional[Tuple[str, ...]]:
+    # Repeated (?area=saude&area=social) or comma separated (?area=saude,social)
+    values = [value.strip() for arg in args.getlist(name)
+              for value in arg.split(",") if value.strip()]
+
+    return tuple(values) if values else None
+
+
+def _number(text: str, name: str) -> float:
+    # NOTE: float() also takes nan and inf, which no filter can compare
+    try:
+        value = float(text)
+    except ValueError:
+        raise ValueError(f"{name} must be a number") from None
+
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be a finite number")
+
+    return value
+
+
+def parse_search_filter(args) -> SearchFilter:
+    # args is the query string multidict of either Flask or Starlette
+    bbox = None
+    if 'bbox' in args:
+        values = args['bbox'].split(",")
+
+        if len(values) != 4:
+            raise ValueError("bbox must be min_lat,min_long,max_lat,max_long")
+
+        bbox = tuple(_number(value, 'bbox') for value in values)
+
+        if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("bbox minimums must not be past its maximums")
+
+    radius = None
+    if 'radius' in args:
+        if 'lat' not in args or 'long' not in args:
+            raise ValueError("radius needs lat and long")
+
+        radius = (_number(args['lat'], 'lat'), _number(
+            args['long'], 'long'), _number(args['radius'], 'radius'))
+
+        if radius[2] < 0:
+            raise ValueError("radius must not be negative")
+
+    return SearchFilter(
+        groups=_values(args, 'group'),
+        areas=_values(args, 'area'),
+        bbox=bbox,  # type: ignore
+        radius=radius,
+    )
+
+
+def page_bounds(results: RankedResults, offset: int, limit: int, page_size: int, entry_id: Optional[str]) -> Tuple[int, int, Optional[str]]:
+    # Start and end of the page past offset, and the cursor of the next
+    # one when there is more to walk through and the results are cached
+    offset = max(offset, 0)
+    end = len(results) if limit <= 0 else min(limit, len(results))
+    page_end = end if page_size <= 0 else min(offset + page_size, end)
+
+    next_cursor = None
+    if page_end < end and entry_id is not None:
+        next_cursor = SearchResultCache.encode_cursor(entry_id, page_end)
+
+    return offset, page_end, next_cursor
+
+
+def ndjson_lines(results: RankedResults, offset: int, end: int, next_cursor: Optional[str]):
+    # NOTE: The best block is sorted and sent first; the rest are only
+    # sorted once the client has read that far
+    stream_block = services.config.get("search_stream_block", 100)
+
+    for block in results.iter_pages(offset, stream_block, end):
+        yield "".join(json.dumps(result) + "\n" for result in block)
+
+    if next_cursor is not None:
+        yield json.dumps({"next_cursor": next_cursor}) + "\n"
+
 
 @s_bp.route('/<query>', methods=['GET'])
 def search(query: str):
+    # Plain requests answer the limit results past offset (limit 0 is all
+    # of them); page_size, cursor and stream switch to paged and/or NDJSON
+    # responses, where limit caps the results walked through
+    offset = request.args.get('offset', default=0, type=int)
     limit = request.args.get('limit', default=0, type=int)
-    rankings = driver.get_query_rankings(query, limit)
-    return json.dumps(rankings)
+    page_size = request.args.get('page_size', default=0, type=int)
+    cursor = request.args.get('cursor')
+    stream = request.args.get('stream', default=0, type=int) != 0
+
+    if not services.is_ready():
+        return jsonify({"error": "Starting up; try again later"}), 503, {"Retry-After": "5"}
+
+    driver = services.driver
+    result_cache = services.result_cache
+
+    if cursor is not None:
+        try:
+            entry_id, offset = SearchResultCache.decode_cursor(cursor)
+        except InvalidCursorError as e:
+            return jsonify({"error": str(e)}), 400
+
+        results = result_cache.get(
+            entry_id, query, driver.results_version())
+
+        if results is None:
+            return jsonify({"error": "Cursor expired; run the query again"}), 410
+
+    else:
+        try:
+            search_filter = parse_search_filter(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        entry_id, results = result_cache.get_or_compute(
+            SearchResultCache.key(query, search_filter),
+            driver.results_version(),
+            lambda: driver.rank_query(query, search_filter),
+        )
+
+        if page_size <= 0 and not stream:
+            return json.dumps(results.page(max(offset, 0), limit))
+
+    offset, page_end, next_cursor = page_bounds(
+        results, offset, limit, page_size, entry_id)
+
+    if stream:
+        return Response(
+            stream_with_context(ndjson_lines(
+                results, offset, page_end, next_cursor)),
+            mimetype="application/x-ndjson",
+        )
+
+    return jsonify({
+        "results": results.page(offset, page_end - offset) if page_end > offset else [],
+        "next_cursor": next_cursor,
+    })
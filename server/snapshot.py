@@ -0,0 +1,219 @@
+from server.versioned_dirs import claim_version, point_current, read_current, version_dirs
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import numpy as np
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+
+if TYPE_CHECKING:
+    # NOTE: Only for annotations; importing the driver loads TensorFlow
+    from server.CCDRDriver import CCDRDriver
+
+logger = logging.getLogger('snapshot')
+logger.setLevel(logging.INFO)
+
+
+SNAPSHOT_FORMAT_VERSION = 3
+
+
+def _write_json(path: str, value: Any):
+    with open(path, "w") as f:
+        json.dump(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_pickle(path: str, value: Any):
+    with open(path, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class SnapshotStore:
+    """Versioned snapshots of the serving index.
+
+    Each snapshot is a directory holding the tag map, the instance
+    embeddings (a .npy loaded memory-mapped), the candidate generator state
+    (ECM clusters or vector index) and the ranker weights. Its version is
+    claimed by creating the directory, so concurrent savers never share
+    one, and the CURRENT file is only replaced to point at it once it is
+    complete, so readers only ever see complete snapshots.
+    """
+
+    CURRENT_FILE = "CURRENT"
+
+    def __init__(self, root: str, keep: int = 2):
+        self.root = root
+        self.keep = keep
+
+        os.makedirs(root, exist_ok=True)
+
+    def _snapshot_dirs(self) -> List[str]:
+        return version_dirs(self.root, "snapshot")
+
+    def current(self) -> Optional[str]:
+        name = read_current(self.root, self.CURRENT_FILE)
+
+        if name is None:
+            return None
+
+        path = os.path.join(self.root, name)
+        return path if os.path.isdir(path) else None
+
+    def save(self, driver: "CCDRDriver") -> str:
+        start = time.perf_counter()
+
+        version, name = claim_version(self.root, "snapshot")
+        path = os.path.join(self.root, name)
+
+        try:
+            candidates_path = os.path.join(path, "candidates")
+            os.makedirs(candidates_path)
+
+            # NOTE: Equipment writes only wait while the index is copied
+            # in memory, so the files below all describe the same index
+            # version; nothing is written to disk under the lock
+            with driver.index_lock.read():
+                tags, digests, embeddings = driver.export_index()
+                candidate_state = driver.candidate_generator.state()
+                attributes = driver.attribute_index.state()
+
+            has_candidate_state = driver.candidate_generator.save(
+                candidate_state, candidates_path)
+
+            np.save(os.path.join(path, "embeddings.npy"), embeddings)
+            _write_json(os.path.join(path, "tags.json"),
+                        {"tags": tags, "digests": digests})
+
+            if not has_candidate_state:
+                logger.info(
+                    "Candidate generator state not saved; the snapshot will rebuild it on load")
+
+            _write_json(os.path.join(path, "attributes.json"), attributes)
+
+            _write_pickle(os.path.join(path, "feedback.pkl"),
+                          driver.feedback_state())
+
+            driver.ranking.save_ranker(os.path.join(path, "ranker"))
+
+            equipment_transformer = driver.equipment_transformer
+            _write_json(os.path.join(path, "manifest.json"), {
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "version": version,
+                "created_at": time.time(),
+                "equipment_model": None if equipment_transformer is None else equipment_transformer.modelname,
+                "count": len(tags),
+                "retrieval_backend": type(driver.candidate_generator).__name__,
+                "has_candidate_state": has_candidate_state,
+                "embeddings_from_index": driver.candidate_generator.stores_embeddings,
+            })
+
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        point_current(self.root, name, self.CURRENT_FILE)
+
+        # NOTE: Only versions older than the current one; newer ones may
+        # still be written by another process
+        current = read_current(self.root, self.CURRENT_FILE)
+        for old in self._snapshot_dirs()[:-self.keep]:
+            if current is not None and old < current:
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+
+        logger.info("Saved %s with %d equipments in %.1fs",
+                    name, len(tags), time.perf_counter() - start)
+
+        return path
+
+    def _read_manifest(self, path: str) -> Optional[Dict[str, Any]]:
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            logger.info("Ignoring %s: format version %s, expected %s",
+                        path, manifest.get("format_version"), SNAPSHOT_FORMAT_VERSION)
+            return None
+
+        return manifest
+
+    def restore(self, driver: "CCDRDriver") -> bool:
+        # Loads the current snapshot into the driver and reconciles it with
+        # the database; False when there is no usable snapshot
+        path = self.current()
+
+        if path is None:
+            return False
+
+        start = time.perf_counter()
+
+        # NOTE: Every file is read before the driver is touched, so an
+        # unreadable snapshot leaves it as it was. The candidate generator
+        # is only replaced once it loaded whole, as the last step, and the
+        # ranker is read aside and only published after it
+        try:
+            manifest = self._read_manifest(path)
+            if manifest is None:
+                return False
+
+            equipment_transformer = driver.equipment_transformer
+            if equipment_transformer is not None and manifest["equipment_model"] != equipment_transformer.modelname:
+                logger.info("Ignoring %s: built with %s",
+                            path, manifest["equipment_model"])
+                return False
+
+            with open(os.path.join(path, "tags.json"), "r") as f:
+                tag_map = json.load(f)
+
+            tags, digests = tag_map["tags"], tag_map["digests"]
+
+            # NOTE: Memory mapped; rows are only paged in when touched
+            embeddings = np.load(os.path.join(
+                path, "embeddings.npy"), mmap_mode="r")
+
+            if not len(tags) == len(digests) == len(embeddings):
+                raise ValueError(
+                    f"{len(tags)} tags, {len(digests)} digests and {len(embeddings)} embeddings")
+
+            with open(os.path.join(path, "attributes.json"), "r") as f:
+                attributes = json.load(f)
+
+            with open(os.path.join(path, "feedback.pkl"), "rb") as f:
+                rows, watermark = pickle.load(f)
+
+            ranker, trained_rows = driver.ranking.read_ranker(
+                os.path.join(path, "ranker"))
+
+            candidates_restored = (
+                manifest["has_candidate_state"]
+                and manifest["retrieval_backend"] == type(driver.candidate_generator).__name__
+                and driver.candidate_generator.load(os.path.join(path, "candidates"))
+            )
+
+        except Exception:
+            logger.exception("Ignoring %s: unreadable snapshot", path)
+            return False
+
+        driver.ranking.publish(ranker, trained_rows)
+
+        if not candidates_restored and manifest.get("embeddings_from_index", False):
+            # NOTE: Normalized (and maybe quantized) by the vector index,
+            # so not reused to build another backend; the equipments are
+            # encoded again, mostly from the embedding store
+            tags, digests, embeddings = [], [], embeddings[:0]
+
+        driver.restore_feedback_state(rows, watermark)
+        driver.restore_index(
+            tags, digests, embeddings, candidates_restored, attributes)
+
+        logger.info("Restored %s with %d equipments in %.1fs",
+                    os.path.basename(path), manifest["count"], time.perf_counter() - start)
+
+        return True
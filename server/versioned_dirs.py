@@ -0,0 +1,60 @@
+from typing import List, Optional, Tuple
+
+import os
+import uuid
+
+
+# Helpers for stores of numbered directories (prefix-NNNNNN) with a
+# CURRENT file naming the newest complete one, written by more than one
+# process at once
+
+
+def version_dirs(root: str, prefix: str) -> List[str]:
+    return sorted(
+        name for name in os.listdir(root)
+        if name.startswith(prefix + "-")
+    )
+
+
+def claim_version(root: str, prefix: str) -> Tuple[int, str]:
+    # The next free version, claimed by creating its (empty) directory:
+    # os.mkdir fails for every process but one
+    while True:
+        existing = version_dirs(root, prefix)
+        version = int(existing[-1].split("-")[1]) + 1 if existing else 1
+        name = f"{prefix}-{version:06d}"
+
+        try:
+            os.mkdir(os.path.join(root, name))
+        except FileExistsError:
+            continue
+
+        return version, name
+
+
+def read_current(root: str, current_file: str = "CURRENT") -> Optional[str]:
+    current_path = os.path.join(root, current_file)
+
+    if not os.path.exists(current_path):
+        return None
+
+    with open(current_path, "r") as f:
+        return f.read().strip() or None
+
+
+def point_current(root: str, name: str, current_file: str = "CURRENT"):
+    # Atomically points CURRENT at name, unless it already names a newer
+    # version (a concurrent writer that finished first)
+    current = read_current(root, current_file)
+    if current is not None and current > name:
+        return
+
+    current_tmp = os.path.join(
+        root, f".{current_file}-{uuid.uuid4().hex}.tmp")
+
+    with open(current_tmp, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(current_tmp, os.path.join(root, current_file))
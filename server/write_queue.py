@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
+
+import logging
+import queue
+import threading
+import time
+import uuid
+
+if TYPE_CHECKING:
+    # NOTE: Only for annotations; importing the driver loads TensorFlow
+    from server.CCDRDriver import CCDRDriver
+
+logger = logging.getLogger('write_queue')
+logger.setLevel(logging.INFO)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    operation: str
+    tags: List[str]
+    status: str = "queued"
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "operation": self.operation,
+            "tags": self.tags,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class EquipmentWriteQueue:
+    """Applies equipment mutations off the request thread.
+
+    A single worker drains queued jobs in micro-batches: the tags of every
+    job in a batch are deduplicated (the latest operation on a tag wins)
+    and applied to the driver together, so their equipments are encoded
+    in one batch. When a batch fails its jobs are applied again one by
+    one, so only the jobs that fail on their own are marked failed.
+    """
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+    def __init__(
+        self,
+        driver: "CCDRDriver",
+        max_depth: int = 1000,
+        max_batch: int = 64,
+        job_retention: int = 10_000,
+    ):
+        self.driver = driver
+        self.max_depth = max_depth
+        self.max_batch = max_batch
+        self.job_retention = job_retention
+
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+
+        self._thread = threading.Thread(
+            target=self._run, name="equipment-write-queue", daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, operation: str, tags: Sequence[str]) -> Job:
+        assert operation in (self.UPSERT, self.DELETE)
+
+        if self._queue.qsize() >= self.max_depth:
+            raise QueueFullError(
+                f"{self._queue.qsize()} jobs waiting; try again later")
+
+        job = Job(id=uuid.uuid4().hex, operation=operation, tags=list(tags))
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict_finished()
+
+        self._queue.put(job)
+
+        return job
+
+    def _evict_finished(self):
+        # NOTE: Oldest first, and only finished jobs; queued and running
+        # ones are kept until they finish, so their status can be read
+        excess = len(self._jobs) - self.job_retention
+        if excess <= 0:
+            return
+
+        evicted = []
+        for job_id, job in self._jobs.items():
+            if len(evicted) == excess:
+                break
+
+            if job.finished_at is not None:
+                evicted.append(job_id)
+
+        for job_id in evicted:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+
+            if job is None:
+                return
+
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    next_job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if next_job is None:
+                    self._apply(batch)
+                    return
+
+                batch.append(next_job)
+
+            self._apply(batch)
+
+    def _apply(self, jobs: List[Job]):
+        latest: Dict[str, str] = {}
+
+        for job in jobs:
+            job.status = "running"
+            for tag in job.tags:
+                latest.pop(tag, None)
+                latest[tag] = job.operation
+
+        upserts = [tag for tag, operation in latest.items()
+                   if operation == self.UPSERT]
+        removals = [tag for tag, operation in latest.items()
+                    if operation == self.DELETE]
+
+        try:
+            result = self.driver.apply_equipment_changes(upserts, removals)
+        except Exception as e:
+            if len(jobs) > 1:
+                # NOTE: In submission order, so the latest operation on a
+                # tag still wins; applying a change twice is harmless
+                logger.exception(
+                    "Failed to apply %d jobs together; applying them one by one", len(jobs))
+
+                for job in jobs:
+                    self._apply([job])
+
+                return
+
+            logger.exception("Failed to apply job %s", jobs[0].id)
+
+            jobs[0].status = "failed"
+            jobs[0].error = str(e)
+            jobs[0].finished_at = time.time()
+
+            return
+
+        for job in jobs:
+            tags = set(job.tags)
+
+            job.result = {
+                key: [tag for tag in tags_of_key if tag in tags]
+                for key, tags_of_key in result.items()
+            }
+            job.status = "done"
+            job.finished_at = time.time()
+
+        logger.info("Applied %d jobs (%d upserts, %d removals)",
+                    len(jobs), len(upserts), len(removals))
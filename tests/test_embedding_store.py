@@ -0,0 +1,29 @@
+import numpy as np
+
+from ccdr.utils.embedding_store import EmbeddingStore
+
+
+def test_store_of_another_model_is_emptied(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "old-model")
+    store.put("text", np.ones(3))
+    store.flush()
+
+    store = EmbeddingStore(str(tmp_path), "new-model")
+    assert len(store) == 0
+
+    store.put("text", np.ones(5))
+    store.flush()
+
+    assert EmbeddingStore(str(tmp_path), "new-model").get("text").shape == (5,)
+
+
+def test_compact_keeps_touched_entries(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "model")
+    store.put_many(["kept", "stale"], [np.ones(3), np.zeros(3)])
+    store.flush()
+
+    store = EmbeddingStore(str(tmp_path), "model")
+    store.touch_many(["kept", "never stored"])
+
+    assert store.compact() == 1
+    assert "kept" in store and "stale" not in store
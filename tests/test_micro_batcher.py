@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ccdr.utils.micro_batcher import MicroBatcher
+
+
+def test_concurrent_items_share_batches():
+    batches = []
+
+    def compute(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(compute, max_batch=8, max_wait=0.05)
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(batcher.submit, [1, 2, 3, 3, 4]))
+
+    assert results == [2, 4, 6, 6, 8]
+    assert sum(len(batch) for batch in batches) == 4
+    assert len(batches) < 4
+
+
+def test_worker_survives_failed_and_short_batches():
+    def compute(items):
+        if "raise" in items:
+            raise RuntimeError("model failed")
+        if "short" in items:
+            return []
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(compute, max_batch=1)
+
+    with pytest.raises(RuntimeError):
+        batcher.submit("raise")
+
+    with pytest.raises(ValueError):
+        batcher.submit("short")
+
+    with pytest.raises(TypeError):
+        batcher.submit(["unhashable"])
+
+    assert batcher.submit("ok") == "OK"
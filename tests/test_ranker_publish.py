@@ -0,0 +1,95 @@
+import threading
+from typing import List
+
+import pytest
+
+ranking = pytest.importorskip("ccdr.ranking_model.ranking")
+
+TIMEOUT = 10
+
+
+class FakeDatabaseAccessor:
+    def __init__(self, ids: List[str]):
+        self.ids = ids
+
+    def get_unique_ids(self) -> List[str]:
+        return list(self.ids)
+
+
+class FakeRanker:
+    # Records what it was trained on, so a reader can tell whether the
+    # published rows belong to it
+
+    def __init__(self, ids: List[str], epochs: int, learning_rate: float):
+        self.unique_equipment_ids = ids
+        self.seen = {}
+        self.warmed_up = False
+
+    def warm_up(self):
+        self.warmed_up = True
+
+    def warm_start_from(self, other: "FakeRanker"):
+        self.seen = dict(other.seen)
+
+    def train(self, clicks, encode_queries, **kwargs):
+        self.seen.update(ranking.feedback_to_rows(clicks))
+
+
+def make_extension() -> "ranking.RankingExtension":
+    return ranking.RankingExtension(
+        FakeDatabaseAccessor(["a", "b", "c"]),
+        tokenizer_name="unused",
+        model_name="unused",
+        ranker_factory=FakeRanker,
+    )
+
+
+def test_learn_publishes_ranker_version_and_rows_together():
+    extension = make_extension()
+    rounds = 200
+
+    done = threading.Event()
+    errors = []
+
+    def read():
+        last_version = -1
+
+        while not done.is_set():
+            current = extension.current
+
+            if not current.ranker.warmed_up:
+                errors.append("ranker published before warm up")
+            if current.ranker.seen != current.trained_rows:
+                errors.append("ranker published with another ranker's rows")
+            if current.version < last_version:
+                errors.append("version went back")
+
+            last_version = current.version
+
+    readers = [threading.Thread(target=read, daemon=True) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+
+    clicks = {}
+    for round in range(rounds):
+        clicks[f"query {round}"] = [("a", 1.)]
+        extension.learn(dict(clicks))
+
+    done.set()
+    for reader in readers:
+        reader.join(TIMEOUT)
+
+    assert errors == []
+    assert extension.ranker_version == rounds
+    assert extension.current.trained_rows == ranking.feedback_to_rows(clicks)
+
+
+def test_learn_keeps_the_current_ranker_without_new_feedback():
+    extension = make_extension()
+
+    extension.learn({"query": [("a", 1.)]})
+    current = extension.current
+
+    extension.learn({"query": [("a", 1.)]})
+
+    assert extension.current is current
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from ccdr.utils.rwlock import ReadWriteLock
+
+TIMEOUT = 5
+
+
+def start(target) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    both_inside = threading.Barrier(2, timeout=TIMEOUT)
+
+    def read():
+        with lock.read():
+            both_inside.wait()
+
+    readers = [start(read) for _ in range(2)]
+    for reader in readers:
+        reader.join(TIMEOUT)
+
+    assert not any(reader.is_alive() for reader in readers)
+
+
+def test_writer_excludes_readers_and_writers():
+    lock = ReadWriteLock()
+    inside = []
+    overlaps = []
+    guard = threading.Lock()
+
+    def enter(kind: str):
+        with guard:
+            if "write" in inside or (kind == "write" and inside):
+                overlaps.append((kind, list(inside)))
+            inside.append(kind)
+
+        time.sleep(0.001)
+
+        with guard:
+            inside.remove(kind)
+
+    def read():
+        for _ in range(50):
+            with lock.read():
+                enter("read")
+
+    def write():
+        for _ in range(50):
+            with lock.write():
+                enter("write")
+
+    threads = [start(read) for _ in range(4)] + [start(write) for _ in range(2)]
+    for thread in threads:
+        thread.join(TIMEOUT * 4)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert overlaps == []
+
+
+def test_waiting_writer_goes_before_new_readers():
+    lock = ReadWriteLock()
+    order = []
+
+    lock.acquire_read()
+
+    writer = start(lambda: (lock.acquire_write(), order.append("write"), lock.release_write()))
+
+    # NOTE: The writer is queued once it is counted as waiting
+    deadline = time.monotonic() + TIMEOUT
+    while not lock._writers_waiting and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert lock._writers_waiting == 1
+
+    reader = start(lambda: (lock.acquire_read(), order.append("read"), lock.release_read()))
+
+    reader.join(0.05)
+    assert reader.is_alive(), "a new reader got in ahead of the waiting writer"
+
+    lock.release_read()
+
+    writer.join(TIMEOUT)
+    reader.join(TIMEOUT)
+
+    assert order == ["write", "read"]
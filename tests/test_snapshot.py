@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+from ccdr.utils.rwlock import ReadWriteLock
+from server.snapshot import SnapshotStore
+
+
+class FakeRanking:
+    def __init__(self, ranker: str):
+        self.ranker = ranker
+
+    def save_ranker(self, path: str):
+        os.makedirs(path)
+        with open(os.path.join(path, "ranker.txt"), "w") as f:
+            f.write(self.ranker)
+
+    def read_ranker(self, path: str):
+        with open(os.path.join(path, "ranker.txt"), "r") as f:
+            return f.read(), {}
+
+    def publish(self, ranker: str, trained_rows):
+        self.ranker = ranker
+
+
+class FakeCandidateGenerator:
+    stores_embeddings = False
+
+    def state(self):
+        return "clusters"
+
+    def save(self, state: str, path: str) -> bool:
+        with open(os.path.join(path, "state.txt"), "w") as f:
+            f.write(state)
+        return True
+
+    def load(self, path: str) -> bool:
+        with open(os.path.join(path, "state.txt"), "r") as f:
+            if f.read() != "clusters":
+                raise ValueError("corrupt candidate state")
+        return True
+
+
+class FakeAttributeIndex:
+    def state(self):
+        return {}
+
+
+class FakeDriver:
+    def __init__(self, ranker: str):
+        self.index_lock = ReadWriteLock()
+        self.equipment_transformer = None
+        self.candidate_generator = FakeCandidateGenerator()
+        self.attribute_index = FakeAttributeIndex()
+        self.ranking = FakeRanking(ranker)
+        self.restored = False
+
+    def export_index(self):
+        return ["a"], ["digest"], np.ones((1, 4), dtype=np.float32)
+
+    def feedback_state(self):
+        return {}, None
+
+    def restore_feedback_state(self, rows, watermark):
+        pass
+
+    def restore_index(self, tags, digests, embeddings, candidates_restored, attributes):
+        self.restored = True
+
+
+def test_restore_publishes_the_snapshot_ranker(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    store.save(FakeDriver("saved ranker"))
+
+    driver = FakeDriver("previous ranker")
+    assert store.restore(driver)
+
+    assert driver.ranking.ranker == "saved ranker"
+    assert driver.restored
+
+
+def test_corrupt_candidates_keep_the_previous_ranker(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    path = store.save(FakeDriver("saved ranker"))
+
+    with open(os.path.join(path, "candidates", "state.txt"), "w") as f:
+        f.write("garbage")
+
+    driver = FakeDriver("previous ranker")
+    assert not store.restore(driver)
+
+    assert driver.ranking.ranker == "previous ranker"
+    assert not driver.restored
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from ccdr.retrieval.ivf_index import IVFIndex
+from ccdr.retrieval.vector_index import BruteForceIndex
+
+
+@pytest.fixture(params=[BruteForceIndex, IVFIndex])
+def index_class(request):
+    return request.param
+
+
+def test_search_ranks_by_cosine_similarity(index_class):
+    index = index_class()
+    index.add_many(["x", "y", "xy"], np.array([[1., 0.], [0., 1.], [1., 1.]]))
+
+    assert [tag for tag, _ in index.search(np.array([1., .1]), 3)] == ["x", "xy", "y"]
+
+    index.remove("x")
+    assert [tag for tag, _ in index.search(np.array([1., .1]), 3)] == ["xy", "y"]
+
+
+def test_ivf_probing_every_list_matches_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, 8))
+    tags = [str(tag) for tag in range(600)]
+
+    exact = BruteForceIndex()
+    exact.add_many(tags, vectors)
+
+    ivf = IVFIndex(n_lists=8, n_probe=8, min_train_size=500)
+    ivf.add_many(tags, vectors)
+    assert ivf.is_trained
+
+    for query in rng.standard_normal((5, 8)):
+        assert [tag for tag, _ in ivf.search(query, 10)] == \
+            [tag for tag, _ in exact.search(query, 10)]
+
+
+def test_empty_index_reloads_without_a_dim(index_class, tmp_path):
+    index = index_class()
+    index.save(str(tmp_path))
+
+    loaded = index_class.load(str(tmp_path), **index.params())
+    assert loaded.dim is None
+
+    loaded.add("a", np.ones(4))
+    assert loaded.dim == 4
+    assert [tag for tag, _ in loaded.search(np.ones(4), 1)] == ["a"]
+
+
+def test_repeated_tag_keeps_its_last_vector(index_class):
+    index = index_class()
+    index.add_many(["a", "b", "a"], np.eye(3))
+
+    assert len(index) == 2
+    assert [tag for tag, _ in index.search(np.array([0., 0., 1.]), 3)] == ["a", "b"]
+    assert index.copy()._size == 2
+
+
+def test_ivf_probed_rows_follow_adds_and_removals():
+    rng = np.random.default_rng(0)
+    index = IVFIndex(min_train_size=500, n_lists=16)
+
+    vectors = rng.standard_normal((1000, 8))
+    index.add_many([str(tag) for tag in range(500)], vectors[:500])
+
+    for start in range(500, 1000, 25):
+        index.add_many([str(tag) for tag in range(start, start + 25)],
+                       vectors[start:start + 25])
+
+        for tag in rng.choice(start, 10):
+            index.remove(str(tag))
+
+        probed = np.arange(4)
+        expected = np.flatnonzero(np.isin(index._lists[:index._size], probed))
+
+        assert np.array_equal(index._probed_rows(probed), expected)
+
+
+def test_ivf_copy_searches_like_the_original():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, 8))
+
+    index = IVFIndex(n_lists=8, n_probe=2, min_train_size=500)
+    index.add_many([str(tag) for tag in range(600)], vectors)
+    for tag in range(0, 600, 7):
+        index.remove(str(tag))
+
+    copy = index.copy()
+    assert copy.is_trained
+
+    for query in rng.standard_normal((5, 8)):
+        assert copy.search(query, 10) == index.search(query, 10)
@@ -0,0 +1,44 @@
+from server.write_queue import EquipmentWriteQueue
+
+
+class FakeDriver:
+    # Fails any batch that touches a bad tag
+
+    def __init__(self, bad_tags):
+        self.bad_tags = set(bad_tags)
+        self.applied = []
+
+    def apply_equipment_changes(self, upserts, removals):
+        if self.bad_tags & set(upserts):
+            raise ValueError("bad tag")
+
+        self.applied.append((list(upserts), list(removals)))
+        return {"added": list(upserts), "removed": list(removals)}
+
+
+def test_failed_batch_is_applied_job_by_job():
+    write_queue = EquipmentWriteQueue(FakeDriver(["bad"]))
+
+    good = write_queue.submit(EquipmentWriteQueue.UPSERT, ["a"])
+    bad = write_queue.submit(EquipmentWriteQueue.UPSERT, ["bad"])
+    removal = write_queue.submit(EquipmentWriteQueue.DELETE, ["b"])
+
+    write_queue._apply([good, bad, removal])
+
+    assert good.status == "done" and good.result == {"added": ["a"], "removed": []}
+    assert bad.status == "failed" and bad.error == "bad tag"
+    assert removal.status == "done" and removal.result == {"added": [], "removed": ["b"]}
+
+
+def test_retention_only_evicts_finished_jobs():
+    write_queue = EquipmentWriteQueue(FakeDriver([]), job_retention=2)
+
+    queued = write_queue.submit(EquipmentWriteQueue.UPSERT, ["a"])
+    finished = write_queue.submit(EquipmentWriteQueue.UPSERT, ["b"])
+    write_queue._apply([finished])
+
+    latest = write_queue.submit(EquipmentWriteQueue.UPSERT, ["c"])
+
+    assert write_queue.get(queued.id) is queued
+    assert write_queue.get(finished.id) is None
+    assert write_queue.get(latest.id) is latest